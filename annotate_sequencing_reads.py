@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+
+# Author: John Hawkins (jsh) [really@gmail.com]
+
+import argparse
+import itertools
+import logging
+import multiprocessing
+import sys
+
+import Bio.SeqIO
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+import packed_targets
+
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s %(levelname)s %(message)s')
+
+class Error(Exception):
+  pass
+
+class SampleError(Error):
+  pass
+
+
+DNA_PAIRINGS = str.maketrans('atcgATCG', 'tagcTAGC')
+
+def revcomp(x):
+  return x.translate(DNA_PAIRINGS)[::-1]
+
+
+# Reads handed to a worker at a time.
+CHUNK_SIZE = 10000
+# Marks a neighbourhood entry claimed equally well by more than one guide.
+AMBIGUOUS = -1
+
+
+def get_comparison_regions(parent_plasmid):
+  """Find the flanks around the guide in the parent plasmid.
+
+  Args:
+    parent_plasmid: parsed genbank SeqIO object for parent plasmid.
+  Returns:
+    (roi_front, target, roi_back): The three parts of the must_have region.
+  """
+  logging.info('Extracting regions from parent plasmid.')
+  items = [x for x in parent_plasmid.features if 'label' in x.qualifiers]
+  rois = [x for x in items if x.qualifiers['label'][0] == 'region_of_interest']
+  targets = [x for x in items if x.qualifiers['label'][0] == 'target']
+  for label, found in (('region_of_interest', rois), ('target', targets)):
+    if len(found) != 1:
+      logging.error('Expected one {label} label in plasmid, found {0}.'.format(
+          len(found), **vars()))
+      sys.exit(1)
+  roi = rois[0].extract(parent_plasmid)
+  target = targets[0].extract(parent_plasmid)
+  target_relstart = roi.seq.find(target.seq)
+  if target_relstart < 0:
+    logging.error("'target' label not inside region_of_interest.")
+    sys.exit(1)
+  roi_front = roi.seq[:target_relstart]
+  roi_back = roi.seq[target_relstart + len(target.seq):]
+  return (str(roi_front).upper(),
+          str(target.seq).upper(),
+          str(roi_back).upper())
+
+
+def read_target_library(target_library_file):
+  """Read (id, sequence) pairs, one per line; returns dict of seq -> id."""
+  target_library = dict()
+  for line in target_library_file:
+    if line.startswith('#'):
+      continue  # Allow comments.
+    fields = line.strip().split('\t')
+    if len(fields) != 2:
+      logging.error('Expected 2 fields in line:\n{line}'.format(**vars()))
+      sys.exit(1)
+    target_id, target_seq = fields
+    target_seq = target_seq.upper()
+    if target_seq in target_library:
+      # Bail!  We saw the same target multiple times, maybe with different ids.
+      oid = target_library[target_seq]
+      nid = target_id
+      seq = target_seq
+      logging.error(
+          'Saw {seq} twice, first as {oid} and then as {nid}'.format(**vars()))
+      sys.exit(1)
+    target_library[target_seq] = target_id
+  return target_library
+
+
+def iter_fasta(handle):
+  """Stream (id, sequence) pairs from a FASTA file, without SeqIO."""
+  name = None
+  parts = list()
+  for line in handle:
+    if line.startswith('>'):
+      if name is not None:
+        yield name, ''.join(parts).upper()
+      name = line[1:].split(None, 1)[0]
+      parts = list()
+    else:
+      parts.append(line.strip())
+  if name is not None:
+    yield name, ''.join(parts).upper()
+
+
+class guide_index(object):
+  """Index of library guides, for exact or near (mismatched) lookups.
+
+  Every guide, and every sequence within max_mismatches substitutions of it, is
+  packed 2 bits per base into a sorted uint64 array, so a whole batch of
+  candidate windows is resolved with one searchsorted.  A neighbour claimed by
+  two guides at the same distance is ambiguous and never reported.
+  """
+  def __init__(self, library, max_mismatches=1):
+    self.names = list()
+    self.sequences = list()
+    self.lengths = list()
+    self._keys = dict()
+    self._guides = dict()
+    self._distances = dict()
+    by_length = dict()
+    for seq, name in library.items():
+      if len(seq) > 32 or set(seq) - set(packed_targets.BASES):
+        logging.warning('Cannot index guide {name} ({seq}).'.format(**vars()))
+        continue
+      by_length.setdefault(len(seq), list()).append((seq, len(self.names)))
+      self.names.append(name)
+      self.sequences.append(seq)
+    for length, entries in sorted(by_length.items()):
+      self.lengths.append(length)
+      keys = packed_targets.pack(packed_targets.encode(x[0] for x in entries))
+      guides = np.array([x[1] for x in entries], dtype=np.int64)
+      all_keys = [keys]
+      all_guides = [guides]
+      all_distances = [np.zeros(len(keys), dtype=np.int64)]
+      for distance in range(1, max_mismatches + 1):
+        for positions in itertools.combinations(range(length), distance):
+          for subs in itertools.product((1, 2, 3), repeat=distance):
+            flip = 0
+            for p, s in zip(positions, subs):
+              flip |= s << (2 * (length - 1 - p))
+            all_keys.append(keys ^ np.uint64(flip))
+            all_guides.append(guides)
+            all_distances.append(np.full(len(keys), distance, dtype=np.int64))
+      keys = np.concatenate(all_keys)
+      guides = np.concatenate(all_guides)
+      distances = np.concatenate(all_distances)
+      order = np.lexsort((guides, distances, keys))
+      keys, guides, distances = keys[order], guides[order], distances[order]
+      first = np.ones(len(keys), dtype=bool)
+      first[1:] = keys[1:] != keys[:-1]
+      # The closest guide wins, unless another guide is just as close.
+      tied = np.zeros(len(keys), dtype=bool)
+      tied[:-1] = (~first[1:] & (distances[1:] == distances[:-1]) &
+                   (guides[1:] != guides[:-1]))
+      guides = np.where(tied, AMBIGUOUS, guides)
+      self._keys[length] = keys[first]
+      self._guides[length] = guides[first]
+      self._distances[length] = distances[first]
+    logging.info('Indexed {0} guides, {1} sequences in all.'.format(
+        len(self.names), sum(len(x) for x in self._keys.values())))
+
+  def lookup(self, codes):
+    """Resolve equal-length windows, given as a matrix of base codes.
+
+    Returns:
+      (guides, distances): guide number (or -1) and mismatches for each row.
+    """
+    n = len(codes)
+    guides = np.full(n, AMBIGUOUS, dtype=np.int64)
+    distances = np.zeros(n, dtype=np.int64)
+    length = codes.shape[1] if codes.ndim == 2 else 0
+    if not n or length not in self._keys:
+      return guides, distances
+    packable = (codes < packed_targets.UNKNOWN_CODE).all(axis=1)
+    keys = packed_targets.pack(np.where(packable[:, None], codes, 0))
+    table = self._keys[length]
+    where = np.minimum(np.searchsorted(table, keys), len(table) - 1)
+    found = packable & (table[where] == keys)
+    guides[found] = self._guides[length][where[found]]
+    distances[found] = self._distances[length][where[found]]
+    return guides, distances
+
+  def lookup_strings(self, windows):
+    """Like lookup(), for a list of strings of any lengths."""
+    guides = np.full(len(windows), AMBIGUOUS, dtype=np.int64)
+    distances = np.zeros(len(windows), dtype=np.int64)
+    for length in self.lengths:
+      rows = [i for i, x in enumerate(windows) if len(x) == length]
+      if rows:
+        found, mismatches = self.lookup(
+            packed_targets.encode(windows[i] for i in rows))
+        guides[rows] = found
+        distances[rows] = mismatches
+    return guides, distances
+
+  def scan(self, seq):
+    """Find an exact guide match anywhere in seq; returns guide number or -1."""
+    codes = packed_targets.encode([seq])[0]
+    for length in self.lengths:
+      if len(codes) < length:
+        continue
+      windows = sliding_window_view(codes, length)
+      guides, distances = self.lookup(windows)
+      hits = np.flatnonzero((guides != AMBIGUOUS) & (distances == 0))
+      if len(hits):
+        return guides[hits[0]]
+    return AMBIGUOUS
+
+
+def extract_window(seq, roi_front, roi_back):
+  """Return the stretch between the flanks, or None if they aren't in order."""
+  front = seq.find(roi_front)
+  if front < 0:
+    return None
+  start = front + len(roi_front)
+  back = seq.find(roi_back, start)
+  if back < 0:
+    return None
+  return seq[start:back]
+
+
+def orient_and_extract(seq, roi_front, roi_back):
+  """Extract the guide window from either strand of a read.
+
+  Returns:
+    (seq, window): the read, reverse complemented if that is the strand on
+      which the flanks were found, and the window (None if not found).
+  """
+  window = extract_window(seq, roi_front, roi_back)
+  if window is None:
+    # Maybe this was a reverse primer.
+    rc = revcomp(seq)
+    window = extract_window(rc, roi_front, roi_back)
+    if window is not None:
+      return rc, window
+  return seq, window
+
+
+# Set in each worker (inherited from the parent where processes are forked).
+_WORKER_STATE = dict()
+
+def _init_worker(index, roi_front, roi_back):
+  _WORKER_STATE['index'] = index
+  _WORKER_STATE['flanks'] = (roi_front, roi_back)
+
+
+def annotate_chunk(records):
+  """Annotate a batch of reads against the guide index.
+
+  Args:
+    records [list]:  (read id, sequence) pairs.
+  Returns:
+    list of output rows, in input order.
+  """
+  index = _WORKER_STATE['index']
+  roi_front, roi_back = _WORKER_STATE['flanks']
+  oriented = list()
+  windows = list()
+  for _, seq in records:
+    seq, window = orient_and_extract(seq, roi_front, roi_back)
+    oriented.append(seq)
+    windows.append(window)
+  found = [x for x in windows if x is not None]
+  guides, distances = index.lookup_strings(found)
+  rows = list()
+  hits = iter(zip(guides, distances))
+  for (read_id, _), seq, window in zip(records, oriented, windows):
+    roi_matched = window is not None
+    if roi_matched:
+      guide, mismatches = next(hits)
+      guide_seq = window
+    else:
+      guide, mismatches = AMBIGUOUS, 0
+      guide_seq = ''
+      for candidate in (seq, revcomp(seq)):
+        guide = index.scan(candidate)
+        if guide != AMBIGUOUS:
+          seq = candidate
+          break
+    known = guide != AMBIGUOUS
+    guide_id = index.names[guide] if known else ''
+    if known and not roi_matched:
+      guide_seq = index.sequences[guide]
+    fields = (read_id,
+              guide_id,
+              guide_seq,
+              seq,
+              roi_matched,
+              known,
+              mismatches if known else '')
+    rows.append('\t'.join(str(x) for x in fields) + '\n')
+  return rows
+
+
+def annotate_reads(records, index, roi_front, roi_back, processes):
+  """Annotate a stream of reads in parallel chunks, yielding rows in order."""
+  chunks = iter(lambda: list(itertools.islice(records, CHUNK_SIZE)), [])
+  if processes <= 1:
+    _init_worker(index, roi_front, roi_back)
+    for chunk in chunks:
+      for row in annotate_chunk(chunk):
+        yield row
+    return
+  pool = multiprocessing.Pool(processes, _init_worker,
+                              (index, roi_front, roi_back))
+  try:
+    for rows in pool.imap(annotate_chunk, chunks):
+      for row in rows:
+        yield row
+  finally:
+    pool.terminate()
+
+
+def parse_args():
+  """Read in the arguments for the sgrna sequencing result analysis code."""
+  logging.info('Parsing command line.')
+  parser = argparse.ArgumentParser(
+      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument('--input_target_lib', type=argparse.FileType('r'),
+                      required=True,
+                      help='Library guides, as "id<TAB>sequence" lines.')
+  parser.add_argument('--input_sequences', type=argparse.FileType('r'),
+                      required=True, help='Sequencing reads, in FASTA format.')
+  parser.add_argument('--parent_plasmid', type=str, required=True,
+                      help=('GenBank file of the parent plasmid, with '
+                            'region_of_interest and target labels.'))
+  parser.add_argument('--output_file', type=argparse.FileType('w'),
+                      default=sys.stdout, help='Where to write annotations.')
+  parser.add_argument('--max_mismatches', type=int, default=1,
+                      help='Mismatches allowed when matching a guide.')
+  parser.add_argument('--processes', type=int,
+                      default=multiprocessing.cpu_count(),
+                      help='Worker processes for annotating reads.')
+  args = parser.parse_args()
+  return args
+
+
+def main():
+  args = parse_args()
+  logging.info(
+      'Parsing target lib file: {0}.'.format(args.input_target_lib.name))
+  target_library = read_target_library(args.input_target_lib)
+  logging.info('Parsing parent plasmid file: {0}.'.format(args.parent_plasmid))
+  parent_vector = Bio.SeqIO.read(args.parent_plasmid, 'genbank')
+  (roi_front, parent_target, roi_back) = get_comparison_regions(parent_vector)
+  target_library[parent_target] = 'PARENT'
+  index = guide_index(target_library, args.max_mismatches)
+  logging.info(
+      'Annotating reads from {0}.'.format(args.input_sequences.name))
+  records = iter_fasta(args.input_sequences)
+  for row in annotate_reads(
+      records, index, roi_front, roi_back, args.processes):
+    args.output_file.write(row)
+
+##############################################
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+
+# Author: John Hawkins (jsh) [really@gmail.com]
+
+import gzip
+import logging
+import os
+import os.path
+import re
+import sys
+
+from Bio import SeqIO
+import numpy as np
+
+
+# Bump when the parsing rules change, so old sidecars are not trusted.
+CACHE_VERSION = '1'
+CACHE_SUFFIX = '.regions.npz'
+
+FORMAT_EXTENSIONS = {
+    '.gb': 'genbank',
+    '.gbk': 'genbank',
+    '.gbff': 'genbank',
+    '.genbank': 'genbank',
+    '.gff': 'gff3',
+    '.gff3': 'gff3',
+    '.gtf': 'gtf',
+    '.tsv': 'regions',
+}
+
+# Feature types used as regions when the caller doesn't say.
+DEFAULT_FEATURE_TYPES = ('gene',)
+
+# Attributes that name a feature, in order of preference.
+GFF_NAME_KEYS = ('Name', 'locus_tag', 'gene')
+GTF_NAME_KEYS = ('gene_name', 'gene_id')
+
+_GFF_ATTRIBUTE = dict(
+    (k, re.compile(r'(?:^|;)\s*' + k + r'=([^;]*)', re.IGNORECASE))
+    for k in GFF_NAME_KEYS)
+_GTF_ATTRIBUTE = dict(
+    (k, re.compile(r'(?:^|;)\s*' + k + r'\s+"?([^";]*)"?'))
+    for k in GTF_NAME_KEYS)
+
+
+def guess_format(file_name):
+  """Annotation format from a file name (ignoring a trailing .gz)."""
+  base = file_name[:-3] if file_name.endswith('.gz') else file_name
+  ext = os.path.splitext(base)[1].lower()
+  if ext not in FORMAT_EXTENSIONS:
+    logging.error('Cannot tell the annotation format of {file_name}.'.format(
+        **vars()))
+    sys.exit(1)
+  return FORMAT_EXTENSIONS[ext]
+
+
+def open_text(file_name):
+  """Open a (possibly gzipped) text file."""
+  if file_name.endswith('.gz'):
+    return gzip.open(file_name, 'rt')
+  return open(file_name)
+
+
+def stranded(name, chrom, start, end, strand):
+  """Region entries for one feature; unknown strands claim both."""
+  if strand in ('+', '-'):
+    return [(name, chrom, start, end, strand)]
+  return [(name, chrom, start, end, '+'), (name, chrom, start, end, '-')]
+
+
+def record_regions(item):
+  """Regions from one GenBank record's 'gene' features, or its 'CDS' features
+  if it has no genes.  The features are walked once, keeping both types.
+  """
+  chrom = item.id
+  found = {'gene': list(), 'CDS': list()}
+  for feature in item.features:
+    if feature.type not in found:
+      continue
+    if 'locus_tag' in feature.qualifiers:
+      name = feature.qualifiers['locus_tag'][0]
+    elif 'gene' in feature.qualifiers:
+      name = feature.qualifiers['gene'][0]
+    else:
+      logging.error('No locus_tag or gene for {feature}.'.format(**vars()))
+      template = 'BAILING OUT UNTIL MISSING FEATURE-NAME ISSUE IS RESOLVED'
+      logging.error(template.format(**vars()))
+      sys.exit(2)
+    strand = {1: '+', -1: '-'}.get(feature.location.strand)
+    found[feature.type].extend(stranded(name,
+                                        chrom,
+                                        int(feature.location.start),
+                                        int(feature.location.end),
+                                        strand))
+  return found['gene'] or found['CDS']
+
+
+def genbank_regions(genbank_file):
+  """Regions from every record of a GenBank file (see record_regions).
+
+  Returns:
+    target_regions: list of (gene, chrom, start, end, strand) entries.
+  """
+  target_regions = list()
+  for item in SeqIO.parse(genbank_file, 'genbank'):
+    target_regions.extend(record_regions(item))
+    logging.info(
+        'Found {0} target regions in genbank file.'.format(len(target_regions)))
+  return target_regions
+
+
+def feature_regions(annotation_file, attribute_patterns, feature_types):
+  """Regions from the wanted features of a GFF3 or GTF file.
+
+  Coordinates are converted from 1-based, inclusive to 0-based, half-open.
+  Only the attributes of wanted features are searched for a name; features
+  without one are skipped.
+  """
+  wanted = set(feature_types)
+  target_regions = list()
+  unnamed = 0
+  with open_text(annotation_file) as handle:
+    for x in handle:
+      if x.startswith('#'):
+        if x.startswith('##FASTA'):
+          break
+        continue
+      parts = x.rstrip('\n').split('\t')
+      if len(parts) != 9:
+        if x.strip():
+          logging.error('Could not parse: {x}'.format(**vars()))
+          sys.exit(1)
+        continue
+      if parts[2] not in wanted:
+        continue
+      attributes = parts[8]
+      name = None
+      for pattern in attribute_patterns:
+        match = pattern.search(attributes)
+        if match:
+          name = match.group(1)
+          break
+      if not name:
+        unnamed += 1
+        continue
+      target_regions.extend(stranded(name,
+                                     parts[0],
+                                     int(parts[3]) - 1,
+                                     int(parts[4]),
+                                     parts[6]))
+  if unnamed:
+    logging.warning('Skipped {0} features without a name.'.format(unnamed))
+  logging.info('Found {0} target regions in {1}.'.format(
+      len(target_regions), annotation_file))
+  return target_regions
+
+
+def table_regions(target_regions_file):
+  """Regions from a (gene, chrom, start, end, strand) TSV file."""
+  logging.info('Parsing target region file.')
+  target_regions = list()
+  for x in open_text(target_regions_file):
+    if x.startswith('#'):
+      continue
+    parts = x.strip().split('\t')
+    try:
+      (name,chrom,start,end,strand) = parts
+    except ValueError:
+      trf = target_regions_file
+      logging.error('Could not parse from {trf}: {x}'.format(**vars()))
+      sys.exit(1)
+    try:
+      target_regions.append((name, chrom, int(start), int(end), strand))
+    except ValueError:
+      x = x.strip()
+      logging.warning('Could not fully parse: {x}'.format(**vars()))
+      continue
+  logging.info(
+      'Found {0} target regions in region file.'.format(len(target_regions)))
+  return target_regions
+
+
+def sort_regions(target_regions):
+  """Order regions by start within each chromosome, as label_targets expects.
+
+  Chromosomes keep the order in which they first appear.
+  """
+  chrom_order = dict()
+  for x in target_regions:
+    chrom_order.setdefault(x[1], len(chrom_order))
+  return sorted(target_regions, key=lambda x: (chrom_order[x[1]], x[2], x[3]))
+
+
+def source_signature(annotation_file, annotation_format, feature_types):
+  """String that changes whenever a cached table could be out of date."""
+  info = os.stat(annotation_file)
+  return '|'.join([CACHE_VERSION,
+                   os.path.abspath(annotation_file),
+                   str(info.st_size),
+                   str(info.st_mtime_ns),
+                   annotation_format,
+                   ','.join(sorted(feature_types))])
+
+
+def save_regions(cache_file_name, signature, target_regions):
+  """Write a region table as a binary sidecar."""
+  columns = list(zip(*target_regions)) or [(), (), (), (), ()]
+  np.savez(cache_file_name,
+           signature=np.array(signature),
+           gene=np.array(columns[0], dtype=str),
+           chrom=np.array(columns[1], dtype=str),
+           start=np.array(columns[2], dtype=np.int64),
+           end=np.array(columns[3], dtype=np.int64),
+           strand=np.array(columns[4], dtype=str))
+
+
+def load_cached_regions(cache_file_name, signature):
+  """Region table from a sidecar, or None if missing or stale."""
+  if not os.path.exists(cache_file_name):
+    return None
+  try:
+    with np.load(cache_file_name, allow_pickle=False) as cached:
+      if str(cached['signature']) != signature:
+        return None
+      return list(zip(cached['gene'].tolist(),
+                      cached['chrom'].tolist(),
+                      cached['start'].tolist(),
+                      cached['end'].tolist(),
+                      cached['strand'].tolist()))
+  except (OSError, KeyError, ValueError):
+    logging.warning('Ignoring unreadable region cache {0}.'.format(
+        cache_file_name))
+    return None
+
+
+def load_regions(annotation_file, annotation_format=None, feature_types=None,
+                 use_cache=True):
+  """Load the target regions of an annotation file.
+
+  Args:
+    annotation_file [str]:    GenBank, GFF3, GTF or region TSV file.
+    annotation_format [str]:  One of FORMAT_EXTENSIONS' values; guessed from
+                              the file name if None.
+    feature_types [list]:     GFF3/GTF feature types to use as regions.
+    use_cache [bool]:         Read and write a '.regions.npz' sidecar.
+  Returns:
+    target_regions: list of (gene, chrom, start, end, strand) entries, with
+      0-based, half-open coordinates.
+  """
+  if annotation_format is None:
+    annotation_format = guess_format(annotation_file)
+  if feature_types is None:
+    feature_types = DEFAULT_FEATURE_TYPES
+  cache_file_name = annotation_file + CACHE_SUFFIX
+  if use_cache:
+    signature = source_signature(annotation_file,
+                                 annotation_format,
+                                 feature_types)
+    target_regions = load_cached_regions(cache_file_name, signature)
+    if target_regions is not None:
+      logging.info('Read {0} target regions from {1}.'.format(
+          len(target_regions), cache_file_name))
+      return target_regions
+  if annotation_format == 'genbank':
+    target_regions = genbank_regions(annotation_file)
+  elif annotation_format == 'gff3':
+    target_regions = sort_regions(feature_regions(
+        annotation_file, [_GFF_ATTRIBUTE[k] for k in GFF_NAME_KEYS],
+        feature_types))
+  elif annotation_format == 'gtf':
+    target_regions = sort_regions(feature_regions(
+        annotation_file, [_GTF_ATTRIBUTE[k] for k in GTF_NAME_KEYS],
+        feature_types))
+  elif annotation_format == 'regions':
+    target_regions = table_regions(annotation_file)
+  else:
+    raise ValueError('Unknown annotation format: {0}'.format(annotation_format))
+  if use_cache:
+    try:
+      save_regions(cache_file_name, signature, target_regions)
+    except OSError as e:
+      logging.warning('Could not write region cache {0}: {1}'.format(
+          cache_file_name, e))
+  return target_regions
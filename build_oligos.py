@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+
+# Author: John Hawkins (jsh) [really@gmail.com]
+
+import argparse
+import logging
+import os.path
+import sys
+
+import numpy as np
+
+import cut_sites
+import library_io
+import packed_targets
+from target_table import target_table
+
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s %(levelname)s %(message)s')
+
+class Error(Exception):
+  pass
+
+class SampleError(Error):
+  pass
+
+
+# Oligos formatted and written at a time.
+CHUNK_SIZE = 100000
+
+
+class cloning_template(object):
+  """Everything that goes around a guide in one sublibrary's oligos."""
+  def __init__(self, name, prefix, suffix):
+    self.name = name
+    self.prefix = prefix.upper()
+    self.suffix = suffix.upper()
+
+
+def parse_template(x):
+  """Template from 'NAME=PREFIX:SUFFIX'."""
+  try:
+    name, flanks = x.split('=', 1)
+    prefix, suffix = flanks.split(':', 1)
+  except ValueError:
+    logging.error('Template {x} is not of the form NAME=PREFIX:SUFFIX.'.format(
+        **vars()))
+    sys.exit(1)
+  return cloning_template(name, prefix, suffix)
+
+
+def read_templates(templates_file):
+  """Templates from 'name<TAB>prefix<TAB>suffix' lines."""
+  templates = list()
+  for x in templates_file:
+    if x.startswith('#') or not x.strip():
+      continue
+    parts = x.strip().split('\t')
+    if len(parts) != 3:
+      logging.error('Could not parse template: {x}'.format(**vars()))
+      sys.exit(1)
+    templates.append(cloning_template(*parts))
+  return templates
+
+
+def assemble(guides, template):
+  """Build every oligo for one template in a single pass.
+
+  Args:
+    guides [array]:   (n, length) uint8 array of guide bases (ASCII).
+    template:         cloning_template to place around them.
+  Returns:
+    (n, width) uint8 array of oligo bases (ASCII).
+  """
+  n = len(guides)
+  prefix = np.frombuffer(template.prefix.encode('ascii'), dtype=np.uint8)
+  suffix = np.frombuffer(template.suffix.encode('ascii'), dtype=np.uint8)
+  return np.concatenate([np.broadcast_to(prefix, (n, len(prefix))),
+                         guides,
+                         np.broadcast_to(suffix, (n, len(suffix)))], axis=1)
+
+
+def length_matchers(matcher):
+  """Split a site_matcher into one per site length, keyed by that length."""
+  lengths = sorted(set(len(x) for x in matcher.patterns))
+  if len(lengths) == 1:
+    return {lengths[0]: matcher}
+  return dict((n, cut_sites.site_matcher(
+                  [x for x in matcher.patterns if len(x) == n],
+                  matcher.contexts))
+              for n in lengths)
+
+
+def new_cut_sites(oligos, template, guide_len, matchers):
+  """Whether each assembled oligo has a site that involves the guide.
+
+  Sites lying wholly inside the template (the intended cloning sites) are not
+  counted; everything that overlaps the guide, including the junctions, is.
+  Each site length gets its own window, so that a short site in the template
+  is not mistaken for one reaching into the guide.
+
+  Args:
+    matchers [dict]:  From length_matchers().
+  """
+  bad = np.zeros(len(oligos), dtype=bool)
+  for length, matcher in matchers.items():
+    if not matcher.patterns:
+      continue
+    lo = max(len(template.prefix) - (length - 1), 0)
+    hi = len(template.prefix) + guide_len + length - 1
+    bad |= matcher.any_site(packed_targets.BASE_CODES[oligos[:, lo:hi]])
+  return bad
+
+
+def format_fasta(names, sequences):
+  return ''.join('>{0}\n{1}\n'.format(n, s) for n, s in zip(names, sequences))
+
+def format_csv(names, sequences):
+  return ''.join('{0},{1}\n'.format(n, s) for n, s in zip(names, sequences))
+
+def format_tsv(names, sequences):
+  return ''.join('{0}\t{1}\n'.format(n, s) for n, s in zip(names, sequences))
+
+# Output formats: (header, row formatter).
+OLIGO_FORMATS = {
+    'fasta': ('', format_fasta),
+    'csv': ('name,sequence\n', format_csv),
+    'tsv': ('', format_tsv),
+    # Pooled oligo orders, e.g. IDT oPools.
+    'opool': ('Pool name\tSequence\n', format_tsv),
+}
+
+
+def oligo_names(table, template):
+  """Name each guide's oligo after the template, gene and offset or locus."""
+  names = list()
+  for gene, offset, chrom, start in zip(table['gene'], table['offset'],
+                                        table['chrom'], table['start']):
+    if gene is None:
+      names.append('{0}_{1}_{2}'.format(template.name, chrom, start))
+    else:
+      names.append('{0}_{1}_{2}'.format(template.name, gene, offset))
+  return names
+
+
+def build_oligos(table, templates, matcher, output_file, output_format,
+                 drop_cut=True):
+  """Assemble, screen and write oligos for every guide and template.
+
+  Returns:
+    (written, cut): number of oligos written, and number with new cut sites.
+  """
+  header, formatter = OLIGO_FORMATS[output_format]
+  output_file.write(header)
+  targets = list(table['target'])
+  if not targets:
+    return 0, 0
+  guide_len = len(targets[0])
+  guides = np.frombuffer(''.join(targets).upper().encode('ascii'),
+                         dtype=np.uint8).reshape(len(targets), guide_len)
+  matchers = length_matchers(matcher)
+  written = 0
+  cut = 0
+  for template in templates:
+    names = np.array(oligo_names(table, template), dtype=object)
+    for start in range(0, len(guides), CHUNK_SIZE):
+      oligos = assemble(guides[start:start + CHUNK_SIZE], template)
+      bad = new_cut_sites(oligos, template, guide_len, matchers)
+      cut += bad.sum()
+      keep = ~bad if drop_cut else np.ones(len(oligos), dtype=bool)
+      sequences = np.ascontiguousarray(oligos[keep]).view(
+          'S{0}'.format(oligos.shape[1])).ravel()
+      output_file.write(formatter(names[start:start + CHUNK_SIZE][keep],
+                                  (x.decode('ascii') for x in sequences)))
+      written += keep.sum()
+  return written, cut
+
+
+def parse_args():
+  """Read in the arguments for the oligo builder."""
+  logging.info('Parsing command line.')
+  parser = argparse.ArgumentParser(
+      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument('--input_tsv_file', type=str, required=True,
+                      help='Selected guides, in targets file format.')
+  parser.add_argument('--output_oligo_file', type=str, default=None,
+                      help='[optional] Where to write the oligos.')
+  parser.add_argument('--output_format', type=str, default='fasta',
+                      choices=sorted(OLIGO_FORMATS),
+                      help='Output file format.')
+  parser.add_argument('--template', type=str, action='append', default=None,
+                      help='Cloning template as NAME=PREFIX:SUFFIX, with the '
+                           'guide going between PREFIX and SUFFIX (can be '
+                           'repeated).')
+  parser.add_argument('--templates_file', type=argparse.FileType('r'),
+                      default=None,
+                      help='Cloning templates, one "name<TAB>prefix<TAB>suffix" '
+                           'per line.')
+  parser.add_argument('--enzyme', type=str, action='append', default=None,
+                      help='Enzyme name or DNA site that must not appear in '
+                           'the guide or its junctions (can be repeated; '
+                           'default BsaI).')
+  parser.add_argument('--keep_cut', action='store_true', default=False,
+                      help='Write oligos with unintended cut sites anyway.')
+  args = parser.parse_args()
+  templates = list()
+  if args.template:
+    templates.extend(parse_template(x) for x in args.template)
+  if args.templates_file:
+    templates.extend(read_templates(args.templates_file))
+  if not templates:
+    parser.error('At least one --template or --templates_file is required.')
+  args.templates = templates
+  if args.enzyme is None:
+    args.enzyme = ['BsaI']
+  if args.output_oligo_file is None:
+    base, ext = os.path.splitext(args.input_tsv_file)
+    args.output_oligo_file =  base + '.oligos'
+  return args
+
+
+def main():
+  args = parse_args()
+  logging.info('Reading in targets from {0}'.format(args.input_tsv_file))
+  with library_io.open_input(args.input_tsv_file) as input_file:
+    table = target_table.from_lines(input_file)
+  matcher = cut_sites.site_matcher(args.enzyme)
+  logging.info('Writing oligos to {0}'.format(args.output_oligo_file))
+  with open(args.output_oligo_file, 'w', buffering=1 << 20) as output_file:
+    written, cut = build_oligos(table,
+                                args.templates,
+                                matcher,
+                                output_file,
+                                args.output_format,
+                                not args.keep_cut)
+  logging.info('Wrote {0} oligos; {1} had unintended cut sites{2}.'.format(
+      written, cut, '' if args.keep_cut else ' and were left out'))
+
+##############################################
+if __name__ == "__main__":
+  sys.exit(main())
@@ -7,19 +7,31 @@ import bisect
 import collections
 import contextlib
 import copy
+import hashlib
 import itertools
+import json
 import logging
+import multiprocessing
+from multiprocessing import shared_memory
 import os.path
 import re
-import shutil
 import subprocess
 import sys
 import tempfile
 
 from Bio import SeqIO
-import pysam
+import numpy as np
 
 from sgrna_target import sgrna_target
+import annotations
+import cut_sites
+import genome_io
+import genome_kmers
+import guide_features
+import library_io
+import library_index
+import off_targets
+import resources
 
 
 logging.basicConfig(level=logging.INFO,
@@ -31,6 +43,9 @@ class Error(Exception):
 class SampleError(Error):
   pass
 
+class BowtieError(Error):
+  pass
+
 
 DNA_PAIRINGS = str.maketrans('atcgATCG', 'tagcTAGC')
 
@@ -38,58 +53,177 @@ def revcomp(x):
   return x.translate(DNA_PAIRINGS)[::-1]
 
 
-def extract_targets(infile_name, pam, target_len):
-  """Generate the complete list of pam-adjacent potential targets in a genome.
+def chrom_targets(chrom, spans, pam, target_len):
+  """The pam-adjacent targets in some spans of one chromosome.
 
   Args:
-    infile_name [str]:  Name of the file containing the source genome.
+    chrom [str]:        Chromosome the spans come from.
+    spans [list]:       (start, sequence) pieces of the chromosome.
     pam [str]:          Regexp DNA pattern for the PAM sequence.
     target_len [int]:   How many bases to pull from the adjacent region.
   Returns:
-    Iterable sequence of sgrna targets.
+    List of sgrna targets, forward strand hits first within each span.
   Notes:
     Discards targets containing 'N' bases.
   """
   # TODO(jsh): Do something with "bases" other than N, ATCG.
-  logging.info('Extracting target set from {infile_name}.'.format(**vars()))
-  fasta_sequences = SeqIO.parse(infile_name, 'fasta')
-  raw_targets = dict()
-  for seq_record in fasta_sequences:
-    genome = seq_record.seq.upper()
-    chrom = seq_record.name
-    pam = pam.upper()
-    reversed_pam = revcomp(pam)
-    block = r'(.{' + str(target_len) + r'})'
-    pam_pattern = r'(?=(' + block + pam + r'))'
-    rev_pattern = r'(?=(' + reversed_pam + block + r'))'
-    for hit in re.finditer(pam_pattern, str(genome)):
+  targets = list()
+  pam = pam.upper()
+  reversed_pam = revcomp(pam)
+  block = r'(.{' + str(target_len) + r'})'
+  pam_pattern = re.compile(r'(?=(' + block + pam + r'))')
+  rev_pattern = re.compile(r'(?=(' + reversed_pam + block + r'))')
+  for lo, span in spans:
+    span = span.upper()
+    for hit in pam_pattern.finditer(span):
       if 'N' in hit.group(1):
         continue  # ...Don't target unknown genetic material.
-      t = sgrna_target(
+      targets.append(sgrna_target(
                 hit.group(2),
                 hit.group(1)[-len(pam):],
                 chrom,
-                hit.start() + 1,
-                hit.start() + 1 + target_len,
-                False)
-      name = t.id_str()
-      raw_targets[name] = t
-    for hit in re.finditer(rev_pattern, str(genome)):
+                lo + hit.start() + 1,
+                lo + hit.start() + 1 + target_len,
+                False))
+    for hit in rev_pattern.finditer(span):
       if 'N' in hit.group(1):
         continue
-      t = sgrna_target(
+      targets.append(sgrna_target(
                 revcomp(hit.group(2)),
                 revcomp(hit.group(1))[-len(pam):],
                 chrom,
-                hit.start() + 1 + len(pam),
-                hit.start() + 1 + len(pam) + target_len,
-                True)
-      name = t.id_str()
-      raw_targets[name] = t
+                lo + hit.start() + 1 + len(pam),
+                lo + hit.start() + 1 + len(pam) + target_len,
+                True))
+  return targets
+
+
+def fetched_targets(task):
+  """chrom_targets for (genome, chrom, spans, pam, target_len), fetching only
+  the spans' bases from an indexed genome."""
+  infile_name, chrom, spans, pam, target_len = task
+  return chrom_targets(chrom,
+                       genome_io.fetch_spans(infile_name, chrom, spans),
+                       pam,
+                       target_len)
+
+
+def extract_targets(infile_name, pam, target_len, windows=None, processes=1):
+  """Generate the complete list of pam-adjacent potential targets in a genome.
+
+  Indexed genomes (see genome_io.indexed) are read a chromosome at a time, in
+  processes worker processes, fetching only the windows when given.  Others
+  are read through from start to end.
+
+  Args:
+    infile_name [str]:  Name of the file containing the source genome.
+    pam [str]:          Regexp DNA pattern for the PAM sequence.
+    target_len [int]:   How many bases to pull from the adjacent region.
+    windows [dict]:     [optional] Map from chrom to a list of (start, end)
+                        spans; only targets lying wholly inside one are made.
+    processes [int]:    How many chromosomes to read at once.
+  Returns:
+    Iterable sequence of sgrna targets.
+  Notes:
+    Discards targets containing 'N' bases.
+  """
+  logging.info('Extracting target set from {infile_name}.'.format(**vars()))
+  raw_targets = dict()
+  def add(targets):
+    for t in targets:
+      raw_targets[t.id_str()] = t
+  if genome_io.indexed(infile_name):
+    tasks = list()
+    for chrom, length in genome_io.fai_lengths(infile_name).items():
+      if windows is None:
+        spans = [(0, length)]
+      else:
+        spans = windows.get(chrom, ())
+      if spans:
+        tasks.append((infile_name, chrom, spans, pam, target_len))
+    if processes > 1 and len(tasks) > 1:
+      with multiprocessing.Pool(min(processes, len(tasks))) as pool:
+        for targets in pool.imap(fetched_targets, tasks):
+          add(targets)
+    else:
+      for task in tasks:
+        add(fetched_targets(task))
+  else:
+    for chrom, genome in genome_io.records(infile_name):
+      if windows is None:
+        spans = [(0, len(genome))]
+      else:
+        spans = windows.get(chrom, ())
+      add(chrom_targets(chrom,
+                        [(lo, genome[lo:hi]) for lo, hi in spans],
+                        pam,
+                        target_len))
   logging.info('{0} raw targets.'.format(len(raw_targets)))
   return raw_targets
 
 
+def parse_region(x):
+  """(chrom, start, end) from 'CHROM:START-END' (1-based, inclusive)."""
+  try:
+    chrom, span = x.rsplit(':', 1)
+    start, end = span.replace(',', '').split('-')
+    return (chrom, int(start) - 1, int(end))
+  except ValueError:
+    logging.error('Region {x} is not of the form CHROM:START-END.'.format(
+        **vars()))
+    sys.exit(1)
+
+
+def design_windows(target_regions, genes, regions, margin, chrom_lens):
+  """Spans of the genome to design guides in.
+
+  Args:
+    target_regions [list]:  (gene, chrom, start, end, strand) annotations.
+    genes [list]:           Names of annotated genes to include.
+    regions [list]:         Extra (chrom, start, end) spans to include.
+    margin [int]:           Bases to add on each side of every span.
+    chrom_lens [dict]:      Map from chrom to sequence length.
+  Returns:
+    windows: map from chrom to a sorted list of disjoint (start, end) spans.
+  """
+  wanted = set(genes)
+  spans = [(c, s, e) for (g, c, s, e, _) in target_regions if g in wanted]
+  missing = wanted - set(x[0] for x in target_regions)
+  if missing:
+    logging.warning('{0} requested genes are not annotated: {1}'.format(
+        len(missing), ', '.join(sorted(missing))))
+  for chrom, start, end in regions:
+    if chrom not in chrom_lens:
+      logging.error('Region chromosome {chrom} is not in the genome.'.format(
+          **vars()))
+      sys.exit(1)
+    spans.append((chrom, start, end))
+  if not spans:
+    logging.error('None of the requested genes or regions were found.')
+    sys.exit(1)
+  windows = collections.defaultdict(list)
+  for chrom, start, end in sorted(spans):
+    start = max(start - margin, 0)
+    end = min(end + margin, chrom_lens[chrom])
+    merged = windows[chrom]
+    if merged and start <= merged[-1][1]:
+      merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+    else:
+      merged.append((start, end))
+  return dict(windows)
+
+
+def overlapping_regions(target_regions, windows):
+  """The annotations that overlap any window."""
+  chosen = list()
+  for x in target_regions:
+    spans = windows.get(x[1], ())
+    i = bisect.bisect_left(spans, (x[3],))
+    if i and spans[i - 1][1] > x[2]:
+      chosen.append(x)
+  return chosen
+
+
 def get_regions_from_genbank(genbank_file):
   """Extract genbank regions into a more usable form.
 
@@ -98,39 +232,7 @@ def get_regions_from_genbank(genbank_file):
   Returns:
     target_regions: list of (gene, chrom, start, end, strand) entries.
   """
-  target_regions = list()
-  for item in SeqIO.parse(genbank_file, 'genbank'):
-    chrom = item.id
-    foundthings = False
-    for ftype in ('gene', 'CDS'):
-      if foundthings:
-        continue
-      for feature in item.features:
-        if feature.type != ftype:
-          continue
-        if 'locus_tag' in feature.qualifiers:
-          name = feature.qualifiers['locus_tag'][0]
-        elif 'gene' in feature.qualifiers:
-          name = feature.qualifiers['gene'][0]
-        else:
-          logging.error('No locus_tag or gene for {feature}.'.format(**vars()))
-          template = 'BAILING OUT UNTIL MISSING FEATURE-NAME ISSUE IS RESOLVED'
-          logging.error(template.format(**vars()))
-          sys.exit(2)
-        foundthings = True
-        start = int(feature.location.start)
-        end = int(feature.location.end)
-        if feature.location.strand == 1:
-          target_regions.append((name, chrom, start, end, '+'))
-        elif feature.location.strand == -1:
-          target_regions.append((name, chrom, start, end, '-'))
-        else:
-          # If we don't know what strand it's on, just claim all targets.
-          target_regions.append((name, chrom, start, end, '+'))
-          target_regions.append((name, chrom, start, end, '-'))
-    logging.info(
-        'Found {0} target regions in genbank file.'.format(len(target_regions)))
-  return target_regions
+  return annotations.genbank_regions(genbank_file)
 
 
 def parse_target_regions(target_regions_file):
@@ -141,27 +243,61 @@ def parse_target_regions(target_regions_file):
   Returns:
     target_regions: list of (gene, chrom, start, end, strand) entries.
   """
-  logging.info('Parsing target region file.')
+  return annotations.table_regions(target_regions_file)
+
+
+def input_digest(file_names):
+  """Hex SHA-1 of the contents of the named files, in order."""
+  digest = hashlib.sha1()
+  for name in file_names:
+    with open(name, 'rb') as handle:
+      for block in iter(lambda: handle.read(1 << 20), b''):
+        digest.update(block)
+    digest.update(b'\0')
+  return digest.hexdigest()
+
+
+def prepare_genome(genbank_file_names, work_dir):
+  """Derive the FASTA genome and gene regions from GenBank inputs.
+
+  Both are named after a hash of the inputs' contents, so they are reused for
+  as long as the inputs don't change and the regions still load (they are
+  also signed with annotations.CACHE_VERSION).  Otherwise the inputs are
+  parsed once, writing the sequences as FASTA and collecting regions on the
+  way.
+
+  Returns:
+    (fasta_file_name, target_regions)
+  """
+  digest = input_digest(genbank_file_names)
+  signature = '|'.join([annotations.CACHE_VERSION, digest])
+  first = os.path.splitext(os.path.basename(genbank_file_names[0]))[0]
+  base = os.path.join(work_dir, '{0}.{1}'.format(first, digest[:16]))
+  fasta_file_name = base + '.fasta'
+  regions_file_name = base + annotations.CACHE_SUFFIX
+  if os.path.exists(fasta_file_name):
+    target_regions = annotations.load_cached_regions(regions_file_name,
+                                                     signature)
+    if target_regions is not None:
+      logging.info('Reusing {fasta_file_name}.'.format(**vars()))
+      return fasta_file_name, target_regions
+  logging.info('Writing {fasta_file_name}.'.format(**vars()))
+  if not os.path.isdir(work_dir):
+    os.makedirs(work_dir)
   target_regions = list()
-  for x in open(target_regions_file):
-    if x.startswith('#'):
-      continue
-    parts = x.strip().split('\t')
-    try:
-      (name,chrom,start,end,strand) = parts
-    except ValueError:
-      trf = target_regions_file
-      logging.error('Could not parse from {trf}: {x}'.format(**vars()))
-      sys.exit(1)
-    try:
-      target_regions.append((name, chrom, int(start), int(end), strand))
-    except ValueError:
-      x = x.strip()
-      logging.warning('Could not fully parse: {x}'.format(**vars()))
-      continue
-  logging.info(
-      'Found {0} target regions in region file.'.format(len(target_regions)))
-  return target_regions
+  def records():
+    for name in genbank_file_names:
+      for record in SeqIO.parse(name, 'genbank'):
+        target_regions.extend(annotations.record_regions(record))
+        yield record
+  # Write under temporary names so an interrupted run is never reused.
+  partial_fasta = fasta_file_name + '.partial'
+  partial_regions = base + '.partial' + annotations.CACHE_SUFFIX
+  SeqIO.write(records(), partial_fasta, 'fasta')
+  annotations.save_regions(partial_regions, signature, target_regions)
+  os.replace(partial_regions, regions_file_name)
+  os.replace(partial_fasta, fasta_file_name)
+  return fasta_file_name, target_regions
 
 
 def chrom_lengths(fasta_file_name):
@@ -171,49 +307,156 @@ def chrom_lengths(fasta_file_name):
     fasta_file_name [str]:  Name of the file containing the source genome.
   Returns:
     chrom_lens: dict mapping fasta entry name (chrom) to sequence length.
+  Notes:
+    Read from the genome's .fai index, without touching the sequence, when
+    it has one.
   """
-  logging.info('Parsing fasta file to check chromosome sizes.')
-  chrom_lens = dict()
-  fasta_sequences = SeqIO.parse(fasta_file_name, 'fasta')
-  for seq_record in fasta_sequences:
-    chrom_lens[seq_record.name] = len(seq_record.seq)
-  return chrom_lens
+  return genome_io.chrom_lengths(fasta_file_name)
+
+
+# Thresholds passed to bowtie -e, from most to least stringent.
+SPECIFICITY_TIERS = (39, 30, 20, 11, 1)
 
 
-def ascribe_specificity(targets, genome_fasta_name, sam_copy):
-  """Set up bowtie stuff and repeatedly call mark_specificity_tier."""
-  # Is there a bowtie index yet?
+def build_bowtie_index(genome_fasta_name):
+  """Build a bowtie index next to the genome unless one is already there."""
   if not os.path.exists(genome_fasta_name + '.1.ebwt'):
     command = ['bowtie-build', genome_fasta_name, genome_fasta_name]
     build_job = subprocess.Popen(command)
     if build_job.wait() != 0:
       logging.fatal('Failed to build bowtie index')
       sys.exit(build_job.returncode)
-  # Generate faked FASTQ file
-  # phredString = '++++++++44444=======!4I'  # 33333333222221111111NGG
-  phredString = 'I4!=======44444++++++++'  # 33333333222221111111NGG
-  _, fastq_name = tempfile.mkstemp()
-  for threshold in (39,30,20,11,1):
-    fastq_tempfile, fastq_name = tempfile.mkstemp()
-    with contextlib.closing(os.fdopen(fastq_tempfile, 'w')) as fastq_file:
-      wrote_anything = False
-      for name, t in targets.items():
-        if t.specificity > 0:
-          continue
-        fullseq = revcomp(t.sequence_with_pam())
-        fastq_file.write(
-            '@{name}\n{fullseq}\n+\n{phredString}\n'.format(**vars()))
-        wrote_anything = True
-    if wrote_anything:
-      mark_specificity_threshold(
-          targets, fastq_name, genome_fasta_name, threshold, sam_copy)
-
-
-def mark_specificity_threshold(
-        targets, fastq_name, genome_name, threshold, sam_copy):
-  # prep output files
-  (specific_tempfile, specific_name) = tempfile.mkstemp()
-  # Filter based on specificity
+
+
+def ascribe_specificity(targets, genome_fasta_name, sam_copy, report=None,
+                        controller=None):
+  """Set up bowtie stuff and repeatedly call mark_specificity_tier.
+
+  Since the result depends only on the sequence, each distinct protospacer (with
+  PAM) is aligned once and its tier is copied to every target that shares it.
+  If an off_targets.off_target_report is given, it ends up holding the
+  alignments of every non-unique sequence, keyed by sequence.  bowtie is run
+  within the budget of controller (a resources.resource_controller), if given.
+  """
+  by_sequence = collections.defaultdict(list)
+  for name, t in targets.items():
+    if t.specificity > 0:
+      continue
+    by_sequence[t.sequence_with_pam()].append(t)
+  logging.info('Scoring {0} unique protospacers.'.format(len(by_sequence)))
+  sequences = dict((seq, seq) for seq in by_sequence)
+  # Every sequence came from this genome, so the uniqueness index applies.
+  uniqueness = genome_kmers.uniqueness_index(genome_fasta_name,
+                                             PHRED_STRING,
+                                             SPECIFICITY_TIERS[0])
+  tiers = specificity_tiers(
+      sequences, genome_fasta_name, sam_copy, uniqueness, report, controller)
+  for seq, group in by_sequence.items():
+    for t in group:
+      t.specificity = tiers[seq]
+
+
+# Qualities for the faked FASTQ reads; bowtie -e sums these over mismatches.
+# phredString = '++++++++44444=======!4I'  # 33333333222221111111NGG
+PHRED_STRING = 'I4!=======44444++++++++'  # 33333333222221111111NGG
+
+
+def write_fake_fastq(sequences, skip=()):
+  """Write sequences (with trailing PAM) as faked FASTQ reads.
+
+  Reads are the reverse complement, so that the PAM is at the start of the read
+  and the PAM-proximal bases fall in the bowtie seed.
+
+  Args:
+    sequences [dict]:  Maps read name to DNA sequence with trailing PAM.
+    skip [container]:  Read names to leave out.
+  Returns:
+    (fastq_name, wrote_anything): name of the temporary file, and whether any
+      reads were written to it.
+  """
+  phredString = PHRED_STRING
+  fastq_tempfile, fastq_name = tempfile.mkstemp()
+  with contextlib.closing(os.fdopen(fastq_tempfile, 'w')) as fastq_file:
+    wrote_anything = False
+    for name, seq in sequences.items():
+      if name in skip:
+        continue
+      fullseq = revcomp(seq)
+      fastq_file.write(
+          '@{name}\n{fullseq}\n+\n{phredString}\n'.format(**vars()))
+      wrote_anything = True
+  return fastq_name, wrote_anything
+
+
+def write_indexed_fastq(reads, rows):
+  """Write faked FASTQ reads named by their row number.
+
+  Args:
+    reads [list]:  Read sequences (already reverse complemented).
+    rows [array]:  Which reads to write.
+  Returns:
+    fastq_name: name of the temporary file.
+  """
+  phredString = PHRED_STRING
+  fastq_tempfile, fastq_name = tempfile.mkstemp()
+  with contextlib.closing(os.fdopen(fastq_tempfile, 'w')) as fastq_file:
+    fastq_file.writelines('@{0}\n{1}\n+\n{2}\n'.format(i, reads[i], phredString)
+                          for i in rows)
+  return fastq_name
+
+
+def specificity_tiers(sequences, genome_fasta_name, sam_copy=None,
+                      uniqueness=None, report=None, controller=None):
+  """Score sequences for specificity against a genome.
+
+  Reads are named by their position in the sequence list, so tiers live in an
+  array and each threshold's results are applied in one update.  Sequences a
+  uniqueness index proves unique get the top tier without being aligned.
+
+  Args:
+    sequences [dict]:         Maps read name to DNA sequence with trailing PAM.
+    genome_fasta_name [str]:  Genome to align against (index built if needed).
+    sam_copy [str]:           [optional] Where to copy the final SAM file.
+    uniqueness:               [optional] genome_kmers.uniqueness_index for the
+                              genome; only usable if every sequence occurs in
+                              it.
+    report:                   [optional] off_targets.off_target_report to
+                              collect the first pass's alignments in.
+    controller:               [optional] resources.resource_controller that
+                              shards and schedules the bowtie runs.
+  Returns:
+    tiers: dict mapping each read name to its specificity tier (0 if none).
+  """
+  build_bowtie_index(genome_fasta_name)
+  if controller is None:
+    controller = resources.resource_controller()
+  names = list(sequences)
+  reads = [revcomp(sequences[x]) for x in names]
+  tiers = np.zeros(len(names), dtype=np.int64)
+  if uniqueness is not None:
+    proven = uniqueness.unique([sequences[x].upper() for x in names])
+    tiers[proven] = SPECIFICITY_TIERS[0]
+    logging.info('{0} of {1} sequences proven unique without alignment.'.format(
+        proven.sum(), len(names)))
+  for i, threshold in enumerate(SPECIFICITY_TIERS):
+    rows = np.flatnonzero(tiers == 0)
+    if len(rows):
+      # Later passes are stricter, so the first one finds every off-target.
+      mark_specificity_threshold(tiers, reads, rows, genome_fasta_name,
+                                 threshold, sam_copy, report if i == 0 else None,
+                                 controller)
+  if report is not None:
+    report.rename(names)
+  return dict(zip(names, tiers.tolist()))
+
+
+def bowtie_command(fastq_name, genome_name, threshold, output_name,
+                   report_k=None, threads=6, chunkmbs=256):
+  """Command line for aligning faked reads at a given -e threshold.
+
+  With report_k, the best report_k alignments of every read are reported
+  instead of only those of unique reads.
+  """
   command = ['bowtie']
   command.extend(['-S'])  # output SAM
   command.extend(['--nomaqround'])  # don't do rounding
@@ -221,109 +464,424 @@ def mark_specificity_threshold(
   command.extend(['-a'])  # report each non-specific hit
   command.extend(['--best'])  # judge the *closest* non-specific match
   command.extend(['--tryhard'])  # judge the *closest* non-specific match
-  command.extend(['--chunkmbs', 256])  # memory setting for --best flag
-  command.extend(['-p', 6])  # how many processors to use
+  command.extend(['--chunkmbs', chunkmbs])  # memory setting for --best flag
+  command.extend(['-p', threads])  # how many processors to use
   command.extend(['-n', 3])  # allowable mismatches in seed
   command.extend(['-l', 15])  # size of seed
   command.extend(['-e', threshold])  # dissimilarity sum before not non-specific hit
   command.extend(['-m', 1])  # discard reads with >1 alignment
+  if report_k:
+    command.remove('-a')
+    command[-2:] = ['-k', report_k]  # report the best few of every read
   command.append(genome_name)  # index base, built above
   command.append(fastq_name)  # faked fastq temp file
-  command.append(specific_name)  # unique hits
-  command = [str(x) for x in command]
-  logging.info('Marking specificity threshold {threshold}'.format(**locals()))
+  command.append(output_name)  # unique hits
+  return [str(x) for x in command]
+
+
+def run_bowtie(command):
   logging.info(' '.join(command))
   bowtie_job = subprocess.Popen(command)
   # Check for problems
   if bowtie_job.wait() != 0:
     sys.exit(bowtie_job.returncode)
+
+
+def aligned_read_ids(sam_name):
+  """Integer names of the reads that aligned, from a SAM file.
+
+  Only QNAME and FLAG are looked at; flag 4 means unaligned.
+  """
+  with open(sam_name) as sam_file:
+    records = (x.split('\t', 2) for x in sam_file if not x.startswith('@'))
+    ids = [int(qname) for qname, flag, _ in records if not int(flag) & 4]
+  return np.array(ids, dtype=np.int64)
+
+
+# Bytes held per read while a shard's SAM is read back, without and with the
+# alignments of an off-target report (per alignment).
+SAM_BYTES_PER_READ = 100
+REPORT_BYTES_PER_ALIGNMENT = 1000
+
+
+class bowtie_shard(object):
+  """Some faked reads, being aligned by a bowtie process of their own."""
+  def __init__(self, reads, rows, genome_name, threshold, plan, report_k):
+    self.rows = rows
+    self.fastq_name = write_indexed_fastq(reads, rows)
+    sam_tempfile, self.sam_name = tempfile.mkstemp()
+    os.close(sam_tempfile)
+    command = bowtie_command(self.fastq_name, genome_name, threshold,
+                             self.sam_name, report_k, plan.threads,
+                             plan.chunkmbs)
+    logging.info(' '.join(command))
+    self.job = subprocess.Popen(command)
+
+  def discard(self):
+    for name in (self.fastq_name, self.sam_name):
+      if os.path.exists(name):
+        os.remove(name)
+
+
+def copy_sam(sam_names, destination):
+  """Concatenate SAM files, keeping only the first one's header."""
+  with open(destination, 'w') as out_file:
+    for i, name in enumerate(sam_names):
+      with open(name) as sam_file:
+        out_file.writelines(x for x in sam_file
+                            if i == 0 or not x.startswith('@'))
+
+
+def mark_specificity_threshold(tiers, reads, rows, genome_name, threshold,
+                               sam_copy, report=None, controller=None):
+  """Raise tiers[i] to threshold for each read i in rows aligning uniquely.
+
+  The reads are aligned in shards, as many at once as the controller (a
+  resources.resource_controller) allows.  With a report, the alignments of
+  the other reads are kept in it.
+  """
+  if controller is None:
+    controller = resources.resource_controller()
+  report_k = report.alignments_wanted() if report is not None else None
+  if report is None:
+    bytes_per_read = SAM_BYTES_PER_READ
+  else:
+    bytes_per_read = REPORT_BYTES_PER_ALIGNMENT * report_k
+  plan = controller.plan('threshold {0}'.format(threshold),
+                         genome_name,
+                         len(rows),
+                         bytes_per_read)
+  logging.info('Marking specificity threshold {threshold}'.format(**locals()))
+  sam_names = list()
+  def start(shard_rows):
+    return bowtie_shard(reads, shard_rows, genome_name, threshold, plan,
+                        report_k)
+  def finish(shard):
+    # Check for problems
+    if shard.job.returncode != 0:
+      raise BowtieError('bowtie exited with status {0}.'.format(
+          shard.job.returncode))
+    if report is None:
+      aligned = aligned_read_ids(shard.sam_name)
+    else:
+      aligned = report.read_sam(shard.sam_name)
+    tiers[aligned] = np.maximum(tiers[aligned], threshold)
+    os.remove(shard.fastq_name)
+    if sam_copy:
+      sam_names.append(shard.sam_name)
+    else:
+      os.remove(shard.sam_name)
+  try:
+    controller.run(plan, rows, start, finish)
+  except BaseException:
+    for name in sam_names:
+      os.remove(name)
+    raise
   if sam_copy:
-    shutil.copyfile(specific_name, sam_copy)
-  aligned_reads = pysam.Samfile(specific_name)
-  for x in aligned_reads:
-    # flag 4 means unaligned, so skip those
-    if not x.flag & 4:
-      t = targets[x.qname]
-      if t.specificity < threshold:
-        t.specificity = threshold
-  os.close(specific_tempfile)
+    copy_sam(sam_names, sam_copy)
+    for name in sam_names:
+      os.remove(name)
+
+
+def unaligned_sequences(sequences, genome_fasta_name, threshold):
+  """Find the sequences with no alignment at all within the threshold.
+
+  Args:
+    sequences [dict]:         Maps read name to DNA sequence with trailing PAM.
+    genome_fasta_name [str]:  Genome to align against (index built if needed).
+    threshold [int]:          bowtie -e threshold.
+  Returns:
+    names: set of read names that did not align anywhere.
+  """
+  build_bowtie_index(genome_fasta_name)
+  fastq_name, wrote_anything = write_fake_fastq(sequences)
+  names = set()
+  if wrote_anything:
+    outputs = [tempfile.mkstemp() for _ in range(3)]
+    (_, sam_name), (_, un_name), (_, max_name) = outputs
+    command = bowtie_command(fastq_name, genome_fasta_name, threshold, sam_name)
+    # Reads failing -m go to --max, so --un only gets reads with no hits.
+    command[-3:-3] = ['--un', un_name, '--max', max_name]
+    run_bowtie(command)
+    with open(un_name) as un_file:
+      for line in itertools.islice(un_file, 0, None, 4):
+        names.add(line[1:].rstrip('\n'))
+    for fd, name in outputs:
+      os.close(fd)
+      os.remove(name)
+  os.remove(fastq_name)
+  return names
+
+
+def unique_alignments(sequences, genome_fasta_name, threshold, pam_len=3):
+  """Find where sequences align, for those aligning exactly once.
+
+  Args:
+    sequences [dict]:         Maps read name to DNA sequence with trailing PAM.
+    genome_fasta_name [str]:  Genome to align against (index built if needed).
+    threshold [int]:          bowtie -e threshold.
+    pam_len [int]:            Length of the trailing PAM.
+  Returns:
+    hits: dict mapping the name of each read with exactly one alignment within
+      the threshold to that off_targets.alignment.
+  """
+  build_bowtie_index(genome_fasta_name)
+  fastq_name, wrote_anything = write_fake_fastq(sequences)
+  hits = dict()
+  if wrote_anything:
+    sam_tempfile, sam_name = tempfile.mkstemp()
+    os.close(sam_tempfile)
+    run_bowtie(bowtie_command(fastq_name, genome_fasta_name, threshold,
+                              sam_name))
+    with open(sam_name) as sam_file:
+      for x in sam_file:
+        if x.startswith('@'):
+          continue
+        fields = x.rstrip('\n').split('\t')
+        if int(fields[1]) & 4:
+          continue
+        hits[fields[0]] = off_targets.parse_alignment(
+            fields, len(sequences[fields[0]]), pam_len)
+    os.remove(sam_name)
+  os.remove(fastq_name)
+  return hits
+
+
+def genome_label(genome_file_name):
+  """Short name for a genome, used to label its output columns."""
+  base = os.path.basename(genome_file_name)
+  for suffix in library_io.OUTPUT_SUFFIXES:
+    if base.endswith(suffix):
+      base = base[:-len(suffix)]
+      break
+  return os.path.splitext(base)[0]
+
+
+def score_background_genomes(targets, background_fasta_names, pam, target_len,
+                             controller=None):
+  """Score targets against other genomes, e.g. the rest of a strain panel.
+
+  Each unique protospacer (with PAM) is aligned once per background genome, no
+  matter how many targets share it.
+
+  Args:
+    targets: the targets to annotate (modified in place).
+    background_fasta_names [list]:  FASTA files of the other genomes.
+    pam [str]:          Regexp DNA pattern for the PAM sequence.
+    target_len [int]:   How many bases to pull from the adjacent region.
+    controller:         [optional] resources.resource_controller for bowtie.
+  Returns:
+    extra_fields: names of the output columns added to each target's extras,
+      one 'specificity_<genome>' column per background genome followed by a
+      'strain_mask' column, in which bit i is set if the protospacer and PAM
+      occur exactly in background genome i.
+  """
+  by_sequence = collections.defaultdict(list)
+  for name, t in targets.items():
+    by_sequence[t.sequence_with_pam()].append(t)
+  logging.info('{0} unique protospacers among {1} targets.'.format(
+      len(by_sequence), len(targets)))
+  sequences = dict((seq, seq) for seq in by_sequence)
+  masks = collections.defaultdict(int)
+  extra_fields = list()
+  for i, fasta_name in enumerate(background_fasta_names):
+    column = 'specificity_' + genome_label(fasta_name)
+    extra_fields.append(column)
+    logging.info('Scoring against background genome {fasta_name}.'.format(
+        **vars()))
+    present = set(x.sequence_with_pam()
+                  for x in extract_targets(fasta_name, pam, target_len).values())
+    tiers = specificity_tiers(sequences, fasta_name, controller=controller)
+    for seq, group in by_sequence.items():
+      if seq in present:
+        masks[seq] |= 1 << i
+      for t in group:
+        t.extras[column] = tiers[seq]
+  extra_fields.append('strain_mask')
+  for seq, group in by_sequence.items():
+    for t in group:
+      t.extras['strain_mask'] = masks[seq]
+  return extra_fields
+
+
+def region_bounds(starts, ends, gene_starts, gene_ends, allow_partial_overlap):
+  """Slice of a chromosome's sorted targets falling in each of its regions.
+
+  Reproduces the moving-window walk over regions in order (neither end of the
+  window ever moves back) as a running maximum over binary searches.  That
+  needs ends sorted as well as starts, as they are when every target has the
+  same length; otherwise the walk is done step by step.
+
+  Returns:
+    (front, back): int arrays; region i gets sorted targets front[i]:back[i].
+  """
+  if len(starts) < 2 or (np.diff(ends) >= 0).all():
+    if allow_partial_overlap:
+      back = np.searchsorted(starts, gene_ends, 'left')
+      front = np.searchsorted(ends, gene_starts, 'right')
+    else:
+      back = np.searchsorted(ends, gene_ends, 'right')
+      front = np.searchsorted(starts, gene_starts, 'left')
+    return np.maximum.accumulate(front), np.maximum.accumulate(back)
+  front = np.zeros(len(gene_starts), dtype=np.int64)
+  back = np.zeros(len(gene_starts), dtype=np.int64)
+  f = b = 0
+  for i, (gene_start, gene_end) in enumerate(zip(gene_starts, gene_ends)):
+    if allow_partial_overlap:
+      while b < len(starts) and starts[b] < gene_end:
+        b += 1
+      while f < len(starts) and ends[f] <= gene_start:
+        f += 1
+    else:
+      while b < len(starts) and ends[b] <= gene_end:
+        b += 1
+      while f < len(starts) and starts[f] < gene_start:
+        f += 1
+    front[i], back[i] = f, b
+  return front, back
+
+
+# Shared memory blocks attached in a labelling worker, by name.
+_LABEL_BLOCKS = dict()
+
+def _shared_array(name, shape, dtype):
+  if name not in _LABEL_BLOCKS:
+    _LABEL_BLOCKS[name] = shared_memory.SharedMemory(name=name)
+  return np.ndarray(shape, dtype=dtype, buffer=_LABEL_BLOCKS[name].buf)
+
+
+def label_chromosome(task):
+  """Label the targets of one chromosome.
+
+  Args:
+    task: (arrays, lo, hi, regions, allow_partial_overlap), where arrays maps
+      'starts', 'ends', 'reverse' and 'order' to (shared memory name, shape,
+      dtype) of the targets sorted by (chrom, start, end), lo:hi is this
+      chromosome's part of them, and regions is (ids, starts, ends, reverse)
+      for its regions in order.
+  Returns:
+    (region_ids, target_ids, offsets, sense): one entry per labelled target.
+  """
+  arrays, lo, hi, regions, allow_partial_overlap = task
+  starts, ends, reverse, order = [_shared_array(*arrays[x])[lo:hi]
+                                  for x in ('starts', 'ends', 'reverse', 'order')]
+  region_ids, gene_starts, gene_ends, gene_reverse = regions
+  front, back = region_bounds(
+      starts, ends, gene_starts, gene_ends, allow_partial_overlap)
+  counts = np.maximum(back - front, 0)
+  which = np.repeat(np.arange(len(counts)), counts)
+  rows = (np.repeat(front - np.cumsum(counts) + counts, counts) +
+          np.arange(counts.sum()))
+  offsets = np.where(gene_reverse[which],
+                     gene_ends[which] - ends[rows],
+                     starts[rows] - gene_starts[which])
+  sense = gene_reverse[which] == reverse[rows]
+  return region_ids[which], order[rows], offsets, sense
 
 
 def label_targets(targets,
                   target_regions,
                   chrom_lens,
-                  allow_partial_overlap):
+                  allow_partial_overlap,
+                  processes=1):
   """Annotate targets according to overlaps with gff entries.
+
+  Works as a generator, so annotated targets can be written out as they are
+  made: first a labelled copy of each target for every region it falls in (in
+  region order), then every target no region claimed (in target order).
+  Unclaimed targets are not copied, to save copying the library.
+  Chromosomes are labelled independently, in a pool of processes sharing the
+  target coordinates, and merged back into region order.
   Args:
     targets: the targets to annotate.
     target_regions: the target regions for which to produce annotations
     chrom_lens: mapping from chrom name to sequence length.
     allow_partial_overlap: Include targets which only partially overlap region.
-  Returns:
-    anno_targets: list of targets with added region annotations
+    processes: how many processes to label chromosomes in.
+  Yields:
+    sgrna_targets, one at a time.  Unclaimed ones are the caller's own objects
+    from targets, so they must not be changed by whoever consumes them.
   """
   logging.info(
       'Labeling targets based on region file.'.format(**vars()))
-  anno_targets = list()
-  found = set()
-  counter = 0
+  all_targets = list(targets.values())
+  chrom_ids = dict()
+  columns = dict(
+      chrom=np.array([chrom_ids.setdefault(x.chrom, len(chrom_ids))
+                      for x in all_targets], dtype=np.int64),
+      starts=np.array([x.start for x in all_targets], dtype=np.int64),
+      ends=np.array([x.end for x in all_targets], dtype=np.int64),
+      reverse=np.array([x.reverse for x in all_targets], dtype=bool))
   # Organize targets by chromosome and then start location.
-  per_chrom_sorted_targets = collections.defaultdict(list)
-  for name, x in targets.items():
-    per_chrom_sorted_targets[x.chrom].append(x)
-  for x in per_chrom_sorted_targets:
-    per_chrom_sorted_targets[x].sort(key=lambda x:(x.start, x.end))
-  per_chrom_bounds = dict()
-  for chrom in chrom_lens:
-    per_chrom_bounds[chrom] = (0,0) # Check out the bound variables
-  for i, x in enumerate(target_regions):
-    (gene, chrom, gene_start, gene_end, gene_strand) = x
-    if i % 100 is 0:
-      logging.info('Examining gene {i} [{gene}].'.format(**vars()))
-    front, back = per_chrom_bounds[chrom]
-    reverse_strand_gene = gene_strand == '-'
+  order = np.lexsort((columns['ends'], columns['starts'], columns['chrom']))
+  bounds = np.searchsorted(columns['chrom'][order],
+                           np.arange(len(chrom_ids) + 1))
+  sorted_columns = dict(starts=columns['starts'][order],
+                        ends=columns['ends'][order],
+                        reverse=columns['reverse'][order],
+                        order=order.astype(np.int64))
+  per_chrom_regions = collections.defaultdict(list)
+  for i, (gene, chrom, gene_start, gene_end, gene_strand) in enumerate(
+      target_regions):
     if gene_start >= chrom_lens[chrom]:
       continue
-    chrom_targets = per_chrom_sorted_targets[chrom]
-    # TODO(jsh): If a gene is contained within another gene, we might double
-    # label outer-gene guides that are later than the end of the inner gene
-    if allow_partial_overlap:
-      # Shift back index until target.start >= gene_end
-      while (back < len(chrom_targets) and
-             chrom_targets[back].start < gene_end):
-        back += 1
-      # Shift front index until target.end > gene_start
-      while (front < len(chrom_targets) and
-             chrom_targets[front].end <= gene_start):
-        front += 1
+    per_chrom_regions[chrom].append((i, gene_start, gene_end, gene_strand == '-'))
+  blocks = list()
+  try:
+    arrays = dict()
+    for name, values in sorted_columns.items():
+      block = shared_memory.SharedMemory(create=True,
+                                         size=max(values.nbytes, 1))
+      blocks.append(block)
+      np.ndarray(values.shape, values.dtype, buffer=block.buf)[:] = values
+      arrays[name] = (block.name, values.shape, values.dtype)
+    tasks = list()
+    for chrom, regions in per_chrom_regions.items():
+      if chrom not in chrom_ids:
+        lo = hi = 0
+      else:
+        lo, hi = bounds[chrom_ids[chrom]], bounds[chrom_ids[chrom] + 1]
+      regions = [np.array(x) for x in zip(*regions)]
+      regions[0] = regions[0].astype(np.int64)
+      regions[1] = regions[1].astype(np.int64)
+      regions[2] = regions[2].astype(np.int64)
+      regions[3] = regions[3].astype(bool)
+      tasks.append((arrays, lo, hi, regions, allow_partial_overlap))
+    logging.info('Labeling {0} chromosomes in {1} processes.'.format(
+        len(tasks), processes))
+    if processes > 1 and len(tasks) > 1:
+      with multiprocessing.Pool(processes) as pool:
+        results = pool.map(label_chromosome, tasks)
     else:
-      # Shift back index until target.end > gene_end
-      while (back < len(chrom_targets) and
-             chrom_targets[back].end <= gene_end):
-        back += 1
-      # Shift front index until target.start >= gene_start
-      while (front < len(chrom_targets) and
-             chrom_targets[front].start < gene_start):
-        front += 1
-    overlap = chrom_targets[front:back]
-    per_chrom_bounds[chrom] = (front, back) # Return bound vars to shelf
-    if len(overlap) == 0:
+      results = [label_chromosome(x) for x in tasks]
+  finally:
+    for name in list(_LABEL_BLOCKS):
+      _LABEL_BLOCKS.pop(name).close()
+    for block in blocks:
+      block.close()
+      block.unlink()
+  if results:
+    region_ids, target_ids, offsets, sense = [np.concatenate(x)
+                                              for x in zip(*results)]
+  else:
+    region_ids = target_ids = offsets = sense = np.zeros(0, dtype=np.int64)
+  merged = np.argsort(region_ids, kind='stable')
+  labelled = np.bincount(region_ids, minlength=len(target_regions))
+  for i in np.flatnonzero(labelled == 0):
+    gene, chrom = target_regions[i][:2]
+    if target_regions[i][2] < chrom_lens[chrom]:
       logging.warn('No overlapping targets for gene {gene}.'.format(**vars()))
-    for target in overlap:
-      found.add(target.id_str())
-      if reverse_strand_gene:
-        offset = gene_end - target.end
-      else:
-        offset = target.start - gene_start
-      returnable = copy.deepcopy(target)
-      returnable.gene = gene
-      returnable.offset = offset
-      returnable.sense_strand = (reverse_strand_gene == target.reverse)
-      anno_targets.append(returnable)
-  for name, target in targets.items():
-    if name not in found:
-      anno_targets.append(copy.deepcopy(target))
-  return anno_targets
+  found = np.zeros(len(all_targets), dtype=bool)
+  found[target_ids] = True
+  for k in merged:
+    # Shallow: only the scalar labels differ from the original.
+    returnable = copy.copy(all_targets[target_ids[k]])
+    returnable.gene = target_regions[region_ids[k]][0]
+    returnable.offset = int(offsets[k])
+    returnable.sense_strand = bool(sense[k])
+    yield returnable
+  for i in np.flatnonzero(~found):
+    yield all_targets[i]
 
 
 def parse_args():
@@ -335,65 +893,233 @@ def parse_args():
       '--input_genbank_genome_name', type=str,
       action='append',
       help='Location of genome file in GenBank format (can be repeated).',
-      required=True)
+      default=None)
+  parser.add_argument(
+      '--input_fasta_genome_name', type=str, default=None,
+      help=('Location of genome file in FASTA format, instead of GenBank '
+            '(may be bgzip compressed; regions come from --annotation_file).'))
   parser.add_argument(
       '--sam_copy', type=str,
       help='[optional] Copy sam tmpfile from (final) bowtie run to here.',
       default=None)
+  parser.add_argument(
+      '--off_target_report', type=str, default=None,
+      help=('[optional] Write the closest off-target loci of each guide here '
+            '(TSV), from the first specificity pass.'))
+  parser.add_argument(
+      '--off_target_top_k', type=int, default=5,
+      help='Off-target loci to list per guide.')
+  parser.add_argument(
+      '--off_target_below_tier', type=int, default=40,
+      help='Only list off-targets for guides with specificity below this.')
+  parser.add_argument(
+      '--background_genome', type=str,
+      action='append', default=None,
+      help=('[optional] FASTA file of another genome (e.g. another strain in '
+            'the panel) to score guides against (can be repeated).'))
+  parser.add_argument(
+      '--guide_features', action='store_true', default=False,
+      help=('Add GC fraction, longest homopolymer, poly-T and cut site '
+            'columns to the output.'))
+  parser.add_argument(
+      '--restriction_site', type=str, action='append', default=None,
+      help=('Enzyme name (e.g. BsaI) or DNA site for the cut_site feature '
+            '(can be repeated).'))
+  parser.add_argument(
+      '--oligo_context', type=str, action='append', default=None,
+      help=('FRONT:BACK flanks placed around each guide when looking for cut '
+            'sites, e.g. TATGT:GTTTA (can be repeated).'))
+  parser.add_argument(
+      '--cut_site_filter', action='store_true', default=False,
+      help=('Drop targets that would put a --restriction_site into any '
+            '--oligo_context, before scoring them.'))
+  parser.add_argument(
+      '--annotation_file', type=str, default=None,
+      help=('[optional] GenBank, GFF3, GTF or region TSV file to take gene '
+            'regions from, instead of the GenBank genome.'))
+  parser.add_argument(
+      '--annotation_feature', type=str, action='append', default=None,
+      help=('GFF3/GTF feature type to use as a region (can be repeated; '
+            'default gene).'))
+  parser.add_argument(
+      '--genes', type=str, action='append', default=None,
+      help=('[optional] Only design guides for these genes (comma separated; '
+            'can be repeated).'))
+  parser.add_argument(
+      '--regions', type=str, action='append', default=None,
+      help=('[optional] Only design guides in these regions, as '
+            'CHROM:START-END, 1-based and inclusive (can be repeated).'))
+  parser.add_argument(
+      '--region_margin', type=int, default=100,
+      help='Bases around each requested gene or region to design in as well.')
+  parser.add_argument(
+      '--work_dir', type=str, default=None,
+      help=('[optional] Where to keep the derived FASTA genome, regions and '
+            'bowtie index (default: next to the first GenBank file).  FASTA '
+            'genomes are indexed where they are.'))
   parser.add_argument(
       '--tsv_output_file', type=str,
-      help='[optional] Specified name for tab-separated output file.',
+      help=('[optional] Specified name for tab-separated output file '
+            '(compressed if it ends in .gz, .bgz or .zst).'),
       default=None)
   parser.add_argument(
       '--only_include_fully_overlapping', action='store_false',
       dest='allow_partial_overlap', default=True,
       help='Only label targets which are fully contained in the region.')
+  parser.add_argument(
+      '--max_memory', type=resources.parse_size, default=None,
+      help=('[optional] Memory budget for this run and its bowtie processes, '
+            'e.g. 16G; alignment is sharded to fit.'))
+  parser.add_argument(
+      '--max_cores', type=int, default=resources.available_cores(),
+      help='Cores to share among bowtie processes.')
+  parser.add_argument(
+      '--run_metrics', type=str, default=None,
+      help=('[optional] Write how alignment was sharded and scheduled, and '
+            'the memory it used, here (JSON).'))
+  parser.add_argument(
+      '--processes', type=int, default=1,
+      help=('How many processes to extract targets (from indexed genomes) '
+            'and label chromosomes in.'))
   args = parser.parse_args()
   # TODO(jsh): add code to handle alternate PAMs and/or guide lengths/shapes
   args.pam = '.gg'
   # TODO(jsh): add code to handle alternate PAMs and/or guide lengths/shapes
   args.target_len = 20
-  fastafile = None
-  parts = os.path.splitext(args.input_genbank_genome_name[0])
-  mergename = parts[0] + '.merged' + parts[1]
-  with open(mergename, 'w') as outhandle:
-    files = args.input_genbank_genome_name
-    chunks = itertools.chain(*[SeqIO.parse(x, 'genbank') for x in files])
-    SeqIO.write(chunks, outhandle, 'genbank')
-  fastafile = mergename + '.fasta'
-  SeqIO.convert(mergename, 'genbank', fastafile, 'fasta')
-  args.input_genbank_genome_name = mergename
+  if args.restriction_site is None:
+    args.restriction_site = list()
+  if args.oligo_context is None:
+    args.oligo_context = [('', '')]
+  else:
+    args.oligo_context = cut_sites.parse_contexts(args.oligo_context)
+  args.genes = [g for x in args.genes or () for g in x.split(',') if g]
+  args.regions = [parse_region(x) for x in args.regions or ()]
+  if args.input_genbank_genome_name:
+    if args.input_fasta_genome_name:
+      logging.error('Give a GenBank or a FASTA genome, not both.')
+      sys.exit(1)
+    first = args.input_genbank_genome_name[0]
+  elif args.input_fasta_genome_name:
+    first = args.input_fasta_genome_name
+  else:
+    logging.error('No genome given; use --input_genbank_genome_name or '
+                  '--input_fasta_genome_name.')
+    sys.exit(1)
+  if args.work_dir is None:
+    args.work_dir = os.path.dirname(first) or '.'
   if args.tsv_output_file is None:
-    base = os.path.splitext(args.input_genbank_genome_name)[0]
-    args.tsv_output_file =  base + '.targets.all.tsv'
-  args.input_fasta_genome_name = fastafile
+    base = os.path.join(os.path.dirname(first), genome_label(first))
+    if args.genes or args.regions:
+      args.tsv_output_file =  base + '.merged.targets.regions.tsv'
+    else:
+      args.tsv_output_file =  base + '.merged.targets.all.tsv'
   return args
 
 
 def main():
   args = parse_args()
+  if args.input_genbank_genome_name:
+    (args.input_fasta_genome_name,
+     genbank_regions) = prepare_genome(args.input_genbank_genome_name,
+                                       args.work_dir)
+  # Find regions
+  chrom_lens = chrom_lengths(args.input_fasta_genome_name)
+  if args.annotation_file is None:
+    if args.input_genbank_genome_name:
+      target_regions = genbank_regions
+    else:
+      logging.warning('No --annotation_file for the FASTA genome; targets '
+                      'will not be labelled with genes.')
+      target_regions = list()
+  else:
+    target_regions = annotations.load_regions(
+        args.annotation_file, feature_types=args.annotation_feature)
+    unknown = set(x[1] for x in target_regions) - set(chrom_lens)
+    if unknown:
+      logging.warning('Ignoring regions on {0} chromosomes not in the '
+                      'genome.'.format(len(unknown)))
+      target_regions = [x for x in target_regions if x[1] in chrom_lens]
+  # The report names genes anywhere in the genome, not just those designed for.
+  all_regions = target_regions
+  windows = None
+  if args.genes or args.regions:
+    windows = design_windows(target_regions,
+                             args.genes,
+                             args.regions,
+                             args.region_margin,
+                             chrom_lens)
+    target_regions = overlapping_regions(target_regions, windows)
+    covered = sum(e - s for spans in windows.values() for s, e in spans)
+    logging.info('Designing in {0} bases across {1} chromosomes.'.format(
+        covered, len(windows)))
   # Build initial list
   all_targets = extract_targets(args.input_fasta_genome_name,
                                 args.pam,
-                                args.target_len)
+                                args.target_len,
+                                windows,
+                                args.processes)
+  if args.cut_site_filter:
+    matcher = cut_sites.site_matcher(args.restriction_site, args.oligo_context)
+    uncut = cut_sites.filter_targets(iter(all_targets.values()), matcher)
+    all_targets = dict((x.id_str(), x) for x in uncut)
+    logging.info('{0} targets without cut sites.'.format(len(all_targets)))
   # Score list
-  ascribe_specificity(all_targets, args.input_fasta_genome_name, args.sam_copy)
+  controller = resources.resource_controller(args.max_memory, args.max_cores)
+  report = None
+  if args.off_target_report:
+    report = off_targets.off_target_report(args.off_target_top_k,
+                                           args.target_len + len(args.pam),
+                                           len(args.pam))
+  ascribe_specificity(all_targets,
+                      args.input_fasta_genome_name,
+                      args.sam_copy,
+                      report,
+                      controller)
+  if report is not None:
+    logging.info('Writing off-target loci to {0}'.format(
+        args.off_target_report))
+    with open(args.off_target_report, 'w') as report_file:
+      count = off_targets.write_report(report_file,
+                                       all_targets.values(),
+                                       report.hits,
+                                       all_regions,
+                                       args.off_target_top_k,
+                                       args.off_target_below_tier,
+                                       args.allow_partial_overlap)
+    logging.info('{0} off-target loci listed.'.format(count))
+  extra_fields = list()
+  if args.background_genome:
+    extra_fields = score_background_genomes(all_targets,
+                                            args.background_genome,
+                                            args.pam,
+                                            args.target_len,
+                                            controller)
+  if args.guide_features:
+    extra_fields.extend(guide_features.add_guide_features(
+        all_targets, args.restriction_site, args.oligo_context))
   # Annotate list
-  chrom_lens = chrom_lengths(args.input_fasta_genome_name)
-  target_regions = get_regions_from_genbank(args.input_genbank_genome_name)
-  all_targets = label_targets(all_targets,
-                              target_regions,
-                              chrom_lens,
-                              args.allow_partial_overlap)
-  # Generate output
-  total_count = len(all_targets)
+  annotated = label_targets(all_targets,
+                            target_regions,
+                            chrom_lens,
+                            args.allow_partial_overlap,
+                            args.processes)
+  # Generate output, as targets are labelled
   logging.info(
-      'Writing {total_count} annotated targets to {args.tsv_output_file}'.format(
-          **vars()))
-  with open(args.tsv_output_file, 'w') as tsv_file:
-    tsv_file.write(sgrna_target.header() + '\n')
-    for target in all_targets:
+      'Writing annotated targets to {args.tsv_output_file}'.format(**vars()))
+  total_count = 0
+  with library_io.open_output(args.tsv_output_file) as tsv_file:
+    tsv_file.write(sgrna_target.header(extra_fields=extra_fields) + '\n')
+    for target in annotated:
       tsv_file.write(str(target) + '\n')
+      total_count += 1
+  logging.info('Wrote {total_count} annotated targets.'.format(**vars()))
+  if library_index.indexable(args.tsv_output_file):
+    library_index.build_index(args.tsv_output_file)
+  if args.run_metrics:
+    logging.info('Writing run metrics to {0}'.format(args.run_metrics))
+    with open(args.run_metrics, 'w') as metrics_file:
+      json.dump(controller.metrics(), metrics_file, indent=2)
+      metrics_file.write('\n')
 
 ##############################################
 if __name__ == "__main__":
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+
+# Author: John Hawkins (jsh) [really@gmail.com]
+
+import argparse
+import itertools
+import logging
+import os.path
+import sys
+
+import numpy as np
+
+import library_io
+import packed_targets
+from sgrna_target import sgrna_target
+
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s %(levelname)s %(message)s')
+
+class Error(Exception):
+  pass
+
+class SampleError(Error):
+  pass
+
+
+# Lines handled at a time while streaming a library.
+CHUNK_SIZE = 200000
+
+COLUMNS = sgrna_target.header().split('\t')
+TARGET_COLUMN = COLUMNS.index('target')
+PAM_COLUMN = COLUMNS.index('pam')
+SPECIFICITY_COLUMN = COLUMNS.index('specificity')
+
+MODES = ('intersect', 'difference')
+
+# Packed sequences only compare equal at the same length (a 32-base sequence
+# can use all 64 bits), so keys carry the length alongside.
+KEY_DTYPE = np.dtype([('length', np.uint8), ('packed', np.uint64)])
+
+
+def library_chunks(library_file, chunk_size=CHUNK_SIZE, headers=None):
+  """Stream a targets file as lists of data lines (header and comments dropped).
+
+  Header lines are appended to headers, if given, as they are passed.
+  """
+  def data_lines():
+    for x in library_file:
+      if x.startswith('gene\t'):
+        if headers is not None:
+          headers.append(x)
+      elif not x.startswith('#'):
+        yield x
+  lines = data_lines()
+  return iter(lambda: list(itertools.islice(lines, chunk_size)), [])
+
+
+def chunk_keys(lines, with_pam, min_specificity):
+  """Pack the protospacers of a chunk of lines.
+
+  Returns:
+    (keys, usable): KEY_DTYPE array of lengths and packed sequences, and a
+      mask of the lines that could be packed and meet min_specificity.
+  """
+  fields = [x.rstrip('\n').split('\t') for x in lines]
+  if with_pam:
+    sequences = [x[TARGET_COLUMN] + x[PAM_COLUMN] for x in fields]
+  else:
+    sequences = [x[TARGET_COLUMN] for x in fields]
+  specificity = np.array([int(x[SPECIFICITY_COLUMN]) for x in fields])
+  usable = specificity >= min_specificity
+  keys = np.zeros(len(lines), dtype=KEY_DTYPE)
+  lengths = set(len(x) for x in sequences)
+  for length in lengths:
+    rows = np.array([i for i, x in enumerate(sequences) if len(x) == length])
+    codes = packed_targets.encode(sequences[i] for i in rows)
+    known = (codes < packed_targets.UNKNOWN_CODE).all(axis=1)
+    if length > 32:
+      known[:] = False
+    else:
+      keys['length'][rows[known]] = length
+      keys['packed'][rows[known]] = packed_targets.pack(codes[known])
+    usable[rows[~known]] = False
+  return keys, usable
+
+
+def protospacer_set(library_file, with_pam=False, min_specificity=0):
+  """Sorted KEY_DTYPE array of the distinct protospacers in a library."""
+  parts = list()
+  for lines in library_chunks(library_file):
+    keys, usable = chunk_keys(lines, with_pam, min_specificity)
+    parts.append(np.unique(keys[usable]))
+  if not parts:
+    return np.zeros(0, dtype=KEY_DTYPE)
+  return np.unique(np.concatenate(parts))
+
+
+def library_header(headers):
+  return headers[0] if headers else sgrna_target.header() + '\n'
+
+
+def compare(library_file, keys, output_file, mode, with_pam=False,
+            min_specificity=0):
+  """Stream a library, writing the lines that are (or are not) in keys.
+
+  The library's own header line goes first (the standard one if it has
+  none), so any extra columns stay labelled.  Lines below min_specificity are
+  never written.
+
+  Returns:
+    number of lines written.
+  """
+  headers = list()
+  started = False
+  written = 0
+  for lines in library_chunks(library_file, headers=headers):
+    if not started:
+      output_file.write(library_header(headers))
+      started = True
+    chunk, usable = chunk_keys(lines, with_pam, min_specificity)
+    present = usable.copy()
+    if len(keys):
+      where = np.minimum(np.searchsorted(keys, chunk), len(keys) - 1)
+      present &= keys[where] == chunk
+    else:
+      present[:] = False
+    if mode == 'intersect':
+      chosen = present
+    else:
+      chosen = usable & ~present
+    output_file.write(''.join(lines[i] for i in np.flatnonzero(chosen)))
+    written += chosen.sum()
+  if not started:
+    output_file.write(library_header(headers))
+  return written
+
+
+def parse_args():
+  """Read in the arguments for the library comparison code."""
+  logging.info('Parsing command line.')
+  parser = argparse.ArgumentParser(
+      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument('--input_tsv_file', type=str, required=True,
+                      help='Library whose lines are written out.')
+  parser.add_argument('--comparison_tsv_file', type=str, required=True,
+                      help='Library to compare against (only its protospacers '
+                           'are kept in memory).')
+  parser.add_argument('--output_tsv_file_name', type=str, default=None,
+                      help='[optional] Where to write the chosen lines.')
+  parser.add_argument('--mode', type=str, default='intersect', choices=MODES,
+                      help='Keep guides found in both libraries, or only in '
+                           'the input.')
+  parser.add_argument('--min_specificity', type=int, default=0,
+                      help='Only consider guides with at least this '
+                           'specificity, in either library.')
+  parser.add_argument('--with_pam', action='store_true', default=False,
+                      help='Require the PAM to match as well.')
+  args = parser.parse_args()
+  if args.output_tsv_file_name is None:
+    base, ext = os.path.splitext(args.input_tsv_file)
+    suffix = '.matched' if args.mode == 'intersect' else '.unmatched'
+    args.output_tsv_file_name =  base + suffix + ext
+  return args
+
+
+def main():
+  args = parse_args()
+  logging.info('Reading targets from {0}'.format(args.comparison_tsv_file))
+  with library_io.open_input(args.comparison_tsv_file) as comparison_file:
+    keys = protospacer_set(comparison_file, args.with_pam, args.min_specificity)
+  logging.info('{0} distinct protospacers to compare against.'.format(
+      len(keys)))
+  logging.info('Reading targets from {0}'.format(args.input_tsv_file))
+  with library_io.open_input(args.input_tsv_file) as input_file:
+    with library_io.open_output(args.output_tsv_file_name) as output_file:
+      count = compare(input_file, keys, output_file, args.mode, args.with_pam,
+                      args.min_specificity)
+  logging.info(
+      'Wrote {count} targets to {args.output_tsv_file_name}'.format(**vars()))
+
+##############################################
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+# Author: John Hawkins (jsh) [really@gmail.com]
+
+import argparse
+import gzip
+import itertools
+import logging
+import multiprocessing
+import os.path
+import sys
+
+import Bio.SeqIO
+import numpy as np
+
+import annotate_sequencing_reads as annotate
+
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s %(levelname)s %(message)s')
+
+class Error(Exception):
+  pass
+
+class SampleError(Error):
+  pass
+
+
+# Reads looked up in the guide index at a time.
+CHUNK_SIZE = 100000
+
+
+def open_reads(file_name):
+  """Open a (possibly gzipped) read file for text reading."""
+  if file_name.endswith('.gz'):
+    return gzip.open(file_name, 'rt')
+  return open(file_name)
+
+
+def iter_fastq_sequences(handle):
+  """Stream read sequences from a FASTQ file, ignoring names and qualities.
+
+  Assumes the usual four lines per record.
+  """
+  for line in itertools.islice(handle, 1, None, 4):
+    yield line.rstrip('\n').upper()
+
+
+# Set in each worker (inherited from the parent where processes are forked).
+_WORKER_STATE = dict()
+
+def _init_worker(index, roi_front, roi_back):
+  _WORKER_STATE['index'] = index
+  _WORKER_STATE['flanks'] = (roi_front, roi_back)
+
+
+def count_sample(sample):
+  """Count reads per guide for one sample.
+
+  Args:
+    sample: (name, file name) of the sample's FASTQ file.
+  Returns:
+    (counts, stats): reads per guide (indexed like index.names), and a dict of
+      read totals for logging.
+  """
+  name, file_name = sample
+  index = _WORKER_STATE['index']
+  roi_front, roi_back = _WORKER_STATE['flanks']
+  counts = np.zeros(len(index.names), dtype=np.int64)
+  stats = dict(reads=0, no_flanks=0, unknown=0)
+  logging.info('Counting reads for {name} from {file_name}.'.format(**vars()))
+  with open_reads(file_name) as handle:
+    sequences = iter_fastq_sequences(handle)
+    for chunk in iter(lambda: list(itertools.islice(sequences, CHUNK_SIZE)),
+                      []):
+      windows = list()
+      for seq in chunk:
+        _, window = annotate.orient_and_extract(seq, roi_front, roi_back)
+        if window is not None:
+          windows.append(window)
+      guides, _ = index.lookup_strings(windows)
+      known = guides[guides != annotate.AMBIGUOUS]
+      counts += np.bincount(known, minlength=len(counts))
+      stats['reads'] += len(chunk)
+      stats['no_flanks'] += len(chunk) - len(windows)
+      stats['unknown'] += len(windows) - len(known)
+  logging.info(
+      '{name}: {reads} reads, {no_flanks} without flanks, {unknown} with '
+      'unrecognized guides.'.format(name=name, **stats))
+  return counts, stats
+
+
+def write_count_matrix(output_file, index, sample_names, counts):
+  """Write a guide x sample table of read counts."""
+  output_file.write('\t'.join(['guide'] + sample_names) + '\n')
+  matrix = np.column_stack(counts)
+  rows = list()
+  for name, row in zip(index.names, matrix):
+    rows.append(name + '\t' + '\t'.join(str(x) for x in row) + '\n')
+  output_file.write(''.join(rows))
+
+
+def parse_args():
+  """Read in the arguments for the pooled screen read counting code."""
+  logging.info('Parsing command line.')
+  parser = argparse.ArgumentParser(
+      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument('--input_target_lib', type=argparse.FileType('r'),
+                      required=True,
+                      help='Library guides, as "id<TAB>sequence" lines.')
+  parser.add_argument('--parent_plasmid', type=str, required=True,
+                      help=('GenBank file of the parent plasmid, with '
+                            'region_of_interest and target labels.'))
+  parser.add_argument('--sample', type=str, action='append', required=True,
+                      help=('NAME=FILE for one sample\'s FASTQ reads, '
+                            'optionally gzipped (can be repeated).'))
+  parser.add_argument('--output_file', type=argparse.FileType('w'),
+                      default=sys.stdout, help='Where to write the counts.')
+  parser.add_argument('--max_mismatches', type=int, default=1,
+                      help='Mismatches allowed when matching a guide.')
+  parser.add_argument('--processes', type=int,
+                      default=multiprocessing.cpu_count(),
+                      help='Samples to count at the same time.')
+  args = parser.parse_args()
+  samples = list()
+  for x in args.sample:
+    if '=' in x:
+      name, file_name = x.split('=', 1)
+    else:
+      file_name = x
+      name = os.path.basename(x).split('.')[0]
+    samples.append((name, file_name))
+  args.sample = samples
+  return args
+
+
+def main():
+  args = parse_args()
+  target_library = annotate.read_target_library(args.input_target_lib)
+  parent_vector = Bio.SeqIO.read(args.parent_plasmid, 'genbank')
+  (roi_front, parent_target, roi_back) = annotate.get_comparison_regions(
+      parent_vector)
+  target_library[parent_target] = 'PARENT'
+  index = annotate.guide_index(target_library, args.max_mismatches)
+  processes = min(args.processes, len(args.sample))
+  if processes <= 1:
+    _init_worker(index, roi_front, roi_back)
+    results = [count_sample(x) for x in args.sample]
+  else:
+    pool = multiprocessing.Pool(processes, _init_worker,
+                                (index, roi_front, roi_back))
+    try:
+      results = pool.map(count_sample, args.sample)
+    finally:
+      pool.terminate()
+  write_count_matrix(args.output_file,
+                     index,
+                     [name for name, _ in args.sample],
+                     [counts for counts, _ in results])
+
+##############################################
+if __name__ == "__main__":
+  sys.exit(main())
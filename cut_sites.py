@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+
+# Author: John Hawkins (jsh) [really@gmail.com]
+
+import argparse
+import collections
+import itertools
+import logging
+import sys
+
+import numpy as np
+
+import library_io
+import packed_targets
+from sgrna_target import sgrna_target
+
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s %(levelname)s %(message)s')
+
+class Error(Exception):
+  pass
+
+class SampleError(Error):
+  pass
+
+
+# Recognition sites for enzymes we commonly have to keep out of oligos.
+RESTRICTION_SITES = {
+    'BsaI': 'GGTCTC',
+    'BsmBI': 'CGTCTC',
+    'BbsI': 'GAAGAC',
+    'SapI': 'GCTCTTC',
+    'BamHI': 'GGATCC',
+    'SpeI': 'ACTAGT',
+}
+
+# The overhang set from our original BsaI cloning scheme.
+DEFAULT_SPACER = 'T'
+DEFAULT_FRONT_OVERHANGS = ['ATGT', 'AAGC', 'GGGA', 'TAGT']
+DEFAULT_BACK_OVERHANGS = ['GTTT']
+
+# Targets buffered per batch when filtering a stream.
+CHUNK_SIZE = 100000
+
+
+def site_sequence(site):
+  """Resolve an enzyme name from RESTRICTION_SITES, or pass DNA through."""
+  return RESTRICTION_SITES.get(site, site).upper()
+
+
+def parse_contexts(context_strings):
+  """Turn 'FRONT:BACK' strings into (front, back) tuples."""
+  contexts = list()
+  for x in context_strings:
+    if ':' not in x:
+      logging.error('Oligo context {x} is not of the form FRONT:BACK.'.format(
+          **vars()))
+      sys.exit(1)
+    front, back = x.upper().split(':', 1)
+    contexts.append((front, back))
+  return contexts
+
+
+def overhang_contexts(front_overhangs, back_overhangs, spacer=DEFAULT_SPACER):
+  """(front, back) contexts for each front/back overhang combination."""
+  recaps = packed_targets.decode(
+      packed_targets.revcomp(packed_targets.encode([spacer])))[0]
+  return [(spacer + f, b + recaps)
+          for f, b in itertools.product(front_overhangs, back_overhangs)]
+
+
+class site_matcher(object):
+  """Multi-pattern (Aho-Corasick) matcher for DNA sites across oligo contexts.
+
+  The automaton is compiled to a dense transition table over base codes, so a
+  batch of guides is scanned one column at a time with array lookups.  Each
+  guide is scanned once, carrying one automaton state per distinct front flank
+  (the state after reading that flank is precomputed); whether each back flank
+  completes a site from a given state is also precomputed, so contexts cost
+  nothing extra per base.
+  """
+  def __init__(self, sites, contexts=(('', ''),)):
+    patterns = set()
+    for site in sites:
+      site = site_sequence(site)
+      patterns.add(site)
+      patterns.add(packed_targets.decode(
+          packed_targets.revcomp(packed_targets.encode([site])))[0])
+    self.patterns = sorted(patterns)
+    self.contexts = list(contexts)
+    self._compile()
+    fronts = sorted(set(f for f, b in self.contexts))
+    backs = sorted(set(b for f, b in self.contexts))
+    self._front_index = np.array(
+        [fronts.index(f) for f, b in self.contexts], dtype=np.intp)
+    self._back_index = np.array(
+        [backs.index(b) for f, b in self.contexts], dtype=np.intp)
+    self._front_states = np.zeros(len(fronts), dtype=np.int32)
+    self._front_hit = np.zeros(len(fronts), dtype=bool)
+    for i, front in enumerate(fronts):
+      self._front_states[i], self._front_hit[i] = self._run(0, front)
+    self._back_hit = np.zeros((len(self._delta), len(backs)), dtype=bool)
+    for state in range(len(self._delta)):
+      for j, back in enumerate(backs):
+        self._back_hit[state, j] = self._run(state, back)[1]
+
+  def _compile(self):
+    """Build the Aho-Corasick trie and flatten it into a dense DFA."""
+    goto = [dict()]
+    accept = [False]
+    for pattern in self.patterns:
+      state = 0
+      for code in packed_targets.encode([pattern])[0]:
+        if code not in goto[state]:
+          goto.append(dict())
+          accept.append(False)
+          goto[state][code] = len(goto) - 1
+        state = goto[state][code]
+      accept[state] = True
+    width = packed_targets.UNKNOWN_CODE + 1
+    delta = np.zeros((len(goto), width), dtype=np.int32)
+    fail = [0] * len(goto)
+    queue = collections.deque()
+    # Unknown bases never occur in sites, so they always lead back to root.
+    for code in range(packed_targets.UNKNOWN_CODE):
+      child = goto[0].get(code)
+      if child is not None:
+        delta[0, code] = child
+        queue.append(child)
+    while queue:
+      state = queue.popleft()
+      accept[state] = accept[state] or accept[fail[state]]
+      for code in range(packed_targets.UNKNOWN_CODE):
+        child = goto[state].get(code)
+        if child is None:
+          delta[state, code] = delta[fail[state], code]
+        else:
+          fail[child] = delta[fail[state], code]
+          delta[state, code] = child
+          queue.append(child)
+    self._delta = delta
+    self._accept = np.array(accept, dtype=bool)
+
+  def _run(self, state, sequence):
+    """Feed a flank through the automaton; returns (state, hit)."""
+    hit = False
+    if sequence:
+      for code in packed_targets.encode([sequence])[0]:
+        state = self._delta[state, code]
+        hit = hit or self._accept[state]
+    return state, hit
+
+  def scan(self, codes):
+    """Find which contexts produce a site for each guide.
+
+    Args:
+      codes [array]:  (n, length) base codes of the guides.
+    Returns:
+      hits: (n, len(contexts)) bool array.
+    """
+    n = len(codes)
+    if not self.patterns:
+      return np.zeros((n, len(self.contexts)), dtype=bool)
+    states = np.tile(self._front_states, (n, 1))
+    hit = np.tile(self._front_hit, (n, 1))
+    for column in range(codes.shape[1]):
+      states = self._delta[states, codes[:, column, None]]
+      hit |= self._accept[states]
+    front_states = states[:, self._front_index]
+    return (hit[:, self._front_index] |
+            self._back_hit[front_states, self._back_index])
+
+  def any_site(self, codes):
+    """Whether any context produces a site, for each guide."""
+    return self.scan(codes).any(axis=1)
+
+
+def filter_targets(targets, matcher, chunk_size=CHUNK_SIZE):
+  """Drop targets whose oligos would contain a site, preserving order.
+
+  Args:
+    targets: iterable of sgrna_targets (consumed in batches).
+    matcher: site_matcher describing the sites and oligo contexts.
+  Yields:
+    the targets without sites.
+  """
+  while True:
+    chunk = list(itertools.islice(targets, chunk_size))
+    if not chunk:
+      return
+    cut = matcher.any_site(packed_targets.encode(x.target for x in chunk))
+    for x, is_cut in zip(chunk, cut):
+      if not is_cut:
+        yield x
+
+
+def parse_args():
+  """Read in the arguments for the cut site filter."""
+  logging.info('Parsing command line.')
+  parser = argparse.ArgumentParser(
+      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument(
+      '--input_tsv_file', type=library_io.open_input, default=sys.stdin,
+      help='Targets to filter, as written by build_sgrna_library.py.')
+  parser.add_argument(
+      '--output_tsv_file', type=library_io.open_output, default=sys.stdout,
+      help='Where to write the targets without cut sites.')
+  parser.add_argument(
+      '--enzyme', type=str, action='append', default=None,
+      help=('Enzyme name ({0}) or DNA site to screen for (can be repeated; '
+            'default BsaI).').format(', '.join(sorted(RESTRICTION_SITES))))
+  parser.add_argument(
+      '--oligo_context', type=str, action='append', default=None,
+      help='FRONT:BACK flanks placed around each guide (can be repeated).')
+  parser.add_argument(
+      '--front_overhang', type=str, action='append', default=None,
+      help='Front overhang, combined with every back overhang (can be repeated).')
+  parser.add_argument(
+      '--back_overhang', type=str, action='append', default=None,
+      help='Back overhang, combined with every front overhang (can be repeated).')
+  parser.add_argument(
+      '--spacer', type=str, default=DEFAULT_SPACER,
+      help='Base(s) between the enzyme site and the overhangs.')
+  args = parser.parse_args()
+  if args.enzyme is None:
+    args.enzyme = ['BsaI']
+  contexts = list()
+  if args.oligo_context:
+    contexts.extend(parse_contexts(args.oligo_context))
+  if args.front_overhang or args.back_overhang or not contexts:
+    contexts.extend(overhang_contexts(
+        [x.upper() for x in args.front_overhang or DEFAULT_FRONT_OVERHANGS],
+        [x.upper() for x in args.back_overhang or DEFAULT_BACK_OVERHANGS],
+        args.spacer.upper()))
+  args.contexts = contexts
+  return args
+
+
+def main():
+  args = parse_args()
+  matcher = site_matcher(args.enzyme, args.contexts)
+  logging.info('Screening for {0} sites across {1} oligo contexts.'.format(
+      len(matcher.patterns), len(matcher.contexts)))
+  kept = 0
+  def targets():
+    for line in args.input_tsv_file:
+      if line.startswith('#'):
+        continue
+      if line.startswith('gene\t'):
+        args.output_tsv_file.write(line)
+        continue
+      yield sgrna_target.from_tsv(line)
+  for x in filter_targets(targets(), matcher):
+    args.output_tsv_file.write(str(x) + '\n')
+    kept += 1
+  logging.info('Kept {kept} targets without cut sites.'.format(**vars()))
+
+##############################################
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+
+# Author: John Hawkins (jsh) [really@gmail.com]
+
+import argparse
+import logging
+import os.path
+import sys
+
+import numpy as np
+
+import cut_sites
+import guide_features
+import packed_targets
+
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s %(levelname)s %(message)s')
+
+class Error(Exception):
+  pass
+
+class SampleError(Error):
+  pass
+
+
+# Sites we never want inside a barcode.
+DEFAULT_ENZYMES = ['BamHI', 'SpeI']
+# Candidates checked against each other (all pairs) at a time.
+SUBBATCH_SIZE = 2000
+# Give up after this many rounds in a row without a new barcode.
+MAX_IDLE_ROUNDS = 20
+
+
+class distance_index(object):
+  """Set of packed barcodes supporting "anything within distance d?" queries.
+
+  Barcodes are cut into d blocks.  Two barcodes differing at fewer than d bases
+  must agree exactly on at least one block, so only barcodes sharing a block
+  value with a query need an exact (XOR/popcount) distance check.  Each block
+  is kept as a sorted array, so a whole batch of queries is checked at once.
+  """
+  def __init__(self, length, min_distance):
+    self.length = length
+    self.min_distance = min_distance
+    bounds = np.linspace(0, length, min_distance + 1).astype(int)
+    self._blocks = list(zip(bounds[:-1], bounds[1:]))
+    self._packed = np.zeros(0, dtype=np.uint64)
+    self._sorted = list()
+
+  def _block_values(self, packed, block):
+    lo, hi = block
+    shift = np.uint64(2 * (self.length - hi))
+    mask = np.uint64((1 << (2 * (hi - lo))) - 1)
+    return (packed >> shift) & mask
+
+  def conflicts(self, packed):
+    """Which packed barcodes are closer than min_distance to any member."""
+    found = np.zeros(len(packed), dtype=bool)
+    for block, (values, members) in zip(self._blocks, self._sorted):
+      queries = self._block_values(packed, block)
+      lo = np.searchsorted(values, queries, 'left')
+      counts = np.searchsorted(values, queries, 'right') - lo
+      total = counts.sum()
+      if not total:
+        continue
+      # One (query, member) pair for every shared block value.
+      which = np.repeat(np.arange(len(packed)), counts)
+      starts = np.repeat(np.cumsum(counts) - counts, counts)
+      partners = members[lo[which] + np.arange(total) - starts]
+      distances = packed_targets.mismatches(self._packed[partners],
+                                            packed[which])
+      found[which[distances < self.min_distance]] = True
+    return found
+
+  def add(self, packed):
+    self._packed = np.concatenate([self._packed, packed])
+    self._sorted = list()
+    for block in self._blocks:
+      values = self._block_values(self._packed, block)
+      order = np.argsort(values, kind='stable')
+      self._sorted.append((values[order], order))
+
+  def __len__(self):
+    return len(self._packed)
+
+
+def spread_out(packed, min_distance):
+  """Greedily keep barcodes (in order) at least min_distance from each other.
+
+  Returns:
+    keep: bool mask over packed.
+  """
+  close = packed_targets.mismatches(packed[:, None], packed[None, :])
+  close = close < min_distance
+  np.fill_diagonal(close, False)
+  keep = np.zeros(len(packed), dtype=bool)
+  blocked = np.zeros(len(packed), dtype=bool)
+  for i in range(len(packed)):
+    if not blocked[i]:
+      keep[i] = True
+      blocked |= close[i]
+  return keep
+
+
+def acceptable(codes, matcher, min_gc, max_gc, max_homopolymer):
+  """Sequence constraints for barcodes, evaluated for a whole batch."""
+  gc = guide_features.gc_fraction(codes)
+  return ((gc >= min_gc) & (gc <= max_gc) &
+          (guide_features.max_homopolymer(codes) <= max_homopolymer) &
+          ~matcher.any_site(codes))
+
+
+def build_barcodes(barcode_size, barcodes_wanted, used_barcodes, rng,
+                   min_distance=3, min_gc=0.4, max_gc=0.6, max_homopolymer=3,
+                   enzymes=DEFAULT_ENZYMES, batch_size=100000):
+  """Design barcodes at least min_distance apart from each other and from
+  every previously used barcode.
+
+  Args:
+    barcode_size [int]:     Length of each barcode (at most 32).
+    barcodes_wanted [int]:  How many new barcodes to make.
+    used_barcodes [list]:   Barcodes already in use, of the same length.
+    rng:                    numpy random Generator.
+  Returns:
+    barcodes: list of new barcode strings.
+  """
+  index = distance_index(barcode_size, min_distance)
+  used = [x for x in used_barcodes if len(x) == barcode_size]
+  if len(used) < len(used_barcodes):
+    logging.warning('Ignoring {0} used barcodes of the wrong size.'.format(
+        len(used_barcodes) - len(used)))
+  if used:
+    index.add(packed_targets.pack(packed_targets.encode(used)))
+  logging.info('{0} barcodes already in use.'.format(len(index)))
+  matcher = cut_sites.site_matcher(enzymes)
+  barcodes = list()
+  found = 0
+  idle_rounds = 0
+  while found < barcodes_wanted:
+    codes = rng.integers(0, 4, (batch_size, barcode_size)).astype(np.uint8)
+    codes = codes[acceptable(codes, matcher, min_gc, max_gc, max_homopolymer)]
+    packed = np.unique(packed_targets.pack(codes))
+    packed = packed[rng.permutation(len(packed))]
+    before = found
+    for start in range(0, len(packed), SUBBATCH_SIZE):
+      chunk = packed[start:start + SUBBATCH_SIZE]
+      chunk = chunk[~index.conflicts(chunk)]
+      chunk = chunk[spread_out(chunk, min_distance)]
+      chunk = chunk[:barcodes_wanted - found]
+      index.add(chunk)
+      barcodes.append(chunk)
+      found += len(chunk)
+      if found == barcodes_wanted:
+        break
+    logging.info('{0} barcodes so far.'.format(found))
+    idle_rounds = idle_rounds + 1 if found == before else 0
+    if idle_rounds == MAX_IDLE_ROUNDS:
+      logging.error(
+          'Stuck at {0} barcodes; try longer barcodes or a smaller '
+          'minimum distance.'.format(found))
+      sys.exit(1)
+  barcodes = np.concatenate(barcodes) if barcodes else np.zeros(0, np.uint64)
+  return packed_targets.decode(packed_targets.unpack(barcodes, barcode_size))
+
+
+def parse_args():
+  """Read in the arguments for the barcode design code."""
+  logging.info('Parsing command line.')
+  parser = argparse.ArgumentParser(
+      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument('--barcode_size', type=int, default=10,
+                      help='Length of each barcode.')
+  parser.add_argument('--barcodes_wanted', type=int, required=True,
+                      help='Number of new barcodes to design.')
+  parser.add_argument('--min_distance', type=int, default=3,
+                      help='Minimum Hamming distance between any two barcodes.')
+  parser.add_argument('--min_gc', type=float, default=0.4,
+                      help='Lowest allowed GC fraction.')
+  parser.add_argument('--max_gc', type=float, default=0.6,
+                      help='Highest allowed GC fraction.')
+  parser.add_argument('--max_homopolymer', type=int, default=3,
+                      help='Longest allowed single-base run.')
+  parser.add_argument('--enzyme', type=str, action='append', default=None,
+                      help=('Enzyme name or DNA site barcodes must not contain '
+                            '(can be repeated; default {0}).').format(
+                                ', '.join(DEFAULT_ENZYMES)))
+  parser.add_argument('--barcode_occupancy_file_name', type=str,
+                      default='/tmp/barcode_occupancy',
+                      help='Previously used barcodes, one per line.')
+  parser.add_argument('--update_occupancy', action='store_true',
+                      default=False,
+                      help='Append the new barcodes to the occupancy file.')
+  parser.add_argument('--seed', type=int, default=None,
+                      help='Random seed, for reproducible barcodes.')
+  parser.add_argument('--output_file_name', type=str, default=None,
+                      help='Where to write the barcodes (default stdout).')
+  args = parser.parse_args()
+  if args.barcode_size > 32:
+    parser.error('--barcode_size can be at most 32.')
+  if not 1 <= args.min_distance <= args.barcode_size:
+    parser.error('--min_distance must be between 1 and --barcode_size.')
+  if args.enzyme is None:
+    args.enzyme = DEFAULT_ENZYMES
+  return args
+
+
+def main():
+  args = parse_args()
+  used_barcodes = list()
+  if os.path.exists(args.barcode_occupancy_file_name):
+    logging.info('Reading in previous barcodes from {0}.'.format(
+        args.barcode_occupancy_file_name))
+    with open(args.barcode_occupancy_file_name) as occupancy_file:
+      used_barcodes = [x.strip().upper() for x in occupancy_file if x.strip()]
+  barcodes = build_barcodes(args.barcode_size,
+                            args.barcodes_wanted,
+                            used_barcodes,
+                            np.random.default_rng(args.seed),
+                            args.min_distance,
+                            args.min_gc,
+                            args.max_gc,
+                            args.max_homopolymer,
+                            args.enzyme)
+  text = ''.join(x + '\n' for x in barcodes)
+  if args.output_file_name is None:
+    sys.stdout.write(text)
+  else:
+    logging.info('Writing barcodes to {0}'.format(args.output_file_name))
+    with open(args.output_file_name, 'w') as output_file:
+      output_file.write(text)
+  if args.update_occupancy:
+    with open(args.barcode_occupancy_file_name, 'a') as occupancy_file:
+      occupancy_file.write(text)
+
+##############################################
+if __name__ == "__main__":
+  sys.exit(main())
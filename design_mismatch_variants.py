@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+
+# Author: John Hawkins (jsh) [really@gmail.com]
+
+import argparse
+import itertools
+import logging
+import os.path
+import sys
+
+import numpy as np
+
+import build_sgrna_library
+import library_io
+import packed_targets
+from sgrna_target import sgrna_target
+from target_table import target_table
+
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s %(levelname)s %(message)s')
+
+class Error(Exception):
+  pass
+
+class SampleError(Error):
+  pass
+
+
+# Parent guides whose variants are enumerated at a time.
+PARENT_BATCH_SIZE = 500
+# Distinct variants sent to bowtie at a time.
+SCORE_BATCH_SIZE = 200000
+
+VARIANT_FIELDS = ('parent', 'mismatches', 'mismatch_positions')
+
+
+def mismatch_deltas(target_len, max_mismatches):
+  """Every way of changing up to max_mismatches bases of a guide.
+
+  Returns:
+    (deltas, positions): (variants, target_len) uint8 array of amounts to add
+      (mod 4) to base codes, and the 1-based positions each one changes.
+  """
+  deltas = list()
+  positions = list()
+  for count in range(1, max_mismatches + 1):
+    for where in itertools.combinations(range(target_len), count):
+      for change in itertools.product((1, 2, 3), repeat=count):
+        delta = np.zeros(target_len, dtype=np.uint8)
+        delta[list(where)] = change
+        deltas.append(delta)
+        positions.append(','.join(str(p + 1) for p in where))
+  return np.array(deltas, dtype=np.uint8), positions
+
+
+def variant_keys(codes, pam_codes, deltas):
+  """Packed variant+PAM sequences of each parent.
+
+  Args:
+    codes [array]:      (parents, target_len) base codes.
+    pam_codes [array]:  (parents, pam_len) base codes.
+    deltas [array]:     From mismatch_deltas().
+  Returns:
+    (parents, variants) uint64 array.
+  """
+  variants = (codes[:, None, :] + deltas[None, :, :]) % 4
+  pams = np.broadcast_to(pam_codes[:, None, :],
+                         (len(codes), len(deltas), pam_codes.shape[1]))
+  full = np.concatenate([variants, pams], axis=2).reshape(
+      -1, codes.shape[1] + pam_codes.shape[1])
+  return packed_targets.pack(full).reshape(len(codes), len(deltas))
+
+
+def parent_batches(codes, pam_codes, deltas):
+  for start in range(0, len(codes), PARENT_BATCH_SIZE):
+    stop = start + PARENT_BATCH_SIZE
+    yield start, variant_keys(codes[start:stop], pam_codes[start:stop], deltas)
+
+
+def variant_hits(sequences, genome_fasta_name, pam_len=3):
+  """Specificity tier of each variant, and the site it is unique to.
+
+  Unlike guides taken from the genome, a variant need not align anywhere, not
+  even to its parent's site (say, with mismatches in the seed).  Those with no
+  alignment within the loosest threshold have no off-target site either, so
+  they get the top tier.  Otherwise the tier is the first threshold at which
+  the variant aligns exactly once, and that site is returned with it so that
+  it can be checked against the parent's.
+
+  Returns:
+    dict mapping each name to (tier, site), where site is (chrom, start,
+      reverse) in library coordinates, or None if the variant never aligns
+      (or never aligns uniquely, with tier 0).
+  """
+  loosest = build_sgrna_library.SPECIFICITY_TIERS[0]
+  unaligned = build_sgrna_library.unaligned_sequences(
+      sequences, genome_fasta_name, loosest)
+  hits = dict((x, (loosest, None)) for x in unaligned)
+  remaining = dict((k, v) for k, v in sequences.items() if k not in unaligned)
+  for threshold in build_sgrna_library.SPECIFICITY_TIERS:
+    if not remaining:
+      break
+    unique = build_sgrna_library.unique_alignments(
+        remaining, genome_fasta_name, threshold, pam_len)
+    for name, x in unique.items():
+      hits[name] = (threshold, (x.chrom, x.start, x.reverse))
+      del remaining[name]
+  hits.update((x, (0, None)) for x in remaining)
+  return hits
+
+
+def score_variants(keys, site_len, pam_len, genome_fasta_name,
+                   aligner=variant_hits):
+  """Tier and unique site (see variant_hits) of each distinct packed variant.
+
+  Returns:
+    (tiers, sites): int array and list, in the order of keys.
+  """
+  tiers = np.zeros(len(keys), dtype=np.int64)
+  sites = list()
+  for start in range(0, len(keys), SCORE_BATCH_SIZE):
+    batch = keys[start:start + SCORE_BATCH_SIZE]
+    sequences = packed_targets.decode(packed_targets.unpack(batch, site_len))
+    logging.info('Scoring variants {0}-{1} of {2}.'.format(
+        start, start + len(batch), len(keys)))
+    scored = aligner(dict((str(i), x) for i, x in enumerate(sequences)),
+                     genome_fasta_name,
+                     pam_len)
+    for i in range(len(batch)):
+      tiers[start + i], site = scored[str(i)]
+      sites.append(site)
+  return tiers, sites
+
+
+def design_variants(table, genome_fasta_name, output_file, max_mismatches=2,
+                    min_specificity=0, aligner=variant_hits):
+  """Enumerate, score and write the mismatched variants of each guide.
+
+  Each distinct variant (with its parent's PAM) is scored once, however many
+  parents it comes from.  A variant that aligns uniquely somewhere other than
+  its parent's site gets specificity 0 for that parent.  Rows are written in
+  the targets file format, at the parent's locus, followed by the parent
+  protospacer and the changed positions.
+
+  Returns:
+    (distinct, written): number of distinct variants, and of rows written.
+  """
+  codes = packed_targets.encode(table['target'])
+  pam_codes = packed_targets.encode(table['pam'])
+  known = ((codes < packed_targets.UNKNOWN_CODE).all(axis=1) &
+           (pam_codes < packed_targets.UNKNOWN_CODE).all(axis=1))
+  if not known.all():
+    logging.warning('Skipping {0} guides with unknown bases.'.format(
+        (~known).sum()))
+  parents = np.flatnonzero(known)
+  codes = codes[parents]
+  pam_codes = pam_codes[parents]
+  site_len = codes.shape[1] + pam_codes.shape[1]
+  deltas, positions = mismatch_deltas(codes.shape[1], max_mismatches)
+  logging.info('{0} variants for each of {1} guides.'.format(
+      len(deltas), len(parents)))
+  keys = np.unique(np.concatenate(
+      [np.unique(x) for _, x in parent_batches(codes, pam_codes, deltas)]))
+  tiers, sites = score_variants(keys, site_len, pam_codes.shape[1],
+                               genome_fasta_name, aligner)
+  output_file.write(sgrna_target.header(extra_fields=VARIANT_FIELDS) + '\n')
+  mismatches = [str(x.count(',') + 1) for x in positions]
+  written = 0
+  for start, batch in parent_batches(codes, pam_codes, deltas):
+    batch_keys = np.searchsorted(keys, batch)
+    batch_tiers = tiers[batch_keys]
+    variants = packed_targets.decode(packed_targets.unpack(
+        (batch >> np.uint64(2 * pam_codes.shape[1])).ravel(), codes.shape[1]))
+    for i in range(len(batch)):
+      row = parents[start + i]
+      fields = table.rows[row].split('\t')[:10]
+      parent = fields[2]
+      parent_site = (table['chrom'][row], int(table['start'][row]),
+                     bool(table['reverse'][row]))
+      for j in np.flatnonzero(batch_tiers[i] >= min_specificity):
+        tier = batch_tiers[i, j]
+        site = sites[batch_keys[i, j]]
+        if site is not None and site != parent_site:
+          tier = 0
+          if tier < min_specificity:
+            continue
+        fields[2] = variants[i * len(deltas) + j]
+        fields[9] = str(tier)
+        output_file.write('\t'.join(
+            fields + [parent, mismatches[j], positions[j]]) + '\n')
+        written += 1
+  return len(keys), written
+
+
+def parse_args():
+  """Read in the arguments for the mismatch variant design code."""
+  logging.info('Parsing command line.')
+  parser = argparse.ArgumentParser(
+      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument('--genomic_background', type=str, required=True,
+                      help='FASTA genome to check for specificity eval.')
+  parser.add_argument('--input_tsv_file', type=str, required=True,
+                      help='Guides to make variants of, in targets file format.')
+  parser.add_argument('--output_tsv_file', type=str, default=None,
+                      help='Where to write the variants.')
+  parser.add_argument('--max_mismatches', type=int, default=2, choices=(1, 2),
+                      help='Most bases to change in each variant.')
+  parser.add_argument('--min_specificity', type=int, default=0,
+                      help='Only write variants with at least this specificity.')
+  args = parser.parse_args()
+  if args.output_tsv_file is None:
+    base = os.path.splitext(args.input_tsv_file)[0]
+    args.output_tsv_file =  base + '.variants.tsv'
+  return args
+
+
+def main():
+  args = parse_args()
+  logging.info('Reading in targets from {0}'.format(args.input_tsv_file))
+  with library_io.open_input(args.input_tsv_file) as input_file:
+    table = target_table.from_lines(input_file)
+  logging.info('Writing variants to {0}'.format(args.output_tsv_file))
+  with library_io.open_output(args.output_tsv_file) as output_file:
+    distinct, written = design_variants(table,
+                                        args.genomic_background,
+                                        output_file,
+                                        args.max_mismatches,
+                                        args.min_specificity)
+  logging.info('Scored {0} distinct variants; wrote {1}.'.format(
+      distinct, written))
+
+##############################################
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+# Author: John Hawkins (jsh) [really@gmail.com]
+
+import io
+import unittest
+
+import design_mismatch_variants
+from sgrna_target import sgrna_target
+from target_table import target_table
+
+
+PARENT = 'GACTTAGCAGTACCATGCAT'
+# Mismatches in the 12 PAM-proximal bases keep a variant from aligning.
+SEED = range(9, 21)
+# A variant whose closest (and only) site is not its parent's.
+ELSEWHERE = 'TACTTAGCAGTACCATGCAT'
+
+
+def stub_aligner(sequences, genome_fasta_name, pam_len):
+  """Stands in for bowtie, as variant_hits would answer for one parent."""
+  hits = dict()
+  for name, seq in sequences.items():
+    target = seq[:-pam_len]
+    changed = [i + 1 for i, (a, b) in enumerate(zip(target, PARENT)) if a != b]
+    if any(x in SEED for x in changed):
+      hits[name] = (39, None)
+    elif target == ELSEWHERE:
+      hits[name] = (39, ('chr', 500, False))
+    else:
+      hits[name] = (30, ('chr', 100, True))
+  return hits
+
+
+class design_variants_test(unittest.TestCase):
+  def design(self, min_specificity):
+    parent = sgrna_target(PARENT, 'AGG', 'chr', 100, 120, True)
+    parent.specificity = 39
+    table = target_table.from_lines(
+        [sgrna_target.header() + '\n', str(parent) + '\n'])
+    output = io.StringIO()
+    distinct, written = design_mismatch_variants.design_variants(
+        table, 'genome.fna', output, 1, min_specificity, stub_aligner)
+    lines = output.getvalue().splitlines()
+    self.assertEqual(distinct, 60)
+    self.assertEqual(written, len(lines) - 1)
+    return [dict(zip(lines[0].split('\t'), x.split('\t'))) for x in lines[1:]]
+
+  def test_unaligned_seed_variants_are_specific(self):
+    rows = self.design(39)
+    self.assertEqual(len(rows), 36)
+    for row in rows:
+      self.assertIn(int(row['mismatch_positions']), SEED)
+      self.assertEqual(row['specificity'], '39')
+      self.assertEqual(row['parent'], PARENT)
+
+  def test_unique_site_must_be_the_parent(self):
+    rows = dict((x['target'], x) for x in self.design(0))
+    self.assertEqual(len(rows), 60)
+    self.assertEqual(rows[ELSEWHERE]['specificity'], '0')
+    others = [x for x in rows.values()
+              if int(x['mismatch_positions']) not in SEED and
+              x['target'] != ELSEWHERE]
+    self.assertEqual(len(others), 23)
+    self.assertTrue(all(x['specificity'] == '30' for x in others))
+
+
+if __name__ == '__main__':
+  unittest.main()
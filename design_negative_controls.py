@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+
+# Author: John Hawkins (jsh) [really@gmail.com]
+
+import argparse
+import collections
+import logging
+import os.path
+import sys
+
+import numpy as np
+
+import build_sgrna_library
+import genome_kmers
+import guide_features
+import library_io
+import packed_targets
+from sgrna_target import sgrna_target
+from target_table import target_table
+
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s %(levelname)s %(message)s')
+
+class Error(Exception):
+  pass
+
+class SampleError(Error):
+  pass
+
+
+# Controls must not align anywhere within this bowtie -e threshold.
+CONTROL_THRESHOLD = 39
+
+
+def draw_candidates(rng, count, library_codes=None, library_pams=None,
+                    target_len=20):
+  """Draw a batch of candidate control guides.
+
+  With a library, each candidate is a random library guide with its bases
+  shuffled (keeping that guide's PAM); otherwise bases are uniformly random and
+  the PAM is NGG.
+
+  Returns:
+    (codes, pams): (count, target_len) base codes and a list of PAMs.
+  """
+  if library_codes is not None:
+    rows = rng.integers(0, len(library_codes), count)
+    codes = library_codes[rows]
+    order = np.argsort(rng.random(codes.shape), axis=1)
+    codes = np.take_along_axis(codes, order, axis=1)
+    pams = [library_pams[i] for i in rows]
+  else:
+    codes = rng.integers(0, 4, (count, target_len)).astype(np.uint8)
+    pams = [packed_targets.BASES[i] + 'GG' for i in rng.integers(0, 4, count)]
+  return codes, pams
+
+
+def passes_constraints(codes, min_gc, max_gc, max_homopolymer):
+  """Sequence constraints for controls, evaluated for a whole batch."""
+  gc = guide_features.gc_fraction(codes)
+  return ((gc >= min_gc) & (gc <= max_gc) &
+          (guide_features.max_homopolymer(codes) <= max_homopolymer) &
+          ~guide_features.has_poly_t(codes))
+
+
+def design_controls(needed, genome_fasta_name, rng, library_codes=None,
+                    library_pams=None, min_gc=0.0, max_gc=1.0,
+                    max_homopolymer=20, seed_len=12, batch_size=10000,
+                    max_rounds=100):
+  """Generate exactly 'needed' controls with no site in the genome.
+
+  Batches of candidates are filtered on sequence, then on whether their
+  PAM-proximal seed sits next to a PAM anywhere in the genome, and the
+  survivors are screened with bowtie.  This repeats until enough pass.
+
+  Returns:
+    list of (target, pam) pairs.
+  """
+  seed_keys = genome_kmers.seed_pam_keys(genome_fasta_name, seed_len)
+  controls = list()
+  seen = set()
+  for attempt in range(max_rounds):
+    if len(controls) >= needed:
+      break
+    count = max(batch_size, 2 * (needed - len(controls)))
+    codes, pams = draw_candidates(rng, count, library_codes, library_pams)
+    keep = passes_constraints(codes, min_gc, max_gc, max_homopolymer)
+    seeds = packed_targets.pack(codes[:, codes.shape[1] - seed_len:])
+    keep &= ~np.isin(seeds, seed_keys)
+    sequences = collections.OrderedDict()
+    rows = np.flatnonzero(keep)
+    for target, i in zip(packed_targets.decode(codes[rows]), rows):
+      if target in seen:
+        continue
+      seen.add(target)
+      sequences[str(len(sequences))] = (target, pams[i])
+    logging.info('Round {0}: {1} of {2} candidates pass prefilters.'.format(
+        attempt, len(sequences), count))
+    unaligned = build_sgrna_library.unaligned_sequences(
+        dict((k, t + p) for k, (t, p) in sequences.items()),
+        genome_fasta_name,
+        CONTROL_THRESHOLD)
+    controls.extend(x for k, x in sequences.items() if k in unaligned)
+    logging.info('{0} specific controls so far.'.format(len(controls)))
+  if len(controls) < needed:
+    logging.error('Only found {0} of {1} controls in {2} rounds.'.format(
+        len(controls), needed, max_rounds))
+    sys.exit(1)
+  return controls[:needed]
+
+
+def parse_args():
+  """Read in the arguments for the negative control design code."""
+  logging.info('Parsing command line.')
+  parser = argparse.ArgumentParser(
+      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument('--genomic_background', type=str, required=True,
+                      help='FASTA genome to check for specificity eval.')
+  parser.add_argument('--input_tsv_file', type=str, default=None,
+                      help=('[optional] Targets whose base composition to '
+                            'shuffle; uniformly random guides if omitted.'))
+  parser.add_argument('--output_tsv_file', type=str, default=None,
+                      help='Where to write the controls.')
+  parser.add_argument('--needed', type=int, default=100,
+                      help='Number of controls to produce.')
+  parser.add_argument('--seed', type=int, default=None,
+                      help='Random seed, for reproducible controls.')
+  parser.add_argument('--min_gc', type=float, default=0.3,
+                      help='Lowest allowed GC fraction.')
+  parser.add_argument('--max_gc', type=float, default=0.7,
+                      help='Highest allowed GC fraction.')
+  parser.add_argument('--max_homopolymer', type=int, default=4,
+                      help='Longest allowed single-base run.')
+  parser.add_argument('--seed_len', type=int, default=12,
+                      help='PAM-proximal bases that must not occur next to a '
+                           'PAM anywhere in the genome.')
+  parser.add_argument('--batch_size', type=int, default=10000,
+                      help='Candidates drawn per round.')
+  parser.add_argument('--max_rounds', type=int, default=100,
+                      help='Give up after this many rounds.')
+  args = parser.parse_args()
+  if args.output_tsv_file is None:
+    if args.input_tsv_file is None:
+      base = os.path.splitext(args.genomic_background)[0]
+    else:
+      base = os.path.splitext(args.input_tsv_file)[0]
+    args.output_tsv_file =  base + '.controls'
+  return args
+
+
+def main():
+  args = parse_args()
+  library_codes = None
+  library_pams = None
+  if args.input_tsv_file is not None:
+    logging.info('Reading in targets from {0}'.format(args.input_tsv_file))
+    with library_io.open_input(args.input_tsv_file) as input_file:
+      table = target_table.from_lines(input_file)
+    library_codes = packed_targets.encode(table['target'])
+    library_pams = list(table['pam'])
+  rng = np.random.default_rng(args.seed)
+  controls = design_controls(args.needed,
+                             args.genomic_background,
+                             rng,
+                             library_codes,
+                             library_pams,
+                             args.min_gc,
+                             args.max_gc,
+                             args.max_homopolymer,
+                             args.seed_len,
+                             args.batch_size,
+                             args.max_rounds)
+  logging.info('Writing controls to {0}'.format(args.output_tsv_file))
+  with library_io.open_output(args.output_tsv_file) as output_file:
+    output_file.write(sgrna_target.header() + '\n')
+    for target, pam in controls:
+      t = sgrna_target(target, pam, 'control', 0, len(target), False)
+      t.specificity = CONTROL_THRESHOLD
+      output_file.write(str(t) + '\n')
+
+##############################################
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+
+# Author: John Hawkins (jsh) [really@gmail.com]
+
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import logging
+import os
+import os.path
+import sys
+
+import build_sgrna_library
+import guide_features
+from sgrna_target import sgrna_target
+
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s %(levelname)s %(message)s')
+
+class Error(Exception):
+  pass
+
+class SampleError(Error):
+  pass
+
+class JobError(Error):
+  pass
+
+
+# Rows sent before waiting for the client to catch up.
+FLUSH_ROWS = 1000
+
+
+def label_all(*args):
+  """build_sgrna_library.label_targets, collected (for the process pool)."""
+  return list(build_sgrna_library.label_targets(*args))
+
+
+def with_guide_features(targets, restriction_sites, contexts):
+  """guide_features.add_guide_features, also returning the targets it
+  annotated (for the process pool, where they are copies)."""
+  extra_fields = guide_features.add_guide_features(
+      targets, restriction_sites, contexts)
+  return targets, extra_fields
+
+
+class loaded_genome(object):
+  """Everything about one genome that is kept warm between jobs."""
+  def __init__(self, name, fasta_file_name, chrom_lens, target_regions):
+    self.name = name
+    self.fasta_file_name = fasta_file_name
+    self.chrom_lens = chrom_lens
+    self.target_regions = target_regions
+    # Maps sequence with PAM to specificity tier.
+    self.specificity = dict()
+    self.lock = asyncio.Lock()
+
+
+def load_genome(name, genbank_file_names, work_dir):
+  """Prepare, index and annotate a genome for serving."""
+  fasta_file_name, target_regions = (
+      build_sgrna_library.prepare_genome(genbank_file_names, work_dir))
+  build_sgrna_library.build_bowtie_index(fasta_file_name)
+  chrom_lens = build_sgrna_library.chrom_lengths(fasta_file_name)
+  logging.info('Loaded genome {0}: {1} chromosomes, {2} regions.'.format(
+      name, len(chrom_lens), len(target_regions)))
+  return loaded_genome(name, fasta_file_name, chrom_lens, target_regions)
+
+
+class design_service(object):
+  """Serve design and query jobs as JSON lines over a stream socket.
+
+  Each request is one JSON object on one line; replies are JSON lines, ending
+  with one holding "done" (or "error").  CPU-heavy stages (extraction,
+  alignment, labelling) run in a process pool so the service stays responsive.
+
+  The aligner is any picklable callable taking (sequences, genome_fasta_name)
+  and returning a dict of tiers, like build_sgrna_library.specificity_tiers,
+  so a stub can stand in for bowtie.
+  """
+  def __init__(self, genomes, pool,
+               aligner=build_sgrna_library.specificity_tiers,
+               pam='.gg', target_len=20):
+    self.genomes = genomes
+    self.pool = pool
+    self.aligner = aligner
+    self.pam = pam
+    self.target_len = target_len
+    self.jobs = {
+        'design': self.design,
+        'specificity': self.specificity,
+        'genes': self.genes,
+        'status': self.status,
+    }
+
+  def genome(self, request):
+    name = request.get('genome')
+    if name is None and len(self.genomes) == 1:
+      name = next(iter(self.genomes))
+    if name not in self.genomes:
+      raise JobError('Unknown genome: {0}'.format(name))
+    return self.genomes[name]
+
+  async def run(self, function, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(self.pool, function, *args)
+
+  async def score(self, genome, sequences):
+    """Specificity tiers for sequences (with PAM), aligning only new ones."""
+    async with genome.lock:
+      new = dict((x, x) for x in set(sequences) if x not in genome.specificity)
+      if new:
+        logging.info('Scoring {0} new sequences against {1}.'.format(
+            len(new), genome.name))
+        genome.specificity.update(
+            await self.run(self.aligner, new, genome.fasta_file_name))
+    return dict((x, genome.specificity[x]) for x in sequences)
+
+  async def design(self, request, send):
+    """Guides for the requested genes/regions, streamed as targets file rows."""
+    genome = self.genome(request)
+    regions = [build_sgrna_library.parse_region(x)
+               for x in request.get('regions', ())]
+    windows = build_sgrna_library.design_windows(genome.target_regions,
+                                                 request.get('genes', ()),
+                                                 regions,
+                                                 request.get('margin', 100),
+                                                 genome.chrom_lens)
+    targets = await self.run(build_sgrna_library.extract_targets,
+                             genome.fasta_file_name,
+                             self.pam,
+                             self.target_len,
+                             windows)
+    tiers = await self.score(genome,
+                             [t.sequence_with_pam() for t in targets.values()])
+    for t in targets.values():
+      t.specificity = tiers[t.sequence_with_pam()]
+    extra_fields = list()
+    if request.get('features'):
+      targets, extra_fields = await self.run(
+          with_guide_features,
+          targets,
+          request.get('restriction_sites', ()),
+          [('', '')])
+    labelled = await self.run(
+        label_all,
+        targets,
+        build_sgrna_library.overlapping_regions(genome.target_regions, windows),
+        genome.chrom_lens,
+        not request.get('only_include_fully_overlapping', False))
+    await send({'header': sgrna_target.header(extra_fields=extra_fields)})
+    for i, t in enumerate(labelled):
+      await send({'row': str(t)}, flush=(i % FLUSH_ROWS == 0))
+    return {'count': len(labelled)}
+
+  async def specificity(self, request, send):
+    """Tiers for given sequences (protospacer plus PAM)."""
+    genome = self.genome(request)
+    sequences = [x.upper() for x in request.get('sequences', ())]
+    return {'specificity': await self.score(genome, sequences)}
+
+  async def genes(self, request, send):
+    """Annotated regions, optionally only the named genes."""
+    genome = self.genome(request)
+    wanted = set(request.get('genes', ()))
+    for x in genome.target_regions:
+      if not wanted or x[0] in wanted:
+        await send({'region': list(x)}, flush=False)
+    return {}
+
+  async def status(self, request, send):
+    return {'genomes': dict(
+        (name, {'chromosomes': len(g.chrom_lens),
+                'regions': len(g.target_regions),
+                'cached_sequences': len(g.specificity)})
+        for name, g in self.genomes.items())}
+
+  async def handle(self, reader, writer):
+    async def send(message, flush=True):
+      writer.write((json.dumps(message) + '\n').encode())
+      if flush:
+        await writer.drain()
+    try:
+      while True:
+        line = await reader.readline()
+        if not line:
+          break
+        if not line.strip():
+          continue
+        try:
+          request = json.loads(line)
+          job = self.jobs.get(request.get('job'))
+          if job is None:
+            raise JobError('Unknown job: {0}'.format(request.get('job')))
+          result = await job(request, send)
+          result['done'] = True
+          await send(result)
+        except (Error, ValueError, KeyError, AttributeError) as e:
+          await send({'error': str(e)})
+        except SystemExit:
+          # The library code exits on bad input after logging why.
+          await send({'error': 'Job failed; see the service log.'})
+        except ConnectionError:
+          raise
+        except Exception as e:
+          logging.exception('Job failed.')
+          await send({'error': 'Job failed: {0!r}'.format(e)})
+    except ConnectionError:
+      pass
+    finally:
+      writer.close()
+
+
+def parse_genome(x):
+  """(name, [genbank files]) from 'NAME=FILE[,FILE...]'."""
+  if '=' in x:
+    name, files = x.split('=', 1)
+  else:
+    files = x
+    name = os.path.splitext(os.path.basename(x.split(',')[0]))[0]
+  return name, files.split(',')
+
+
+def parse_args():
+  """Read in the arguments for the design service."""
+  logging.info('Parsing command line.')
+  parser = argparse.ArgumentParser(
+      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument('--genome', type=str, action='append', required=True,
+                      help=('GenBank genome to serve, as NAME=FILE[,FILE...] '
+                            '(can be repeated).'))
+  parser.add_argument('--work_dir', type=str, default=None,
+                      help=('[optional] Where to keep derived genome files '
+                            '(default: next to each GenBank file).'))
+  parser.add_argument('--socket', type=str, default=None,
+                      help='[optional] Unix socket to listen on.')
+  parser.add_argument('--host', type=str, default='127.0.0.1',
+                      help='Address to listen on without --socket.')
+  parser.add_argument('--port', type=int, default=8742,
+                      help='Port to listen on without --socket.')
+  parser.add_argument('--processes', type=int, default=None,
+                      help='Worker processes for CPU-heavy stages.')
+  args = parser.parse_args()
+  args.genome = [parse_genome(x) for x in args.genome]
+  return args
+
+
+async def serve(args):
+  genomes = dict()
+  for name, files in args.genome:
+    work_dir = args.work_dir or os.path.dirname(files[0]) or '.'
+    genomes[name] = load_genome(name, files, work_dir)
+  with concurrent.futures.ProcessPoolExecutor(args.processes) as pool:
+    service = design_service(genomes, pool)
+    if args.socket:
+      server = await asyncio.start_unix_server(service.handle, args.socket)
+      logging.info('Listening on {0}'.format(args.socket))
+    else:
+      server = await asyncio.start_server(service.handle, args.host, args.port)
+      logging.info('Listening on {0}:{1}'.format(args.host, args.port))
+    async with server:
+      await server.serve_forever()
+
+
+def main():
+  args = parse_args()
+  try:
+    asyncio.run(serve(args))
+  except KeyboardInterrupt:
+    pass
+
+##############################################
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+# Author: John Hawkins (jsh) [really@gmail.com]
+
+import asyncio
+import concurrent.futures
+import json
+import os.path
+import tempfile
+import unittest
+
+import annotations
+import build_sgrna_library
+import design_service
+
+
+TESTDATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testdata')
+GENOME = os.path.join(TESTDATA, 'rgfptest.fna')
+REGIONS = os.path.join(TESTDATA, 'rgfptest_regions.tsv')
+
+
+def stub_aligner(sequences, genome_fasta_name):
+  """Stands in for bowtie: a made-up tier that depends only on the sequence."""
+  return dict((name, 39 if seq[0] in 'AC' else 11)
+              for name, seq in sequences.items())
+
+
+def failing_aligner(sequences, genome_fasta_name):
+  raise RuntimeError('aligner crashed')
+
+
+class design_service_test(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    cls.pool = concurrent.futures.ProcessPoolExecutor(2)
+
+  @classmethod
+  def tearDownClass(cls):
+    cls.pool.shutdown()
+
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    self.socket = os.path.join(self.tmp.name, 'service.sock')
+
+  def tearDown(self):
+    self.tmp.cleanup()
+
+  def genomes(self):
+    target_regions = annotations.load_regions(REGIONS, use_cache=False)
+    chrom_lens = build_sgrna_library.chrom_lengths(GENOME)
+    return {'rgfp': design_service.loaded_genome(
+        'rgfp', GENOME, chrom_lens, target_regions)}
+
+  def converse(self, requests, aligner=stub_aligner):
+    """Send requests to a fresh service over a socket; replies per request."""
+    async def talk():
+      service = design_service.design_service(self.genomes(), self.pool,
+                                              aligner)
+      server = await asyncio.start_unix_server(service.handle, self.socket)
+      async with server:
+        reader, writer = await asyncio.open_unix_connection(self.socket)
+        replies = list()
+        for request in requests:
+          writer.write((json.dumps(request) + '\n').encode())
+          await writer.drain()
+          lines = list()
+          while True:
+            lines.append(json.loads(await reader.readline()))
+            if 'done' in lines[-1] or 'error' in lines[-1]:
+              break
+          replies.append(lines)
+        writer.close()
+        await writer.wait_closed()
+      return replies
+    return asyncio.run(talk())
+
+  def test_design_streams_labelled_rows(self):
+    [lines] = self.converse([{'job': 'design',
+                              'genes': ['gfp'],
+                              'margin': 0,
+                              'features': True}])
+    header = lines[0]['header'].split('\t')
+    self.assertEqual(header[:3], ['gene', 'offset', 'target'])
+    self.assertIn('gc', header)
+    rows = [dict(zip(header, x['row'].split('\t'))) for x in lines[1:-1]]
+    self.assertEqual(lines[-1], {'count': len(rows), 'done': True})
+    self.assertTrue(rows)
+    for row in rows:
+      self.assertEqual(row['chrom'], 'GFP')
+      self.assertEqual(row['gene'], 'gfp')
+      expected = 39 if row['target'][0] in 'AC' else 11
+      self.assertEqual(int(row['specificity']), expected)
+      self.assertNotEqual(row['gc'], 'None')
+
+  def test_specificity_and_status(self):
+    sequences = ['ATCTTTTTCGGCTTTTTTTAGTA', 'GGTTATCGACAACATTTTCACAT']
+    replies = self.converse([
+        {'job': 'specificity', 'sequences': sequences},
+        {'job': 'specificity', 'sequences': sequences[:1]},
+        {'job': 'status'},
+    ])
+    self.assertEqual(replies[0], [{'specificity': {sequences[0]: 39,
+                                                   sequences[1]: 11},
+                                   'done': True}])
+    self.assertEqual(replies[1][0]['specificity'], {sequences[0]: 39})
+    status = replies[2][0]['genomes']['rgfp']
+    self.assertEqual(status['cached_sequences'], 2)
+    self.assertEqual(status['regions'], 6)
+
+  def test_genes(self):
+    [lines] = self.converse([{'job': 'genes', 'genes': ['Bob']}])
+    self.assertEqual(lines[:-1], [{'region': ['Bob', 'NC_000964.3', 43, 120,
+                                              '-']}])
+
+  def test_errors_are_replies(self):
+    replies = self.converse([
+        {'job': 'nonsense'},
+        {'job': 'design', 'genome': 'missing', 'genes': ['Chuck']},
+        {'job': 'specificity', 'sequences': 5},
+        {'job': 'status'},
+    ])
+    self.assertIn('Unknown job', replies[0][0]['error'])
+    self.assertIn('Unknown genome', replies[1][0]['error'])
+    self.assertIn('TypeError', replies[2][0]['error'])
+    # The connection is still usable afterwards.
+    self.assertTrue(replies[3][0]['done'])
+
+  def test_aligner_failure_is_a_reply(self):
+    [lines] = self.converse([{'job': 'specificity', 'sequences': ['ACGT']}],
+                            failing_aligner)
+    self.assertIn('aligner crashed', lines[0]['error'])
+
+
+if __name__ == '__main__':
+  unittest.main()
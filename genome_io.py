@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+# Author: John Hawkins (jsh) [really@gmail.com]
+
+import logging
+import os
+import os.path
+
+from Bio import SeqIO
+
+import library_io
+
+try:
+  import pysam
+except ImportError:
+  pysam = None
+
+
+FAI_SUFFIX = '.fai'
+GZI_SUFFIX = '.gzi'
+
+
+def _fresh(index_file_name, fasta_file_name):
+  return (os.path.exists(index_file_name) and
+          os.path.getmtime(index_file_name) >=
+          os.path.getmtime(fasta_file_name))
+
+
+def has_fai(fasta_file_name):
+  """Whether the genome has a .fai index at least as new as itself."""
+  return _fresh(fasta_file_name + FAI_SUFFIX, fasta_file_name)
+
+
+def fai_lengths(fasta_file_name):
+  """Map from chrom to sequence length, from the genome's .fai index."""
+  chrom_lens = dict()
+  with open(fasta_file_name + FAI_SUFFIX) as fai_file:
+    for line in fai_file:
+      fields = line.split('\t')
+      chrom_lens[fields[0]] = int(fields[1])
+  return chrom_lens
+
+
+def indexed(fasta_file_name):
+  """Whether regions of the genome can be fetched without reading it all.
+
+  That takes pysam and either an uncompressed FASTA with a .fai index, or a
+  bgzip one.  A bgzip genome is indexed here (.fai and .gzi) if need be;
+  uncompressed genomes are only used as indexed if they already are.
+  """
+  if pysam is None:
+    return False
+  compression = library_io.sniff_compression(fasta_file_name)
+  if compression == '':
+    return has_fai(fasta_file_name)
+  if compression != 'bgzip':
+    return False
+  if not (has_fai(fasta_file_name) and
+          _fresh(fasta_file_name + GZI_SUFFIX, fasta_file_name)):
+    logging.info('Indexing {0} with faidx.'.format(fasta_file_name))
+    pysam.faidx(fasta_file_name)
+  return True
+
+
+def chrom_lengths(fasta_file_name):
+  """Map from chrom to sequence length, from the .fai index if there is one."""
+  if has_fai(fasta_file_name) or indexed(fasta_file_name):
+    return fai_lengths(fasta_file_name)
+  logging.info('Parsing fasta file to check chromosome sizes.')
+  return dict((chrom, len(sequence))
+              for chrom, sequence in records(fasta_file_name))
+
+
+def records(fasta_file_name):
+  """Yield (chrom, sequence) for each entry of a (possibly compressed) FASTA
+  file, read from start to end."""
+  with library_io.open_input(fasta_file_name) as fasta_file:
+    for record in SeqIO.parse(fasta_file, 'fasta'):
+      yield record.name, str(record.seq)
+
+
+def fetch_spans(fasta_file_name, chrom, spans):
+  """[(start, sequence)] of the 0-based, half-open spans of one chrom of an
+  indexed genome; only those bases are read."""
+  with pysam.FastaFile(fasta_file_name) as fasta_file:
+    return [(start, fasta_file.fetch(reference=chrom, start=start, end=end))
+            for start, end in spans]
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+
+# Author: John Hawkins (jsh) [really@gmail.com]
+
+import itertools
+import logging
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+import genome_io
+import packed_targets
+
+
+G_CODE = packed_targets.BASES.index('G')
+
+
+def read_genome_codes(fasta_file_name):
+  """Yield (chrom, codes) for each sequence of a FASTA genome."""
+  for chrom, sequence in genome_io.records(fasta_file_name):
+    yield chrom, packed_targets.encode([sequence])[0]
+
+
+def seed_pam_keys(fasta_file_name, seed_len):
+  """Packed seeds of every NGG-adjacent site on either strand of a genome.
+
+  Args:
+    fasta_file_name [str]:  Genome to index.
+    seed_len [int]:         Bases immediately 5' of the PAM to keep.
+  Returns:
+    keys: sorted, unique uint64 array of packed seeds.
+  """
+  logging.info('Indexing seed+PAM sites of {fasta_file_name}.'.format(
+      **vars()))
+  keys = list()
+  for chrom, codes in read_genome_codes(fasta_file_name):
+    for strand in (codes, packed_targets.revcomp(codes[None, :])[0]):
+      if len(strand) < seed_len + 3:
+        continue
+      # PAM starts at p, with G at p + 1 and p + 2.
+      pam_starts = np.arange(seed_len, len(strand) - 2)
+      is_pam = ((strand[pam_starts + 1] == G_CODE) &
+                (strand[pam_starts + 2] == G_CODE))
+      seeds = sliding_window_view(strand, seed_len)[
+          pam_starts[is_pam] - seed_len]
+      known = (seeds < packed_targets.UNKNOWN_CODE).all(axis=1)
+      keys.append(packed_targets.pack(seeds[known]))
+  if not keys:
+    return np.zeros(0, dtype=np.uint64)
+  return np.unique(np.concatenate(keys))
+
+
+# Seed positions kept by uniqueness_index; 14 bases fill 28 bits.
+UNIQUENESS_SEED_LEN = 14
+# Genome windows keyed at a time.
+KEY_BLOCK_SIZE = 1 << 22
+
+
+def site_weights(phred_string):
+  """Mismatch cost at each position of a protospacer+PAM site.
+
+  Reads are the reverse complement of the site, so the qualities run backwards.
+  """
+  return np.array([ord(x) - 33 for x in phred_string[::-1]], dtype=np.int64)
+
+
+def mismatch_masks(weights, seed_positions, threshold):
+  """XOR masks over packed seeds for every affordable set of mismatches.
+
+  Returns:
+    masks: uint32 array (excluding zero) turning a seed key into each key
+      that differs from it at positions whose costs sum to at most threshold.
+  """
+  seed_len = len(seed_positions)
+  masks = list()
+  def extend(mask, first, budget):
+    for i in range(first, seed_len):
+      cost = weights[seed_positions[i]]
+      if cost > budget:
+        continue
+      shift = 2 * (seed_len - 1 - i)
+      for change in (1, 2, 3):
+        changed = mask | (change << shift)
+        masks.append(changed)
+        extend(changed, i + 1, budget - cost)
+  extend(0, 0, threshold)
+  return np.array(masks, dtype=np.uint32)
+
+
+def seed_keys(codes, seed_positions):
+  """Packed seeds of each row of base codes, and whether all were known."""
+  keys = np.zeros(len(codes), dtype=np.uint32)
+  for p in seed_positions:
+    keys <<= np.uint32(2)
+    keys |= codes[:, p].astype(np.uint32)
+  known = (codes[:, seed_positions] < packed_targets.UNKNOWN_CODE).all(axis=1)
+  return keys, known
+
+
+def key_bits(keys, size):
+  """Bitmap (uint8, little bit order) with the bits of sorted unique keys set."""
+  bitmap = np.zeros(size, dtype=np.uint8)
+  if len(keys):
+    byte = keys >> np.uint32(3)
+    bits = np.left_shift(np.uint8(1), (keys & np.uint32(7)).astype(np.uint8))
+    starts = np.flatnonzero(np.r_[True, byte[1:] != byte[:-1]])
+    bitmap[byte[starts]] = np.bitwise_or.reduceat(bits, starts)
+  return bitmap
+
+
+def test_bits(bitmap, keys):
+  return (bitmap[keys >> np.uint32(3)] >> (keys & np.uint32(7)).astype(
+      np.uint8)) & np.uint8(1) == 1
+
+
+class uniqueness_index(object):
+  """Proves that a protospacer+PAM has no near site elsewhere in a genome.
+
+  The bowtie -e score of an alignment is the summed cost (quality) of its
+  mismatches.  Any site within threshold of a guide therefore matches the
+  guide's seed -- its most costly positions -- up to one of a small set of
+  affordable mismatch combinations.  The index records which seeds occur in
+  the genome (on either strand) and which occur more than once, so a guide
+  whose seed occurs once and none of whose affordable seed variants occur at
+  all can have no site within threshold but its own.
+
+  Only valid for sequences known to occur in the genome.
+  """
+  def __init__(self, fasta_file_name, phred_string, threshold):
+    weights = site_weights(phred_string)
+    self.site_len = len(weights)
+    # Costliest positions first; ties go to the PAM-proximal end.
+    order = np.argsort(-weights[::-1], kind='stable')[:UNIQUENESS_SEED_LEN]
+    self.seed_positions = np.sort(self.site_len - 1 - order)
+    self.masks = mismatch_masks(weights, self.seed_positions, threshold)
+    self._build(fasta_file_name, weights, threshold)
+
+  def _windows(self, fasta_file_name):
+    """Yield blocks of site windows (as base code rows) on both strands."""
+    for chrom, codes in read_genome_codes(fasta_file_name):
+      for strand in (codes, packed_targets.revcomp(codes[None, :])[0]):
+        if len(strand) < self.site_len:
+          continue
+        windows = sliding_window_view(strand, self.site_len)
+        for start in range(0, len(windows), KEY_BLOCK_SIZE):
+          yield windows[start:start + KEY_BLOCK_SIZE]
+
+  def _expand(self, windows, weights, threshold):
+    """Seed keys for windows with unknown bases, taking every base for them.
+
+    Unknown bases count as mismatches, so windows whose unknown seed bases
+    alone cost more than threshold can be left out.
+    """
+    keys = list()
+    for row in windows[:, self.seed_positions]:
+      unknown = np.flatnonzero(row >= packed_targets.UNKNOWN_CODE)
+      if weights[self.seed_positions[unknown]].sum() > threshold:
+        continue
+      for bases in itertools.product(range(4), repeat=len(unknown)):
+        filled = row.copy()
+        filled[unknown] = bases
+        keys.append(seed_keys(filled[None, :], np.arange(len(filled)))[0])
+    if not keys:
+      return np.zeros(0, dtype=np.uint32)
+    return np.concatenate(keys)
+
+  def _build(self, fasta_file_name, weights, threshold):
+    logging.info('Indexing seeds of {fasta_file_name}.'.format(**vars()))
+    size = 1 << (2 * len(self.seed_positions) - 3)
+    self.present = np.zeros(size, dtype=np.uint8)
+    self.repeated = np.zeros(size, dtype=np.uint8)
+    for windows in self._windows(fasta_file_name):
+      keys, known = seed_keys(windows, self.seed_positions)
+      keys = np.concatenate([keys[known],
+                             self._expand(windows[~known], weights, threshold)])
+      keys, counts = np.unique(keys, return_counts=True)
+      block = key_bits(keys, size)
+      self.repeated |= key_bits(keys[counts > 1], size)
+      self.repeated |= self.present & block
+      self.present |= block
+
+  def unique(self, sequences, chunk_size=50000):
+    """Which sequences (protospacer+PAM strings) are proven unique."""
+    proven = np.zeros(len(sequences), dtype=bool)
+    lengths = np.array([len(x) for x in sequences])
+    rows = np.flatnonzero(lengths == self.site_len)
+    for start in range(0, len(rows), chunk_size):
+      chunk = rows[start:start + chunk_size]
+      codes = packed_targets.encode(sequences[i] for i in chunk)
+      keys, known = seed_keys(codes, self.seed_positions)
+      ok = known & test_bits(self.present, keys)
+      ok &= ~test_bits(self.repeated, keys)
+      ok &= ~test_bits(self.present,
+                       keys[:, None] ^ self.masks[None, :]).any(axis=1)
+      # Leave anything with unknown bases to bowtie.
+      ok &= (codes < packed_targets.UNKNOWN_CODE).all(axis=1)
+      proven[chunk] = ok
+    return proven
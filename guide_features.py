@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+# Author: John Hawkins (jsh) [really@gmail.com]
+
+import logging
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+import cut_sites
+import packed_targets
+
+
+# Shortest run of T that terminates Pol III transcription.
+POLY_T_RUN = 4
+
+# Rows processed at a time, to bound the size of intermediate arrays.
+CHUNK_SIZE = 100000
+
+FEATURE_FIELDS = ('gc', 'max_homopolymer', 'poly_t', 'cut_site')
+
+
+def gc_fraction(codes):
+  """Fraction of G or C bases in each row of a base code matrix."""
+  gc = (codes == 1) | (codes == 2)
+  return gc.sum(axis=1) / float(codes.shape[1])
+
+
+def max_homopolymer(codes):
+  """Length of the longest single-base run in each row."""
+  run = np.ones(len(codes), dtype=np.int32)
+  longest = run.copy()
+  for column in range(1, codes.shape[1]):
+    same = codes[:, column] == codes[:, column - 1]
+    run = np.where(same, run + 1, 1)
+    np.maximum(longest, run, out=longest)
+  return longest
+
+
+def has_poly_t(codes, run=POLY_T_RUN):
+  """Whether each row contains a run of at least 'run' T bases."""
+  if codes.shape[1] < run:
+    return np.zeros(len(codes), dtype=bool)
+  windows = sliding_window_view(codes == 3, run, axis=1)
+  return windows.all(axis=2).any(axis=1)
+
+
+def contains_sites(codes, sites, contexts=(('', ''),)):
+  """Whether a site occurs in any of the oligos built around each guide.
+
+  Args:
+    codes [array]:     (n, length) base codes of the guides.
+    sites [list]:      Enzyme names or DNA sites; both strands are checked.
+    contexts [list]:   (front, back) flanks to place around each guide, so that
+                       sites spanning the overhang junctions are found too.
+  Returns:
+    found: bool array, True where some context/site combination matched.
+  """
+  return cut_sites.site_matcher(sites, contexts).any_site(codes)
+
+
+def add_guide_features(targets, sites=(), contexts=(('', ''),)):
+  """Attach sequence features of each protospacer as extra output columns.
+
+  Args:
+    targets: dict of sgrna_targets to annotate (modified in place).
+    sites [list]:     Restriction enzyme names or DNA sites to screen for.
+    contexts [list]:  (front, back) oligo flanks to screen the sites across.
+  Returns:
+    extra_fields: names of the added columns.
+  """
+  logging.info('Computing guide features for {0} targets.'.format(
+      len(targets)))
+  matcher = cut_sites.site_matcher(sites, contexts)
+  array = packed_targets.target_array.from_targets(targets)
+  for start in range(0, len(array), CHUNK_SIZE):
+    codes = array.codes[start:start + CHUNK_SIZE]
+    gc = gc_fraction(codes)
+    homopolymer = max_homopolymer(codes)
+    poly_t = has_poly_t(codes)
+    cut_site = matcher.any_site(codes)
+    for i, t in enumerate(array.targets[start:start + CHUNK_SIZE]):
+      t.extras['gc'] = '{0:.2f}'.format(gc[i])
+      t.extras['max_homopolymer'] = int(homopolymer[i])
+      t.extras['poly_t'] = bool(poly_t[i])
+      t.extras['cut_site'] = bool(cut_site[i])
+  return list(FEATURE_FIELDS)
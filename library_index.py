@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+
+# Author: John Hawkins (jsh) [really@gmail.com]
+
+import argparse
+import logging
+import os
+import os.path
+import sys
+
+from Bio import bgzf
+import numpy as np
+
+import library_io
+from sgrna_target import sgrna_target
+
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s %(levelname)s %(message)s')
+
+class Error(Exception):
+  pass
+
+class SampleError(Error):
+  pass
+
+
+INDEX_SUFFIX = '.index.npz'
+
+COLUMNS = sgrna_target.header().split('\t')
+CHROM_COLUMN = COLUMNS.index('chrom')
+START_COLUMN = COLUMNS.index('start')
+END_COLUMN = COLUMNS.index('end')
+
+
+def file_signature(file_name):
+  info = os.stat(file_name)
+  return '{0}|{1}'.format(info.st_size, info.st_mtime_ns)
+
+
+def is_bgzf(library_file_name):
+  return library_io.sniff_compression(library_file_name) == 'bgzip'
+
+
+def indexable(library_file_name):
+  """Only uncompressed and bgzip files can be read from the middle (and
+  stdout, '-', can't be read at all)."""
+  if library_file_name == '-':
+    return False
+  return library_io.sniff_compression(library_file_name) in ('', 'bgzip')
+
+
+def offset_lines(library_file_name):
+  """(offset, line) of each line, as bytes; offsets are virtual for BGZF."""
+  if is_bgzf(library_file_name):
+    yield from library_io.bgzf_lines(library_file_name)
+    return
+  offset = 0
+  with open(library_file_name, 'rb') as library_file:
+    for line in library_file:
+      yield offset, line
+      offset += len(line)
+
+
+def build_index(library_file_name):
+  """Index a targets file by position, next to it.
+
+  Rows are sorted by (chrom, start); for each, the start, end and offset of
+  its line are stored, with per-chromosome bounds into those arrays.  Offsets
+  are bytes into the file, or BGZF virtual offsets for bgzip files.
+  """
+  if not indexable(library_file_name):
+    logging.error('Only uncompressed or bgzip files can be indexed, '
+                  'not {0}.'.format(library_file_name))
+    sys.exit(1)
+  logging.info('Indexing {0} by position.'.format(library_file_name))
+  chroms = dict()
+  chrom_ids = list()
+  starts = list()
+  ends = list()
+  offsets = list()
+  for offset, line in offset_lines(library_file_name):
+    if not (line.startswith(b'#') or line.startswith(b'gene\t')):
+      fields = line.split(b'\t', END_COLUMN + 1)
+      chrom = fields[CHROM_COLUMN].decode()
+      chrom_ids.append(chroms.setdefault(chrom, len(chroms)))
+      starts.append(int(fields[START_COLUMN]))
+      ends.append(int(fields[END_COLUMN]))
+      offsets.append(offset)
+  chrom_ids = np.array(chrom_ids, dtype=np.int64)
+  starts = np.array(starts, dtype=np.int64)
+  ends = np.array(ends, dtype=np.int64)
+  order = np.lexsort((ends, starts, chrom_ids))
+  bounds = np.searchsorted(chrom_ids[order], np.arange(len(chroms) + 1))
+  np.savez(library_file_name + INDEX_SUFFIX,
+           signature=np.array(file_signature(library_file_name)),
+           chroms=np.array(list(chroms), dtype=str),
+           bounds=bounds,
+           starts=starts[order],
+           ends=ends[order],
+           offsets=np.array(offsets, dtype=np.uint64)[order])
+  return len(order)
+
+
+class library_index(object):
+  """Position lookups over a targets file, using its '.index.npz' sidecar.
+
+  Coordinates are those of the file's start and end columns.  The index is
+  (re)built if it is missing or older than the file.  The file may be
+  uncompressed or bgzip compressed.
+  """
+  def __init__(self, library_file_name):
+    self.library_file_name = library_file_name
+    self.bgzf = is_bgzf(library_file_name)
+    index_name = library_file_name + INDEX_SUFFIX
+    signature = file_signature(library_file_name)
+    if not self._load(index_name, signature):
+      build_index(library_file_name)
+      self._load(index_name, signature)
+
+  def _load(self, index_name, signature):
+    if not os.path.exists(index_name):
+      return False
+    with np.load(index_name, allow_pickle=False) as index:
+      if str(index['signature']) != signature:
+        return False
+      bounds = index['bounds']
+      starts = index['starts']
+      ends = index['ends']
+      offsets = index['offsets']
+      self._chroms = dict()
+      for i, chrom in enumerate(index['chroms'].tolist()):
+        lo, hi = bounds[i], bounds[i + 1]
+        longest = (ends[lo:hi] - starts[lo:hi]).max() if hi > lo else 0
+        self._chroms[chrom] = (starts[lo:hi], ends[lo:hi], offsets[lo:hi],
+                               longest)
+    return True
+
+  def chroms(self):
+    return list(self._chroms)
+
+  def overlapping(self, chrom, start, end):
+    """Offsets of the guides overlapping [start, end), in start order."""
+    if chrom not in self._chroms:
+      return np.zeros(0, dtype=np.uint64)
+    starts, ends, offsets, longest = self._chroms[chrom]
+    lo = np.searchsorted(starts, start - longest, 'left')
+    hi = np.searchsorted(starts, end, 'left')
+    return offsets[lo:hi][ends[lo:hi] > start]
+
+  def nearest(self, chrom, position, count=1):
+    """Offsets of the count guides starting closest to position."""
+    if chrom not in self._chroms:
+      return np.zeros(0, dtype=np.uint64)
+    starts, ends, offsets, longest = self._chroms[chrom]
+    i = np.searchsorted(starts, position)
+    lo = max(i - count, 0)
+    hi = min(i + count, len(starts))
+    distance = np.abs(starts[lo:hi] - position)
+    closest = np.argsort(distance, kind='stable')[:count]
+    return offsets[lo:hi][np.sort(closest)]
+
+  def header(self):
+    """The file's header line (the standard one if it has none)."""
+    with library_io.open_input(self.library_file_name) as library_file:
+      for line in library_file:
+        if line.startswith('gene\t'):
+          return line
+        if not line.startswith('#'):
+          break
+    return sgrna_target.header() + '\n'
+
+  def lines(self, offsets):
+    """The library lines at the given offsets."""
+    if self.bgzf:
+      library_file = bgzf.BgzfReader(self.library_file_name, 'rb')
+    else:
+      library_file = open(self.library_file_name, 'rb')
+    with library_file:
+      for offset in offsets:
+        library_file.seek(int(offset))
+        yield library_file.readline().decode()
+
+
+def parse_locus(x):
+  """(chrom, start, end) from 'CHROM:START-END' or (chrom, pos) from
+  'CHROM:POS'; both inclusive, in the library's coordinates."""
+  try:
+    chrom, span = x.rsplit(':', 1)
+    span = span.replace(',', '')
+    if '-' in span:
+      start, end = span.split('-')
+      return chrom, int(start), int(end) + 1
+    return chrom, int(span)
+  except ValueError:
+    logging.error('Could not parse locus {x}.'.format(**vars()))
+    sys.exit(1)
+
+
+def parse_args():
+  """Read in the arguments for the library position query code."""
+  parser = argparse.ArgumentParser(
+      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument('--library', type=str, required=True,
+                      help='Targets file to query (indexed if needed).')
+  parser.add_argument('--region', type=str, action='append', default=None,
+                      help='CHROM:START-END; print the guides overlapping it '
+                           '(can be repeated).')
+  parser.add_argument('--nearest', type=str, action='append', default=None,
+                      help='CHROM:POS; print the guides starting closest to it '
+                           '(can be repeated).')
+  parser.add_argument('--count', type=int, default=1,
+                      help='How many guides --nearest prints.')
+  args = parser.parse_args()
+  return args
+
+
+def main():
+  args = parse_args()
+  index = library_index(args.library)
+  sys.stdout.write(index.header())
+  for x in args.region or ():
+    chrom, start, end = parse_locus(x)
+    sys.stdout.writelines(index.lines(index.overlapping(chrom, start, end)))
+  for x in args.nearest or ():
+    chrom, position = parse_locus(x)
+    sys.stdout.writelines(index.lines(index.nearest(chrom, position,
+                                                    args.count)))
+
+##############################################
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+
+# Author: John Hawkins (jsh) [really@gmail.com]
+
+import io
+import logging
+import queue
+import struct
+import sys
+import threading
+import zlib
+
+from Bio import bgzf
+
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
+
+# Uncompressed bytes per BGZF block (as bgzip itself writes them).
+BGZF_BLOCK_SIZE = 65280
+# Bytes passed between the caller and the worker thread at a time.
+CHUNK_SIZE = 1 << 20
+# Chunks in flight before the faster side waits for the slower one.
+QUEUE_DEPTH = 8
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+# What to write, by output file suffix.  Plain gzip readers read BGZF, so
+# '.gz' gets bgzip too and stays indexable.
+OUTPUT_SUFFIXES = {
+    '.gz': 'bgzip',
+    '.bgz': 'bgzip',
+    '.zst': 'zstd',
+}
+
+_GZIP_MAGIC = b'\x1f\x8b'
+_ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+def bgzf_block(data, level=GZIP_LEVEL):
+  """One BGZF block: a gzip member carrying its own size in a 'BC' field."""
+  compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+  deflated = compressor.compress(data) + compressor.flush()
+  header = struct.pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6,
+                       66, 67, 2, len(deflated) + 25)
+  return header + deflated + struct.pack('<II', zlib.crc32(data), len(data))
+
+BGZF_EOF = bgzf_block(b'')
+
+
+def output_compression(file_name):
+  """Compression to write file_name with, from its suffix ('' for none)."""
+  for suffix, compression in OUTPUT_SUFFIXES.items():
+    if file_name.endswith(suffix):
+      return compression
+  return ''
+
+
+def sniff_compression(file_name):
+  """'bgzip', 'gzip', 'zstd' or '' (none), from a file's first bytes."""
+  with open(file_name, 'rb') as handle:
+    head = handle.read(18)
+  if head.startswith(_ZSTD_MAGIC):
+    return 'zstd'
+  if head.startswith(_GZIP_MAGIC):
+    if len(head) == 18 and head[3] & 4 and head[12:14] == b'BC':
+      return 'bgzip'
+    return 'gzip'
+  return ''
+
+
+def require_zstandard():
+  if zstandard is None:
+    logging.error('Reading or writing .zst files needs the zstandard package.')
+    sys.exit(1)
+
+
+class compressed_writer(io.RawIOBase):
+  """Binary file that compresses on a background thread.
+
+  write() only queues the bytes; the worker compresses and writes them, so
+  compression overlaps whatever the caller does between writes (zlib and
+  zstd release the GIL while they work).
+  """
+  def __init__(self, file_name, compression):
+    super().__init__()
+    if compression == 'zstd':
+      require_zstandard()
+    self._file = open(file_name, 'wb')
+    self._compression = compression
+    self._queue = queue.Queue(QUEUE_DEPTH)
+    self._finished = False
+    self._error = None
+    self._thread = threading.Thread(target=self._work, daemon=True)
+    self._thread.start()
+
+  def writable(self):
+    return True
+
+  def write(self, data):
+    if self._error is not None:
+      raise self._error
+    self._queue.put(bytes(data))
+    return len(data)
+
+  def close(self):
+    if self.closed:
+      return
+    self._queue.put(None)
+    self._thread.join()
+    self._file.close()
+    super().close()
+    if self._error is not None:
+      raise self._error
+
+  def _chunks(self):
+    while not self._finished:
+      data = self._queue.get()
+      if data is None:
+        self._finished = True
+      else:
+        yield data
+
+  def _work(self):
+    try:
+      if self._compression == 'bgzip':
+        self._write_bgzf()
+      else:
+        self._write_zstd()
+    except Exception as e:
+      self._error = e
+      # Keep taking writes so the caller notices rather than hangs.
+      for _ in self._chunks():
+        pass
+
+  def _write_bgzf(self):
+    pending = bytearray()
+    for data in self._chunks():
+      pending += data
+      full = len(pending) - len(pending) % BGZF_BLOCK_SIZE
+      for i in range(0, full, BGZF_BLOCK_SIZE):
+        self._file.write(bgzf_block(pending[i:i + BGZF_BLOCK_SIZE]))
+      del pending[:full]
+    if pending:
+      self._file.write(bgzf_block(pending))
+    self._file.write(BGZF_EOF)
+
+  def _write_zstd(self):
+    compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    for data in self._chunks():
+      self._file.write(compressor.compress(data))
+    self._file.write(compressor.flush())
+
+
+class decompressed_reader(io.RawIOBase):
+  """Binary view of a compressed file, decompressed ahead on a thread."""
+  def __init__(self, file_name, compression):
+    super().__init__()
+    if compression == 'zstd':
+      require_zstandard()
+    self._file = open(file_name, 'rb')
+    self._compression = compression
+    self._queue = queue.Queue(QUEUE_DEPTH)
+    self._stop = threading.Event()
+    self._pending = memoryview(b'')
+    self._eof = False
+    self._thread = threading.Thread(target=self._work, daemon=True)
+    self._thread.start()
+
+  def readable(self):
+    return True
+
+  def readinto(self, buffer):
+    while not self._pending and not self._eof:
+      data = self._queue.get()
+      if isinstance(data, Exception):
+        self._eof = True
+        raise data
+      if data is None:
+        self._eof = True
+      else:
+        self._pending = memoryview(data)
+    n = min(len(buffer), len(self._pending))
+    buffer[:n] = self._pending[:n]
+    self._pending = self._pending[n:]
+    return n
+
+  def close(self):
+    if self.closed:
+      return
+    self._stop.set()
+    while self._thread.is_alive():
+      try:
+        self._queue.get(timeout=0.1)
+      except queue.Empty:
+        pass
+    self._file.close()
+    super().close()
+
+  def _work(self):
+    try:
+      if self._compression == 'zstd':
+        chunks = self._read_zstd()
+      else:
+        chunks = self._read_gzip()
+      for data in chunks:
+        if self._stop.is_set():
+          return
+        self._queue.put(data)
+      self._queue.put(None)
+    except Exception as e:
+      self._queue.put(e)
+
+  def _read_gzip(self):
+    # Concatenated members (as in BGZF) are read one after another.
+    decompressor = zlib.decompressobj(31)
+    # Whether the current member has been given any input.
+    started = False
+    for raw in iter(lambda: self._file.read(CHUNK_SIZE), b''):
+      while raw:
+        started = True
+        data = decompressor.decompress(raw)
+        if data:
+          yield data
+        if decompressor.eof:
+          raw = decompressor.unused_data
+          decompressor = zlib.decompressobj(31)
+          started = False
+        else:
+          raw = b''
+    if started:
+      raise EOFError('{0} is truncated.'.format(self._file.name))
+
+  def _read_zstd(self):
+    reader = zstandard.ZstdDecompressor().stream_reader(
+        self._file, read_across_frames=True)
+    for data in iter(lambda: reader.read(CHUNK_SIZE), b''):
+      yield data
+
+
+def open_input(file_name):
+  """Open a targets file for text reading, whatever its compression.
+
+  '-' is stdin.  Compressed files are decompressed on a background thread.
+  """
+  if file_name == '-':
+    return sys.stdin
+  compression = sniff_compression(file_name)
+  if not compression:
+    return open(file_name)
+  return io.TextIOWrapper(
+      io.BufferedReader(decompressed_reader(file_name, compression),
+                        CHUNK_SIZE))
+
+
+def open_output(file_name):
+  """Open a targets file for text writing, compressed as its suffix says.
+
+  '-' is stdout, which stays open when the returned file is closed.
+  Compressed files are compressed on a background thread.
+  """
+  if file_name == '-':
+    sys.stdout.flush()
+    return open(sys.stdout.fileno(), 'w', buffering=CHUNK_SIZE, closefd=False)
+  compression = output_compression(file_name)
+  if not compression:
+    return open(file_name, 'w', buffering=CHUNK_SIZE)
+  return io.TextIOWrapper(
+      io.BufferedWriter(compressed_writer(file_name, compression), CHUNK_SIZE))
+
+
+def bgzf_blocks(handle):
+  """(file offset, data) of each non-empty block of an open BGZF file."""
+  while True:
+    offset = handle.tell()
+    header = handle.read(18)
+    if not header:
+      return
+    if (len(header) < 18 or not header.startswith(_GZIP_MAGIC) or
+        header[12:14] != b'BC'):
+      raise ValueError('No BGZF block at offset {0}.'.format(offset))
+    size = struct.unpack('<H', header[16:18])[0] + 1
+    data = zlib.decompress(handle.read(size - 18)[:-8], -15)
+    if data:
+      yield offset, data
+
+
+def bgzf_lines(file_name):
+  """(virtual offset, line) of each line of a BGZF file, as bytes.
+
+  A virtual offset is the line's block offset in the file, shifted up 16
+  bits, plus its offset within the block's data; BgzfReader.seek() takes it.
+  """
+  carry = b''
+  carry_offset = None
+  with open(file_name, 'rb') as handle:
+    for offset, data in bgzf_blocks(handle):
+      start = 0
+      end = data.find(b'\n')
+      while end >= 0:
+        if carry_offset is None:
+          yield bgzf.make_virtual_offset(offset, start), data[start:end + 1]
+        else:
+          yield carry_offset, carry + data[start:end + 1]
+          carry = b''
+          carry_offset = None
+        start = end + 1
+        end = data.find(b'\n', start)
+      if start < len(data):
+        if carry_offset is None:
+          carry_offset = bgzf.make_virtual_offset(offset, start)
+        carry += data[start:]
+  if carry_offset is not None:
+    yield carry_offset, carry
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+# Author: John Hawkins (jsh) [really@gmail.com]
+
+import bisect
+import collections
+import re
+
+import numpy as np
+
+
+REPORT_FIELDS = ('target', 'pam', 'chrom', 'start', 'end', 'specificity',
+                 'rank', 'off_chrom', 'off_start', 'off_end', 'off_dir',
+                 'mismatches', 'mismatch_positions', 'off_gene')
+
+_MD_TOKEN = re.compile(r'(\d+)|\^[A-Z]+|([A-Z])')
+
+
+def mismatch_offsets(md):
+  """0-based offsets (along the reference) of the mismatches in an MD tag."""
+  offsets = list()
+  at = 0
+  for run, base in _MD_TOKEN.findall(md):
+    if run:
+      at += int(run)
+    elif base:
+      offsets.append(at)
+      at += 1
+  return offsets
+
+
+class alignment(object):
+  """One place a guide (protospacer+PAM) aligns, in library coordinates."""
+  def __init__(self, chrom, start, end, reverse, mismatch_positions):
+    self.chrom = chrom
+    self.start = start
+    self.end = end
+    self.reverse = reverse
+    # 1-based positions within protospacer+PAM.
+    self.mismatch_positions = mismatch_positions
+
+
+def parse_alignment(fields, site_len, pam_len):
+  """alignment from the fields of a mapped SAM record of a faked read.
+
+  Reads are reverse complemented sites, so a read on the reverse strand means
+  the site reads forward, and vice versa.
+  """
+  flag = int(fields[1])
+  pos = int(fields[3])
+  md = ''
+  for tag in fields[11:]:
+    if tag.startswith('MD:Z:'):
+      md = tag[5:]
+      break
+  offsets = mismatch_offsets(md)
+  if flag & 16:
+    positions = [x + 1 for x in offsets]
+    return alignment(fields[2], pos, pos + site_len - pam_len, False, positions)
+  positions = sorted(site_len - x for x in offsets)
+  return alignment(fields[2], pos + pam_len, pos + site_len, True, positions)
+
+
+class off_target_report(object):
+  """Collects the alignments of non-unique reads while tiers are assigned.
+
+  Used for the first (loosest) specificity pass, which is then run with
+  'bowtie -k top_k+1' rather than '-m 1': a read is unique exactly when one
+  alignment comes back, and otherwise its best alignments are kept.
+  """
+  def __init__(self, top_k, site_len=23, pam_len=3):
+    self.top_k = top_k
+    self.site_len = site_len
+    self.pam_len = pam_len
+    # Maps read name to its alignments, best first.
+    self.hits = dict()
+
+  def alignments_wanted(self):
+    # One for the guide's own site, top_k for everything else.
+    return max(self.top_k + 1, 2)
+
+  def read_sam(self, sam_name):
+    """Keep the alignments of reads aligning more than once.
+
+    Returns:
+      ids: integer names of the reads that aligned exactly once.
+    """
+    per_read = collections.OrderedDict()
+    with open(sam_name) as sam_file:
+      for x in sam_file:
+        if x.startswith('@'):
+          continue
+        fields = x.rstrip('\n').split('\t')
+        if int(fields[1]) & 4:
+          continue
+        per_read.setdefault(int(fields[0]), list()).append(fields)
+    unique = list()
+    for read, records in per_read.items():
+      if len(records) == 1:
+        unique.append(read)
+      else:
+        self.hits[read] = [parse_alignment(x, self.site_len, self.pam_len)
+                           for x in records]
+    return np.array(unique, dtype=np.int64)
+
+  def rename(self, names):
+    """Swap integer read names for names[i]."""
+    self.hits = dict((names[i], x) for i, x in self.hits.items())
+
+
+class gene_lookup(object):
+  """Finds the regions (as used by label_targets) overlapping a locus."""
+  def __init__(self, target_regions, allow_partial_overlap=True):
+    self.allow_partial_overlap = allow_partial_overlap
+    per_chrom = collections.defaultdict(list)
+    for gene, chrom, start, end, strand in target_regions:
+      per_chrom[chrom].append((start, end, gene))
+    self._regions = dict()
+    for chrom, regions in per_chrom.items():
+      regions.sort()
+      longest = max(e - s for s, e, _ in regions)
+      self._regions[chrom] = ([x[0] for x in regions], regions, longest)
+
+  def genes(self, chrom, start, end):
+    """Names of the regions a target at [start, end) overlaps (or, without
+    allow_partial_overlap, lies entirely within)."""
+    if chrom not in self._regions:
+      return list()
+    starts, regions, longest = self._regions[chrom]
+    lo = bisect.bisect_left(starts, start - longest)
+    if self.allow_partial_overlap:
+      hi = bisect.bisect_left(starts, end)
+    else:
+      hi = bisect.bisect_right(starts, start)
+    found = list()
+    for s, e, gene in regions[lo:hi]:
+      if self.allow_partial_overlap:
+        hit = e > start
+      else:
+        hit = end <= e
+      if hit and gene not in found:
+        found.append(gene)
+    return found
+
+
+def write_report(report_file, targets, hits, target_regions, top_k,
+                 below_tier=40, allow_partial_overlap=True):
+  """Write the off-target loci of each guide as TSV.
+
+  Args:
+    report_file:              Open file for the report.
+    targets [iterable]:       sgrna_targets to report on.
+    hits [dict]:              Maps sequence with PAM to alignments, best first.
+    target_regions [list]:    (gene, chrom, start, end, strand) annotations.
+    top_k [int]:              Off-target loci to list per guide.
+    below_tier [int]:         Only report guides with lower specificity.
+    allow_partial_overlap:    Name genes the locus only partly overlaps.
+  Returns:
+    number of off-target loci written.
+  """
+  lookup = gene_lookup(target_regions, allow_partial_overlap)
+  report_file.write('\t'.join(REPORT_FIELDS) + '\n')
+  written = 0
+  for t in targets:
+    if t.specificity >= below_tier:
+      continue
+    own = (t.chrom, t.start, t.reverse)
+    others = [x for x in hits.get(t.sequence_with_pam(), ())
+              if (x.chrom, x.start, x.reverse) != own]
+    for rank, x in enumerate(others[:top_k], 1):
+      genes = lookup.genes(x.chrom, x.start, x.end)
+      row = [t.target, t.pam, t.chrom, t.start, t.end, t.specificity,
+             rank, x.chrom, x.start, x.end, 'rev' if x.reverse else 'fwd',
+             len(x.mismatch_positions),
+             ','.join(str(p) for p in x.mismatch_positions) or '-',
+             ','.join(genes) or None]
+      report_file.write('\t'.join(str(v) for v in row) + '\n')
+      written += 1
+  return written
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+# Author: John Hawkins (jsh) [really@gmail.com]
+
+import numpy as np
+
+
+BASES = 'ACGT'
+# Code used for anything other than A, C, G or T.
+UNKNOWN_CODE = 4
+
+BASE_CODES = np.full(256, UNKNOWN_CODE, dtype=np.uint8)
+for code, base in enumerate(BASES):
+  BASE_CODES[ord(base)] = code
+  BASE_CODES[ord(base.lower())] = code
+CODE_BASES = np.frombuffer(b'ACGTN', dtype=np.uint8)
+
+
+def encode(sequences):
+  """Encode equal-length DNA strings as a matrix of base codes.
+
+  Args:
+    sequences [iterable of str]:  DNA sequences, all of the same length.
+  Returns:
+    codes: (n, length) uint8 array, A/C/G/T as 0-3 and anything else as 4.
+  """
+  sequences = list(sequences)
+  if not sequences:
+    return np.zeros((0, 0), dtype=np.uint8)
+  length = len(sequences[0])
+  raw = np.frombuffer(''.join(sequences).encode('ascii'), dtype=np.uint8)
+  if raw.size != length * len(sequences):
+    raise ValueError('Sequences must all have the same length.')
+  return BASE_CODES[raw].reshape(len(sequences), length)
+
+
+def decode(codes):
+  """Inverse of encode(); returns a list of DNA strings."""
+  codes = np.asarray(codes)
+  if codes.size == 0:
+    return [''] * len(codes)
+  raw = np.ascontiguousarray(CODE_BASES[codes])
+  rows = raw.view('S{0}'.format(codes.shape[1])).ravel()
+  return [x.decode('ascii') for x in rows]
+
+
+def complement(codes):
+  """Complement base codes, leaving unknown bases alone."""
+  return np.where(codes < UNKNOWN_CODE, 3 - codes, codes).astype(np.uint8)
+
+
+def revcomp(codes):
+  """Reverse complement each row of a base code matrix."""
+  return complement(codes)[:, ::-1]
+
+
+def pack(codes):
+  """Pack each row of base codes (at most 32 wide) into one uint64.
+
+  The first base ends up in the most significant bits, so packed values sort in
+  the same order as the sequences.  Unknown bases are not representable, so
+  callers must exclude them first.
+  """
+  codes = np.asarray(codes)
+  if codes.shape[1] > 32:
+    raise ValueError('Cannot pack more than 32 bases into 64 bits.')
+  packed = np.zeros(len(codes), dtype=np.uint64)
+  for column in range(codes.shape[1]):
+    packed <<= np.uint64(2)
+    packed |= codes[:, column].astype(np.uint64)
+  return packed
+
+
+def unpack(packed, length):
+  """Inverse of pack() for rows of the given length."""
+  packed = np.asarray(packed, dtype=np.uint64)
+  codes = np.zeros((len(packed), length), dtype=np.uint8)
+  for column in range(length):
+    shift = np.uint64(2 * (length - 1 - column))
+    codes[:, column] = (packed >> shift) & np.uint64(3)
+  return codes
+
+
+_LOW_BITS = np.uint64(0x5555555555555555)
+_BYTE_POPCOUNT = np.array([bin(i).count('1') for i in range(256)],
+                          dtype=np.uint8)
+
+def popcount(values):
+  """Number of set bits in each uint64."""
+  values = np.asarray(values, dtype=np.uint64)
+  if hasattr(np, 'bitwise_count'):
+    return np.bitwise_count(values).astype(np.int64)
+  as_bytes = values.reshape(-1, 1).view(np.uint8)
+  counts = _BYTE_POPCOUNT[as_bytes].sum(axis=1).astype(np.int64)
+  return counts.reshape(values.shape)
+
+
+def mismatches(packed_a, packed_b):
+  """Number of differing bases between packed sequences (broadcasting)."""
+  diff = np.bitwise_xor(packed_a, packed_b)
+  return popcount((diff | (diff >> np.uint64(1))) & _LOW_BITS)
+
+
+class target_array(object):
+  """Column-oriented view of a collection of sgrna_targets.
+
+  Row i of every array describes targets[names[i]].
+  """
+  def __init__(self, names, targets, codes):
+    self.names = names
+    self.targets = targets
+    self.codes = codes
+
+  @classmethod
+  def from_targets(cls, targets):
+    """Build from a dict mapping target name to sgrna_target.
+
+    codes holds the protospacer only (no PAM).
+    """
+    names = list(targets)
+    rows = [targets[x] for x in names]
+    codes = encode(x.target for x in rows)
+    return target_array(names, rows, codes)
+
+  def __len__(self):
+    return len(self.names)
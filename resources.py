@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+
+# Author: John Hawkins (jsh) [really@gmail.com]
+
+import collections
+import glob
+import logging
+import multiprocessing
+import os
+import os.path
+import re
+import subprocess
+
+
+MB = 1 << 20
+# bowtie's --chunkmbs (per thread, for --best) when memory allows.
+DEFAULT_CHUNKMBS = 256
+MIN_CHUNKMBS = 32
+# Cores each extra concurrent bowtie process should get, at least.
+THREADS_PER_JOB = 4
+# Smallest shard worth a bowtie process of its own.
+MIN_SHARD_READS = 10000
+# Rough bowtie memory per read in flight: input and output buffers.
+BOWTIE_BYTES_PER_READ = 1024
+# Fraction of the budget above which running jobs are backed off.
+HIGH_WATER = 0.9
+POLL_SECONDS = 0.2
+
+_SIZE = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*([kmgt]?)i?b?\s*$', re.IGNORECASE)
+
+
+def parse_size(x):
+  """Bytes from a size like '512M', '16G' or '1048576'."""
+  match = _SIZE.match(x)
+  if not match:
+    raise ValueError('Not a size: {0}'.format(x))
+  number, unit = match.groups()
+  return int(float(number) * 1024 ** ' kmgt'.index(unit.lower() or ' '))
+
+
+def available_cores():
+  """Cores this process may run on (fewer than the machine's if pinned)."""
+  try:
+    return len(os.sched_getaffinity(0))
+  except AttributeError:
+    return multiprocessing.cpu_count()
+
+
+def process_rss(pid):
+  """Resident set size of a process in bytes (0 if gone or unknown)."""
+  try:
+    with open('/proc/{0}/status'.format(pid)) as status:
+      for line in status:
+        if line.startswith('VmRSS:'):
+          return int(line.split()[1]) * 1024
+  except OSError:
+    pass
+  return 0
+
+
+def child_pids(pid):
+  children = list()
+  for name in glob.glob('/proc/{0}/task/*/children'.format(pid)):
+    try:
+      with open(name) as children_file:
+        children.extend(int(x) for x in children_file.read().split())
+    except OSError:
+      pass
+  return children
+
+
+def tree_rss(pid):
+  """RSS of a process and all its descendants (bowtie may be a wrapper)."""
+  return process_rss(pid) + sum(tree_rss(x) for x in child_pids(pid))
+
+
+def index_size(index_name):
+  """Bytes of a bowtie index, which each bowtie process loads in full."""
+  return sum(os.path.getsize(x)
+             for pattern in ('.*.ebwt', '.*.ebwtl')
+             for x in glob.glob(glob.escape(index_name) + pattern))
+
+
+class shard_plan(object):
+  """How one batch of reads is to be aligned."""
+  def __init__(self, label, reads, jobs, threads, chunkmbs, shard_reads,
+               job_bytes):
+    self.label = label
+    self.reads = reads
+    self.jobs = jobs
+    self.threads = threads
+    self.chunkmbs = chunkmbs
+    self.shard_reads = shard_reads
+    # Estimated peak RSS of one bowtie process; None with no budget.
+    self.job_bytes = job_bytes
+    # Filled in by resource_controller.run().
+    self.shards = 0
+    self.peak_bytes = 0
+    self.job_peak_bytes = 0
+    self.backoffs = 0
+
+  def shards_of(self, rows):
+    """rows cut into shards of at most shard_reads."""
+    count = max(1, -(-len(rows) // self.shard_reads))
+    return [rows[i * len(rows) // count:(i + 1) * len(rows) // count]
+            for i in range(count)]
+
+  def metrics(self):
+    return dict(vars(self))
+
+
+class resource_controller(object):
+  """Fits alignment to a memory and core budget.
+
+  For each batch of reads, plan() picks bowtie's threads and --chunkmbs, how
+  many bowtie processes run at once and how many reads each one gets, from
+  the index size, the read count and what this process already holds.
+  Threads are preferred to processes, since threads share one copy of the
+  index.  run() then starts the shards as memory allows, watching the RSS of
+  this process and its children and raising its per-job estimate to the
+  largest job seen so far.  Near the budget it stops the newest job,
+  requeues its reads as two smaller shards and runs fewer jobs at once.
+
+  With no max_memory, every batch is one bowtie process using every core.
+  """
+  def __init__(self, max_memory=None, max_cores=None):
+    self.max_memory = max_memory
+    self.max_cores = max_cores or available_cores()
+    # Lowered when a lone job gets near the budget.
+    self.shard_cap = None
+    self.plans = list()
+
+  def usage(self):
+    return tree_rss(os.getpid())
+
+  def plan(self, label, index_name, reads, bytes_per_read=0):
+    """Decide how to align reads against a bowtie index.
+
+    Args:
+      label [str]:           Names the batch in logs and metrics.
+      index_name [str]:      bowtie index base name.
+      reads [int]:           How many reads there are.
+      bytes_per_read [int]:  What this process will hold per read while the
+                             results are read back.
+    Returns:
+      shard_plan
+    """
+    cores = self.max_cores
+    if self.max_memory is None:
+      plan = shard_plan(label, reads, 1, cores, DEFAULT_CHUNKMBS,
+                        max(reads, 1), None)
+    else:
+      budget = self.max_memory - self.usage()
+      index_bytes = index_size(index_name)
+      per_read = BOWTIE_BYTES_PER_READ + bytes_per_read
+      def job_fixed(threads, chunkmbs):
+        return index_bytes + chunkmbs * MB * threads
+      def job_threads(jobs):
+        return min(threads, max(1, cores // jobs))
+      # Fixed costs get half the budget at most; reads get the rest.  Smaller
+      # chunks are tried before fewer threads.
+      chunkmbs = DEFAULT_CHUNKMBS
+      threads = cores
+      while (chunkmbs > MIN_CHUNKMBS and
+             job_fixed(threads, chunkmbs) > budget / 2):
+        chunkmbs //= 2
+      while threads > 1 and job_fixed(threads, chunkmbs) > budget / 2:
+        threads -= 1
+      most_jobs = max(1, min(cores // THREADS_PER_JOB,
+                             -(-reads // MIN_SHARD_READS)))
+      jobs = 1
+      while (jobs < most_jobs and
+             (jobs + 1) * job_fixed(job_threads(jobs + 1), chunkmbs) <=
+             budget / 2):
+        jobs += 1
+      threads = job_threads(jobs)
+      fixed = job_fixed(threads, chunkmbs)
+      room = budget - jobs * fixed
+      shard_reads = max(MIN_SHARD_READS, room // (jobs * per_read))
+      shard_reads = min(shard_reads, max(1, -(-reads // jobs)))
+      if self.shard_cap is not None:
+        shard_reads = min(shard_reads, self.shard_cap)
+      if room < jobs * shard_reads * per_read:
+        logging.warning('Aligning {0} may not fit in {1} MB.'.format(
+            label, self.max_memory // MB))
+      plan = shard_plan(label, reads, jobs, threads, chunkmbs, shard_reads,
+                        fixed + shard_reads * BOWTIE_BYTES_PER_READ)
+    logging.info(
+        '{0}: {1} reads in shards of up to {2}, {3} at a time, '
+        '{4} threads each, --chunkmbs {5}.'.format(
+            label, reads, plan.shard_reads, plan.jobs, plan.threads,
+            plan.chunkmbs))
+    self.plans.append(plan)
+    return plan
+
+  def run(self, plan, rows, start, finish):
+    """Align rows in shards, a few at a time, within the budget.
+
+    Args:
+      plan:           From plan().
+      rows [array]:   What to align; cut into shards.
+      start:          Called with a shard's rows; returns an object with
+                      those .rows, the subprocess.Popen aligning them as
+                      .job, and a .discard() that removes its files.
+      finish:         Called with that object once its job has ended
+                      (unless it was stopped to back off).
+
+    If finish raises (say, because a job failed), the jobs still running are
+    stopped and their files discarded before the error propagates.
+    """
+    running = list()
+    try:
+      self._run(plan, rows, start, finish, running)
+    except BaseException:
+      for x in running:
+        if x.job.poll() is None:
+          x.job.terminate()
+        x.job.wait()
+        x.discard()
+      raise
+
+  def _run(self, plan, rows, start, finish, running):
+    pending = collections.deque(plan.shards_of(rows))
+    plan.shards = len(pending)
+    jobs = plan.jobs
+    job_bytes = plan.job_bytes
+    while pending or running:
+      while pending and len(running) < jobs:
+        if (running and job_bytes is not None and
+            self.usage() + job_bytes > self.max_memory):
+          break
+        running.append(start(pending.popleft()))
+      try:
+        running[0].job.wait(timeout=POLL_SECONDS)
+      except subprocess.TimeoutExpired:
+        pass
+      usage = self.usage()
+      plan.peak_bytes = max(plan.peak_bytes, usage)
+      for x in running:
+        plan.job_peak_bytes = max(plan.job_peak_bytes, tree_rss(x.job.pid))
+      if job_bytes is not None:
+        # Trust what jobs have really used over the estimate.
+        job_bytes = max(job_bytes, plan.job_peak_bytes)
+      for x in list(running):
+        if x.job.poll() is not None:
+          # Left in running until finished, so a failure cleans it up too.
+          finish(x)
+          running.remove(x)
+      if self.max_memory is None or usage <= self.max_memory * HIGH_WATER:
+        continue
+      if len(running) > 1:
+        newest = running.pop()
+        newest.job.terminate()
+        newest.job.wait()
+        newest.discard()
+        rows = newest.rows
+        pieces = [x for x in (rows[len(rows) // 2:], rows[:len(rows) // 2])
+                  if len(x)]
+        pending.extendleft(pieces)
+        plan.shards += len(pieces) - 1
+        jobs = max(1, len(running))
+        plan.backoffs += 1
+        logging.warning('{0}: near the memory budget ({1} MB); requeued a '
+                        'shard and now running {2} at a time.'.format(
+                            plan.label, usage // MB, jobs))
+      elif running and (self.shard_cap is None or
+                        self.shard_cap > MIN_SHARD_READS):
+        self.shard_cap = max(MIN_SHARD_READS, len(running[0].rows) // 2)
+        plan.backoffs += 1
+        logging.warning('{0}: near the memory budget ({1} MB) with one job; '
+                        'later shards get at most {2} reads.'.format(
+                            plan.label, usage // MB, self.shard_cap))
+
+  def metrics(self):
+    """Every decision so far, for the run metrics."""
+    return {
+        'max_memory': self.max_memory,
+        'max_cores': self.max_cores,
+        'peak_bytes': max([x.peak_bytes for x in self.plans] or [0]),
+        'alignments': [x.metrics() for x in self.plans],
+    }
@@ -95,13 +95,20 @@ class sgrna_target(object):
     self.reverse = bool_from_rev(reverse)
     self.sense_strand = None
     self.specificity = 0
+    # Optional trailing output columns, in column order.
+    self.extras = collections.OrderedDict()
 
   @classmethod
-  def from_tsv(cls, tsv, sep='\t'):
+  def from_tsv(cls, tsv, sep='\t', extra_fields=()):
     """Alternate factory constructor from serialized sgrna_target string.
 
     Intended for reading back in the result of sgrna_target.__str__()
+
+    Any columns beyond the standard ones are kept in t.extras, keyed by the
+    corresponding name in extra_fields (or by column number if unnamed), so
+    that they survive being written back out.
     """
+    fields = tsv.strip().split(sep)
     (gene,
      offset,
      target,
@@ -111,16 +118,21 @@ class sgrna_target(object):
      end,
      reverse,
      sense_strand,
-     specificity) = tsv.strip().split(sep)
+     specificity) = fields[:10]
     t = sgrna_target(target, pam, chrom, start, end, reverse)
     t.gene = none_or_str(gene)
     t.offset = none_or_int(offset)
     t.sense_strand = bool_from_sense(sense_strand)
     t.specificity = none_or_int(specificity)
+    for i, value in enumerate(fields[10:]):
+      if i < len(extra_fields):
+        t.extras[extra_fields[i]] = value
+      else:
+        t.extras[i + 10] = value
     return t
 
   @classmethod
-  def header(cls, sep='\t'):
+  def header(cls, sep='\t', extra_fields=()):
     return sep.join([
       'gene',
       'offset',
@@ -131,7 +143,7 @@ class sgrna_target(object):
       'end',
       'repldir',
       'transdir',
-      'specificity'])
+      'specificity'] + list(extra_fields))
 
   def __str__(self, sep='\t'):
     if self.reverse:
@@ -152,7 +164,7 @@ class sgrna_target(object):
       self.end,
       rev_str,
       sst_str,
-      self.specificity]])
+      self.specificity] + list(self.extras.values())])
 
   def id_str(self, sep=';'):
     return sep.join([str(x) for x in [
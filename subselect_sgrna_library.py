@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+
+# Author: John Hawkins (jsh) [really@gmail.com]
+
+import argparse
+import logging
+import os.path
+import sys
+
+import numpy as np
+
+import library_io
+from target_table import target_table
+
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s %(levelname)s %(message)s')
+
+class Error(Exception):
+  pass
+
+class SampleError(Error):
+  pass
+
+
+SUBSELECTOR_REGISTRY = dict()
+
+# Specificity thresholds tried in turn, from most to least stringent.
+THRESHOLDS = (30, 20, 10, 0)
+# Guides closer together than this (in offset) are considered overlapping.
+MIN_SPACING = 20
+
+
+class gene_groups(object):
+  """Rows of a target_table grouped by gene, each group sorted by offset.
+
+  order lists row indices group by group; group[i] is the group of order[i],
+  and starts[g] is where group g begins in order.  Groups are numbered by the
+  gene's first appearance in the table.
+  """
+  def __init__(self, table, keep=None):
+    genes = table['gene']
+    labelled = np.array([x is not None for x in genes], dtype=bool)
+    if keep is not None:
+      labelled &= keep
+    rows = np.flatnonzero(labelled)
+    names, first, inverse = np.unique(
+        genes[rows].astype(str), return_index=True, return_inverse=True)
+    # Renumber genes by first appearance rather than alphabetically.
+    appearance = np.argsort(np.argsort(first, kind='stable'), kind='stable')
+    gene_ids = appearance[inverse]
+    sort = np.lexsort((table['offset'][rows], gene_ids))
+    self.order = rows[sort]
+    self.group = gene_ids[sort]
+    self.names = names[np.argsort(first, kind='stable')]
+    self.starts = np.searchsorted(self.group, np.arange(len(self.names)))
+    self.offsets = table['offset'][self.order]
+
+  def __len__(self):
+    return len(self.names)
+
+  def count(self, mask):
+    """Number of masked (sorted) rows in each group."""
+    return np.bincount(self.group[mask], minlength=len(self))
+
+  def rank(self, mask):
+    """0-based position of each masked row among masked rows of its group."""
+    running = np.cumsum(mask)
+    before = np.concatenate(([0], running))[self.starts][self.group]
+    return running - before - 1
+
+
+def partition_overlapping(groups, mask, spacing=MIN_SPACING):
+  """Greedily keep masked guides at least 'spacing' apart, within each gene.
+
+  Walks each gene's masked guides in offset order, keeping a guide only if it
+  is far enough from the last one kept.  The walk is done for all genes at once,
+  one rank at a time.
+
+  Returns:
+    spaced: bool mask over sorted rows of the guides that were kept.
+  """
+  spaced = np.zeros(len(mask), dtype=bool)
+  positions = np.flatnonzero(mask)
+  if not len(positions):
+    return spaced
+  ranks = groups.rank(mask)[positions]
+  by_rank = np.argsort(ranks, kind='stable')
+  rank_starts = np.searchsorted(ranks[by_rank], np.arange(ranks.max() + 2))
+  last = np.zeros(len(groups), dtype=np.int64)
+  for k in range(ranks.max() + 1):
+    at_rank = positions[by_rank[rank_starts[k]:rank_starts[k + 1]]]
+    gene = groups.group[at_rank]
+    offset = groups.offsets[at_rank]
+    keep = (k == 0) | (offset >= last[gene] + spacing)
+    spaced[at_rank[keep]] = True
+    last[gene[keep]] = offset[keep]
+  return spaced
+
+
+def tiered_selection(table, groups, wanted, pool, fallback=None):
+  """Pick 'wanted' guides per gene, relaxing specificity one tier at a time.
+
+  For each threshold in THRESHOLDS, take non-overlapping guides from the pool
+  with specificity above the threshold if there are enough, or else all of those
+  plus overlapping ones if that suffices.  Failing every threshold, pad the
+  specific guides with non-specific ones and finally, if a fallback pool is
+  given and the pool runs dry, with guides from the fallback.
+
+  Args:
+    table:    target_table being subselected.
+    groups:   gene_groups over the table.
+    wanted:   guides wanted per gene.
+    pool:     bool mask over sorted rows of preferred guides.
+    fallback: [optional] bool mask over sorted rows to use last.
+  Returns:
+    Selected row indices, gene by gene, in selection order.
+  """
+  specificity = table['specificity'][groups.order]
+  gene = groups.group
+  decided = np.zeros(len(groups), dtype=bool)
+  picked = np.zeros(len(gene), dtype=bool)
+  # Sorting key within a gene: which part of the answer a row came from.
+  part = np.zeros(len(gene), dtype=np.int64)
+  within = np.zeros(len(gene), dtype=np.int64)
+  def take(mask, limit, part_number):
+    """Pick masked rows of undecided genes, up to limit[gene] per gene."""
+    ranks = groups.rank(mask)
+    chosen = mask & ~decided[gene] & (ranks < limit[gene])
+    picked[chosen] = True
+    part[chosen] = part_number
+    within[chosen] = ranks[chosen]
+  for threshold in THRESHOLDS:
+    specific = pool & (specificity > threshold)
+    spaced = partition_overlapping(groups, specific)
+    overlapped = specific & ~spaced
+    n_spaced = groups.count(spaced)
+    n_specific = groups.count(specific)
+    enough_spaced = ~decided & (n_spaced >= wanted)
+    take(spaced & enough_spaced[gene], np.full(len(groups), wanted), 0)
+    decided |= enough_spaced
+    enough_specific = ~decided & (n_specific >= wanted)
+    take(spaced & enough_specific[gene], n_spaced, 0)
+    take(overlapped & enough_specific[gene], wanted - n_spaced, 1)
+    decided |= enough_specific
+  # Nothing worked, so n_specific and friends are left from threshold 0.
+  nonspecific = pool & ~specific
+  n_pool = groups.count(pool)
+  if fallback is None:
+    padded = ~decided
+  else:
+    padded = ~decided & (n_pool >= wanted)
+  take(specific & padded[gene], n_specific, 0)
+  take(nonspecific & padded[gene], wanted - n_specific, 1)
+  decided |= padded
+  if fallback is not None:
+    take(pool, n_pool, 0)
+    take(fallback, wanted - n_pool, 1)
+  sort = np.lexsort((within[picked], part[picked], gene[picked]))
+  return groups.order[picked][sort]
+
+
+def antisense(table, groups, wanted):
+  sense = table['sense_strand'][groups.order]
+  return tiered_selection(table, groups, wanted, ~sense, fallback=sense)
+
+SUBSELECTOR_REGISTRY['antisense'] = antisense
+
+
+def template(table, groups, wanted):
+  sense = table['sense_strand'][groups.order]
+  return tiered_selection(table, groups, wanted, sense)
+
+SUBSELECTOR_REGISTRY['template'] = template
+
+
+def parse_args():
+  """Read in the arguments for the sgrna library subselection code."""
+  logging.info('Parsing command line.')
+  parser = argparse.ArgumentParser(
+      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument('--input_tsv_file', type=str, required=True,
+                      help='Targets file written by build_sgrna_library.py.')
+  parser.add_argument(
+      '--output_tsv_file_name', type=str, default=None,
+      help='[optional] Where to write the chosen targets.')
+  parser.add_argument('--subselector', type=str, required=True,
+                      choices=sorted(SUBSELECTOR_REGISTRY),
+                      help='Selection policy.')
+  parser.add_argument('--wanted', type=int, default=3,
+                      help='Number of guides wanted per gene.')
+  parser.add_argument('--gene_list', type=str, default=None,
+                      help='[optional] File listing the genes to select for.')
+  parser.add_argument('--exclude_listed_genes', action='store_true',
+                      default=False,
+                      help='Select for every gene except those listed.')
+  args = parser.parse_args()
+  if args.output_tsv_file_name is None:
+    base, ext = os.path.splitext(args.input_tsv_file)
+    args.output_tsv_file_name =  base + '.sub' + ext
+  if args.gene_list is not None:
+    args.gene_list = set([x.strip() for x in open(args.gene_list)])
+  return args
+
+
+def main():
+  args = parse_args()
+  subselector_func = SUBSELECTOR_REGISTRY[args.subselector]
+  logging.info('Reading in targets from {0}'.format(args.input_tsv_file))
+  with library_io.open_input(args.input_tsv_file) as input_file:
+    table = target_table.from_lines(input_file)
+  keep = None
+  if args.gene_list is not None:
+    listed = np.isin(table['gene'].astype(str), list(args.gene_list))
+    keep = ~listed if args.exclude_listed_genes else listed
+  groups = gene_groups(table, keep)
+  logging.info('Selecting targets for {0} genes.'.format(len(groups)))
+  chosen = subselector_func(table, groups, args.wanted)
+  logging.info('Writing {0} targets to {1}'.format(
+      len(chosen), args.output_tsv_file_name))
+  with library_io.open_output(args.output_tsv_file_name) as output_file:
+    if table.header is not None:
+      output_file.write(table.header + '\n')
+    output_file.write(''.join(table.rows[i] + '\n' for i in chosen))
+
+##############################################
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+# Author: John Hawkins (jsh) [really@gmail.com]
+
+import numpy as np
+
+from sgrna_target import sgrna_target
+
+
+# Stand-in for 'None' in integer columns.
+MISSING = np.iinfo(np.int64).min
+
+INT_COLUMNS = ('offset', 'start', 'end', 'specificity')
+STR_COLUMNS = ('gene', 'target', 'pam', 'chrom')
+
+
+class target_table(object):
+  """Columnar form of a targets TSV, with one NumPy array per column.
+
+  Columns are named as in sgrna_target.header(), except that 'repldir' and
+  'transdir' become the bool columns 'reverse' and 'sense_strand'.  Integer
+  columns hold MISSING where the file says 'None', and gene is None for
+  unlabelled targets.  The original lines are kept in rows, so that selected
+  targets can be written back out unchanged (extra columns included).
+  """
+  def __init__(self, rows, columns, header=None):
+    self.rows = rows
+    self.columns = columns
+    self.header = header
+
+  @classmethod
+  def from_lines(cls, lines, sep='\t'):
+    """Build from the lines of a file written by build_sgrna_library.py."""
+    header = None
+    rows = list()
+    for line in lines:
+      if line.startswith('#'):
+        continue
+      line = line.rstrip('\n')
+      if line.startswith('gene' + sep):
+        header = line
+        continue
+      rows.append(line)
+    fields = [x.split(sep) for x in rows]
+    names = sgrna_target.header(sep).split(sep)
+    columns = dict()
+    for j, name in enumerate(names):
+      values = [x[j] for x in fields]
+      if name in INT_COLUMNS:
+        columns[name] = np.array(
+            [MISSING if x == 'None' else int(x) for x in values],
+            dtype=np.int64)
+      elif name == 'repldir':
+        columns['reverse'] = np.array([x == 'rev' for x in values], dtype=bool)
+      elif name == 'transdir':
+        columns['sense_strand'] = np.array(
+            [x == 'sense' for x in values], dtype=bool)
+      else:
+        columns[name] = np.array(
+            [None if x == 'None' else x for x in values], dtype=object)
+    return target_table(rows, columns, header)
+
+  def __len__(self):
+    return len(self.rows)
+
+  def __getitem__(self, name):
+    return self.columns[name]